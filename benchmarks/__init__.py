@@ -0,0 +1,5 @@
+"""Benchmarks of Mesh's synchronization hot paths
+
+Run with ``python -m benchmarks`` from the repository root, see
+``python -m benchmarks --help`` for the options.
+"""
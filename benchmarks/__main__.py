@@ -0,0 +1,147 @@
+"""Runs the benchmarks and compares them against a baseline
+
+Throughput is the number of items processed per second in the median
+run, latency percentiles are over the timed runs and peak memory is
+measured with :mod:`tracemalloc` in a separate run. With ``--baseline``
+the process exits with status 1 if any case got slower or used more
+memory than the baseline allows.
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+from benchmarks.cases import CASES
+
+#: Smallest and largest supported data size
+SIZES = (1000, 500000)
+
+
+def init_args():
+    """Initialize the CLI argument parser"""
+
+    parser = argparse.ArgumentParser(
+            prog='python -m benchmarks',
+            description='Benchmarks of Mesh hot paths')
+    parser.add_argument(
+            'cases', nargs='*', metavar='case',
+            help=f'Cases to run, all by default: {", ".join(sorted(CASES))}')
+    parser.add_argument(
+            '--size', type=int, default=10000,
+            help=f'Number of items, between {SIZES[0]} and {SIZES[1]}')
+    parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Number of timed runs per case')
+    parser.add_argument(
+            '--baseline', type=argparse.FileType('r'),
+            help='Results to compare against, as written by --save')
+    parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Allowed relative regression against the baseline')
+    parser.add_argument(
+            '--save', type=argparse.FileType('w'),
+            help='Write the results as json')
+
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f'Unknown cases: {", ".join(sorted(unknown))}')
+    if not SIZES[0] <= args.size <= SIZES[1]:
+        parser.error(f'--size must be between {SIZES[0]} and {SIZES[1]}')
+    return args
+
+
+def percentile(values, fraction):
+    """Returns the nearest rank percentile of *values*"""
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(name, size, repeat):
+    """Runs a case and returns its results
+
+    :rtype: :class:`~python:dict`
+    """
+
+    runs = CASES[name](size)
+    run = next(runs)
+    try:
+        run()  # Warm up caches and connections
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            items = run()
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        runs.close()
+
+    median = statistics.median(timings)
+    return {
+        'items': items,
+        'throughput': items / median if median else float('inf'),
+        'p50': percentile(timings, 0.5),
+        'p95': percentile(timings, 0.95),
+        'p99': percentile(timings, 0.99),
+        'peak_memory': peak
+    }
+
+
+def regressions(results, baseline, threshold):
+    """Returns descriptions of results worse than the baseline"""
+
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or base.get('items') != result['items']:
+            continue
+
+        if result['throughput'] < base['throughput'] * (1 - threshold):
+            found.append(f'{name}: throughput {result["throughput"]:.0f}/s, '
+                         f'baseline {base["throughput"]:.0f}/s')
+        if result['peak_memory'] > base['peak_memory'] * (1 + threshold):
+            found.append(f'{name}: peak memory {result["peak_memory"]} B, '
+                         f'baseline {base["peak_memory"]} B')
+    return found
+
+
+def main():
+    args = init_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    print(f'{"case":<20} {"items":>8} {"items/s":>12} {"p50 ms":>9} '
+          f'{"p95 ms":>9} {"p99 ms":>9} {"peak MiB":>9}')
+    for name in args.cases or sorted(CASES):
+        result = results[name] = measure(name, args.size, args.repeat)
+        print(f'{name:<20} {result["items"]:>8} '
+              f'{result["throughput"]:>12.0f} '
+              f'{result["p50"] * 1000:>9.2f} {result["p95"] * 1000:>9.2f} '
+              f'{result["p99"] * 1000:>9.2f} '
+              f'{result["peak_memory"] / 2 ** 20:>9.2f}')
+
+    if args.save is not None:
+        json.dump(results, args.save, indent=2)
+
+    if args.baseline is not None:
+        found = regressions(results, json.load(args.baseline), args.threshold)
+        for regression in found:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
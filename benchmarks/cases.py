@@ -0,0 +1,193 @@
+"""Benchmark cases
+
+Each case is a generator function taking the data size. It prepares its
+data, yields a callable which is timed repeatedly and returns the number
+of items it processed, and cleans up once resumed.
+"""
+
+from pathlib import Path
+import tempfile
+
+from benchmarks import data
+from benchmarks.mocks import MockPlex, MockTrakt, trakt_client
+from mesh.helpers import (datetime_from_ISO8601_str, datetime_to_ISO8601_str,
+                          epochs_from_ISO8601_strs)
+from mesh.history import History
+from mesh.matching import Episode, IdIndex, get_index
+from mesh.outbox import get_outbox
+from mesh.synchronize import push, send_batches
+from mesh.user import User, UserManager, UserStore
+
+#: Registered cases by name
+CASES = {}
+
+#: Cases which make HTTP requests use this fraction of the size
+NETWORK_SCALE = 100
+
+
+def case(function):
+    CASES[function.__name__.replace('_', '-')] = function
+    return function
+
+
+def unlimited_trakt(size):
+    """Returns a :class:`MockTrakt` with *size* items and no rate limits"""
+    return MockTrakt(size, read_rate=1e9, write_rate=1e9, burst=10 ** 9)
+
+
+@case
+def timestamps_parse(size):
+    strs = [e['watched_at'] for e in data.history(size)]
+
+    def run():
+        for s in strs:
+            datetime_from_ISO8601_str(s)
+        return len(strs)
+    yield run
+
+
+@case
+def timestamps_format(size):
+    dates = [p.watched_at for p in data.plays(size)]
+
+    def run():
+        for d in dates:
+            datetime_to_ISO8601_str(d)
+        return len(dates)
+    yield run
+
+
+@case
+def timestamps_batch(size):
+    strs = [e['watched_at'] for e in data.history(size)]
+    yield lambda: len(epochs_from_ISO8601_strs(strs))
+
+
+@case
+def matching_hits(size):
+    with tempfile.TemporaryDirectory() as tmp:
+        index = IdIndex(Path(tmp).joinpath('idindex.db'))
+        index.update([('movie', data.guids(i), i) for i in range(size)])
+        items = [('movie', data.guids(i)) for i in range(size)]
+
+        yield lambda: len(index.resolve_many(items))
+        index.close()
+
+
+@case
+def matching_misses(size):
+    count = max(10, size // NETWORK_SCALE)
+    items = [('movie', data.guids(i)[1:]) for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            unlimited_trakt(count) as trakt, trakt_client(trakt):
+        path = Path(tmp).joinpath('idindex.db')
+
+        def run():
+            index = IdIndex(path)
+            index.invalidate()
+            resolved = index.resolve_many(items)
+            index.close()
+            return len(resolved)
+        yield run
+
+
+@case
+def matching_episodes(size):
+    count = max(data.EPISODES_PER_SHOW, size // NETWORK_SCALE)
+    items = [('episode', data.episode_guids(i)[1:],
+              Episode(data.show_guids(i // data.EPISODES_PER_SHOW)[1:], 1,
+                      i % data.EPISODES_PER_SHOW + 1))
+             for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            unlimited_trakt(count) as trakt, trakt_client(trakt):
+        path = Path(tmp).joinpath('idindex.db')
+
+        def run():
+            index = IdIndex(path)
+            index.invalidate()
+            resolved = index.resolve_many(items)
+            index.close()
+            return len(resolved)
+        yield run
+
+
+@case
+def history_diff(size):
+    plex = [(e['type'], e['movie']['ids']['trakt'],
+             data.watched_at(e['movie']['ids']['trakt']))
+            for e in data.history(size)]
+    trakt = data.history(size, offset=size // 10)
+
+    def run():
+        left = History(plex)
+        right = History.from_entries(trakt)
+        left.difference(right)
+        sum(1 for _ in left.join(right))
+        return size * 2
+    yield run
+
+
+@case
+def users_json(size):
+    users = data.users(size)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp).joinpath('usermapping')
+
+        def run():
+            manager = UserManager(path, users)
+            manager.save()
+            return len(UserManager(path).users)
+        yield run
+
+
+@case
+def users_store(size):
+    users = data.users(size)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = UserStore(Path(tmp).joinpath('users.db'))
+        for user in users:
+            store.add(user)
+
+        def run():
+            for user in users:
+                store.update(user, ('last_pull',))
+            return len(users)
+        yield run
+        store.close()
+
+
+@case
+def push_batching(size):
+    items = [('movie', i, e['watched_at'])
+             for i, e in enumerate(data.history(size))]
+
+    with unlimited_trakt(size) as trakt, trakt_client(trakt):
+        def run():
+            send_batches('sync/history', items)
+            return len(items)
+        yield run
+
+
+@case
+def push_pipeline(size):
+    count = max(500, size // 10)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockPlex(count, latency=0.01) as plex, \
+            MockTrakt(count, read_rate=1e9, write_rate=1e9, burst=10 ** 9,
+                      latency=0.01) as trakt, \
+            trakt_client(trakt, username=None):
+        get_index(Path(tmp).joinpath('idindex.db'))
+        get_outbox(Path(tmp).joinpath('outbox.db'))
+        runs = iter(range(10 ** 9))
+
+        def run():
+            # A new Trakt user each run, so every play is sent again
+            name = f'run{next(runs)}'
+            user = User(name, plex.token('user0'), trakt.authorize(name),
+                        url=plex.url)
+            push(user, plex.identifier, batch_size=100)
+            return len(trakt.state(name).history)
+        yield run
@@ -0,0 +1,120 @@
+"""Generators of synthetic Plex libraries, Trakt histories and users
+
+All generators are deterministic for a given size, so results of
+different runs are comparable.
+"""
+
+from datetime import datetime, timezone
+import random
+
+from mesh.helpers import ISO8601_str_from_epoch
+from mesh.plex import Play
+from mesh.user import User
+
+#: Watch times are spread over the ten years before this epoch
+LATEST = 1600000000
+SPAN = 10 * 365 * 24 * 60 * 60
+
+
+#: Offset between the Trakt ids and TVDb ids of synthetic episodes
+EPISODE_OFFSET = 10 ** 7
+
+#: Offset between the Trakt ids and TVDb ids of synthetic shows
+SHOW_OFFSET = 2 * 10 ** 7
+
+#: Number of episodes of each synthetic show, all in season 1
+EPISODES_PER_SHOW = 100
+
+
+def guids(i):
+    """Returns the normalized guids of the *i*:th synthetic movie"""
+    return [f'plex://movie/{i:024x}', f'imdb://tt{i:07d}', f'tmdb://{i}']
+
+
+def episode_guids(i):
+    """Returns the normalized guids of the *i*:th synthetic episode"""
+    return [f'plex://episode/{i:024x}', f'tvdb://{EPISODE_OFFSET + i}']
+
+
+def show_guids(i):
+    """Returns the normalized guids of the *i*:th synthetic show"""
+    return [f'plex://show/{i:024x}', f'tvdb://{SHOW_OFFSET + i}']
+
+
+def trakt_id(id_type, value):
+    """Returns the media type and Trakt id of a synthetic item or None
+
+    Movies are found through their IMDb or TMDb ids, shows and episodes
+    through their TVDb ids.
+    """
+
+    try:
+        if id_type == 'imdb' and value.startswith('tt'):
+            return 'movie', int(value[2:])
+        if id_type == 'tmdb':
+            return 'movie', int(value)
+        if id_type == 'tvdb' and int(value) >= SHOW_OFFSET:
+            return 'show', int(value) - SHOW_OFFSET
+        if id_type == 'tvdb' and int(value) >= EPISODE_OFFSET:
+            return 'episode', int(value) - EPISODE_OFFSET
+    except ValueError:
+        pass
+    return None
+
+
+def trakt_entry(media, i, **fields):
+    """Returns a Trakt sync entry of a synthetic item
+
+    Episodes carry their show, season and number like on Trakt.
+
+    :param fields: Additional fields, e.g. ``watched_at``
+    """
+
+    entry = dict(fields, type=media)
+    if media == 'movie':
+        entry['movie'] = {'ids': {'trakt': i, 'imdb': f'tt{i:07d}',
+                                  'tmdb': i}}
+    elif media == 'show':
+        entry['show'] = {'ids': {'trakt': i, 'tvdb': SHOW_OFFSET + i}}
+    else:
+        entry['episode'] = {'season': 1, 'number': i % EPISODES_PER_SHOW + 1,
+                            'ids': {'trakt': i, 'tvdb': EPISODE_OFFSET + i}}
+        entry['show'] = trakt_entry('show', i // EPISODES_PER_SHOW)['show']
+    return entry
+
+
+def watched_at(i):
+    """Returns a deterministic watch time in seconds since the epoch"""
+    return LATEST - (i * 7919) % SPAN
+
+
+def plays(size):
+    """Returns *size* Plex plays"""
+
+    return [Play('movie', guids(i),
+                 datetime.fromtimestamp(watched_at(i), timezone.utc))
+            for i in range(size)]
+
+
+def history(size, offset=0):
+    """Returns *size* Trakt history entries
+
+    :param offset: Shifts the items, so histories with different offsets
+                   only partially overlap
+    """
+
+    return [trakt_entry('movie', i, id=i,
+                        watched_at=ISO8601_str_from_epoch(watched_at(i)))
+            for i in range(offset, offset + size)]
+
+
+def users(size):
+    """Returns *size* users with shuffled watermarks"""
+
+    rng = random.Random(size)
+    return [User(f'user{i}', f'token{i}',
+                 {'access_token': f'access{i}', 'refresh_token': f'refresh{i}',
+                  'created_at': LATEST, 'expires_in': 7776000},
+                 last_pull=datetime.fromtimestamp(
+                     LATEST - rng.randrange(SPAN), timezone.utc))
+            for i in range(size)]
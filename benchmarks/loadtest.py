@@ -0,0 +1,136 @@
+"""Runs the scheduler for many users against the mock servers
+
+Every user gets a Plex token of a :class:`~benchmarks.mocks.MockPlex`
+and a Trakt token of a :class:`~benchmarks.mocks.MockTrakt`, and one
+event of the chosen mode is scheduled for each. Trakt's rate limits are
+enforced per user by the mock and by Mesh's client side limiters, so
+the run shows how the scheduler copes with 429s and injected errors.
+
+Example::
+
+    python -m benchmarks.loadtest --users 200 --size 5000 --mode push
+"""
+
+import argparse
+import logging
+from pathlib import Path
+import tempfile
+import threading
+import time
+
+from benchmarks.__main__ import percentile
+from benchmarks.mocks import MockPlex, MockTrakt, trakt_client
+from mesh.events import EVENTS, Scheduler
+from mesh.journal import get_journal
+from mesh.matching import get_index
+from mesh.outbox import get_outbox
+from mesh.sessions import configure
+from mesh.user import User
+
+
+def init_args():
+    """Initialize the CLI argument parser"""
+
+    parser = argparse.ArgumentParser(
+            prog='python -m benchmarks.loadtest',
+            description='Load test of the scheduler against mock servers')
+    parser.add_argument(
+            '--users', type=int, default=100,
+            help='Number of users')
+    parser.add_argument(
+            '--size', type=int, default=1000,
+            help='Number of movies and of episodes in the Plex library')
+    parser.add_argument(
+            '--mode', choices=sorted(EVENTS), default='push',
+            help='Event run for each user')
+    parser.add_argument(
+            '--workers', type=int, default=16,
+            help='Maximum number of concurrent events')
+    parser.add_argument(
+            '--history', type=int, default=0,
+            help='Number of plays each user starts out with on Trakt')
+    parser.add_argument(
+            '--read-rate', type=float, default=1000 / 300,
+            help='Trakt GET requests per second allowed per user')
+    parser.add_argument(
+            '--write-rate', type=float, default=1,
+            help='Trakt POST requests per second allowed per user')
+    parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Seconds added to every mock response')
+    parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help='Fraction of mock requests answered with 503')
+    parser.add_argument(
+            '--no-client-limit', dest='limit', action='store_false',
+            help="Disable Mesh's client side rate limiting")
+    return parser.parse_args()
+
+
+def timed(event_class, timings, failures):
+    """Returns a subclass of *event_class* recording each run
+
+    Run times in seconds are appended to *timings* and failed runs are
+    counted in ``failures[0]``, the scheduler still logs the error.
+    """
+
+    lock = threading.Lock()
+
+    class TimedEvent(event_class):
+        def run(self, servers):
+            start = time.perf_counter()
+            try:
+                super().run(servers)
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                raise
+            finally:
+                with lock:
+                    timings.append(time.perf_counter() - start)
+
+    return TimedEvent
+
+
+def main():
+    args = init_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    configure(pool_size=args.workers)
+
+    mock = {'latency': args.latency, 'error_rate': args.error_rate}
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockPlex(args.size, args.users, **mock) as plex, \
+            MockTrakt(args.size, args.history, args.read_rate,
+                      args.write_rate, **mock) as trakt, \
+            trakt_client(trakt, username=None, limit=args.limit):
+        get_index(Path(tmp).joinpath('idindex.db'))
+        get_journal(Path(tmp).joinpath('journal.db'))
+        get_outbox(Path(tmp).joinpath('outbox.db'))
+
+        timings, failures = [], [0]
+        event_class = timed(EVENTS[args.mode], timings, failures)
+        scheduler = Scheduler(plex.identifier, workers=args.workers)
+        now = time.monotonic()
+        for i in range(args.users):
+            name = f'user{i}'
+            user = User(name, plex.token(name), trakt.authorize(name),
+                        url=plex.url)
+            scheduler.schedule(event_class(now, user))
+
+        start = time.perf_counter()
+        scheduler.run(until_idle=True)
+        elapsed = time.perf_counter() - start
+
+    print(f'{args.mode} for {args.users} users with {args.workers} workers')
+    print(f'events        {len(timings):>10} ({failures[0]} failed)')
+    print(f'elapsed s     {elapsed:>10.2f}')
+    print(f'events/s      {len(timings) / elapsed:>10.2f}')
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        print(f'{name} ms        {percentile(timings, fraction) * 1000:>10.1f}')
+    print(f'plex requests {plex.requests:>10} ({plex.errors} errors)')
+    print(f'trakt requests{trakt.requests:>10} ({trakt.errors} errors, '
+          f'{trakt.rate_limited} rate limited)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+"""Local stand-ins for the Plex and Trakt APIs used by Mesh
+
+The servers emulate the subset of the APIs Mesh calls, with in memory
+state per user, and are meant for benchmarks and load tests on a single
+machine. Each server runs on a background thread::
+
+    with MockTrakt(size=10000) as trakt, MockPlex(size=10000, users=100) as plex:
+        ...
+
+Latency and error rates are configurable, see :class:`MockServer`.
+"""
+
+from benchmarks.mocks.plex import MockPlex
+from benchmarks.mocks.server import MockServer, trakt_client
+from benchmarks.mocks.trakt import MockTrakt
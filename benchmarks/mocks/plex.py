@@ -0,0 +1,413 @@
+"""Stand-in for the Plex server and plex.tv endpoints used by Mesh"""
+
+import base64
+import hashlib
+import json
+import queue
+import threading
+import time
+import uuid
+from xml.sax.saxutils import quoteattr
+
+from benchmarks import data
+from benchmarks.mocks.server import MockServer, Response, route
+
+#: Key of the movie and the show library section
+MOVIES, SHOWS = '1', '2'
+
+#: Fixed key from the websocket protocol, see RFC 6455
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+#: Plex search type of each media type
+_TYPES = {'1': 'movie', '2': 'show', '4': 'episode'}
+
+#: Attributes of the view state of an item for a user
+_STATE = ('viewCount', 'lastViewedAt', 'userRating', 'lastRatedAt')
+
+
+def _xml(tag='MediaContainer', children=(), **attrs):
+    """Returns an XML element with quoted attributes as text"""
+
+    attrs = ''.join(f' {k}={quoteattr(str(v))}' for k, v in attrs.items()
+                    if v is not None)
+    return f'<{tag}{attrs}>{"".join(children)}</{tag}>'
+
+
+def _filter(state, filters):
+    """Returns whether a view state matches Plex ``>>`` filters"""
+
+    for name, value in filters.items():
+        if float(state.get(name) or 0) <= float(value):
+            return False
+    return True
+
+
+class MockPlex(MockServer):
+    """Emulates a Plex server with a movie and a TV show library
+
+    Both libraries hold *size* items with the synthetic guids of
+    :mod:`benchmarks.data`, episodes are grouped into shows of
+    :data:`benchmarks.data.EPISODES_PER_SHOW` episodes. Items are found
+    through their guids like with the Plex agents. Every user starts out having watched every
+    *watch_every*:th item, with different items for each user. Marking
+    items as played and rating them changes the state of the user owning
+    the token of the request.
+
+    Playback started through :meth:`play` is listed in the server's
+    sessions and announced on its notification websocket. The plex.tv
+    pin endpoints used by :func:`mesh.plex.oauth` are served as well.
+
+    :param size: Number of movies and of episodes
+    :param users: Number of users, named ``user0``, ``user1``...
+    :param watch_every: Spacing of the initially watched items
+    """
+
+    def __init__(self, size=10000, users=1, watch_every=3, **kwargs):
+        super().__init__(**kwargs)
+        self.size = size
+        self.watch_every = watch_every
+        self.identifier = uuid.uuid4().hex
+
+        self._users = {self.token(f'user{i}'): (i, f'user{i}')
+                       for i in range(users)}
+        self._states = {}
+        self._sessions = {}
+        self._listeners = []
+        self._pins = {}
+        self._state_lock = threading.Lock()
+
+    @staticmethod
+    def token(username):
+        """Returns the Plex token of a user"""
+        return f'token-{username}'
+
+    @property
+    def shows(self):
+        """Number of shows"""
+        return -(-self.size // data.EPISODES_PER_SHOW)
+
+    def rating_key(self, media, i):
+        """Returns the rating key of the *i*:th movie, episode or show"""
+
+        offset = {'movie': 0, 'episode': self.size, 'show': 2 * self.size}
+        return offset[media] + i + 1
+
+    def _item(self, rating_key):
+        """Returns the media type and index of a rating key or None"""
+
+        if 1 <= rating_key <= self.size:
+            return 'movie', rating_key - 1
+        if self.size < rating_key <= 2 * self.size:
+            return 'episode', rating_key - self.size - 1
+        if 2 * self.size < rating_key <= 2 * self.size + self.shows:
+            return 'show', rating_key - 2 * self.size - 1
+        return None
+
+    def _keys(self, media):
+        """Returns the rating keys of all items of a media type"""
+
+        count = self.shows if media == 'show' else self.size
+        return [self.rating_key(media, i) for i in range(count)]
+
+    def _guids(self, rating_key):
+        """Returns the guids of an item, the Plex guid first"""
+
+        media, i = self._item(rating_key)
+        return {'movie': data.guids, 'episode': data.episode_guids,
+                'show': data.show_guids}[media](i)
+
+    def state(self, username, rating_key):
+        """Returns the view state of an item for a user"""
+
+        index = int(username[len('user'):])
+        with self._state_lock:
+            override = self._states.get((username, rating_key))
+        if override is not None:
+            return override
+
+        media, i = self._item(rating_key)
+        if (i + index) % self.watch_every:
+            return {}
+        return {'viewCount': 1, 'lastViewedAt': data.watched_at(i)}
+
+    def _update(self, username, rating_key, **changes):
+        state = dict(self.state(username, rating_key), **changes)
+        with self._state_lock:
+            self._states[(username, rating_key)] = state
+
+    def _element(self, rating_key, username):
+        media, i = self._item(rating_key)
+        plex, *guids = self._guids(rating_key)
+        key = f'/library/metadata/{rating_key}'
+        if media == 'show':
+            return _xml('Directory', [_xml('Guid', id=g) for g in guids],
+                        ratingKey=rating_key, guid=plex, type='show',
+                        title=f'Show {i}', key=f'{key}/children',
+                        librarySectionID=SHOWS, leafCount=min(
+                            data.EPISODES_PER_SHOW,
+                            self.size - i * data.EPISODES_PER_SHOW))
+
+        if media == 'movie':
+            attrs = {'type': 'movie', 'title': f'Movie {i}',
+                     'librarySectionID': MOVIES}
+        else:
+            show, number = divmod(i, data.EPISODES_PER_SHOW)
+            attrs = {'type': 'episode', 'title': f'Episode {i}',
+                     'librarySectionID': SHOWS,
+                     'grandparentTitle': f'Show {show}',
+                     'grandparentRatingKey': self.rating_key('show', show),
+                     'grandparentGuid': data.show_guids(show)[0],
+                     'parentIndex': 1, 'index': number + 1}
+
+        state = self.state(username, rating_key)
+        return _xml('Video', [_xml('Guid', id=g) for g in guids],
+                    ratingKey=rating_key, guid=plex, duration=3600000,
+                    key=key, **attrs, **{k: state.get(k) for k in _STATE})
+
+    def before(self, request):
+        token = request.headers.get('X-Plex-Token') or \
+            request.query.get('X-Plex-Token')
+        request.user = self._users.get(token, (None, None))[1]
+        public = ('/identity', '/api/v2/pins', '/users/account')
+        if request.user is None and not request.path.startswith(public):
+            return Response('Unauthorized', 401, content_type='text/html')
+        return None
+
+    def _container(self, children=(), **attrs):
+        return Response(_xml(children=children, **attrs),
+                        content_type='text/xml')
+
+    @route('GET', '/identity')
+    def identity(self, request):
+        return self._container(machineIdentifier=self.identifier,
+                               version='1.40.0.0')
+
+    @route('GET', '/')
+    def root(self, request):
+        return self._container(machineIdentifier=self.identifier,
+                               friendlyName='Mock', version='1.40.0.0',
+                               myPlexUsername='user0')
+
+    @route('GET', '/library')
+    def library(self, request):
+        return self._container([_xml('Directory', key='sections',
+                                     title='Library Sections')])
+
+    @route('GET', '/library/sections')
+    def sections(self, request):
+        return self._container([
+            _xml('Directory', key=MOVIES, type='movie', title='Movies',
+                 agent='tv.plex.agents.movie', language='en-US',
+                 uuid='movies'),
+            _xml('Directory', key=SHOWS, type='show', title='TV Shows',
+                 agent='tv.plex.agents.series', language='en-US',
+                 uuid='shows')
+        ])
+
+    @route('GET', '/system/agents')
+    def agents(self, request):
+        return self._container([
+            _xml('Agent', identifier=f'tv.plex.agents.{name}',
+                 shortIdentifier=name, name=f'Plex {name.title()}')
+            for name in ('movie', 'series')
+        ])
+
+    def _page(self, request, keys):
+        """Returns a container with the requested page of items"""
+
+        start = int(request.headers.get('X-Plex-Container-Start') or
+                    request.query.get('X-Plex-Container-Start', 0))
+        size = int(request.headers.get('X-Plex-Container-Size') or
+                   request.query.get('X-Plex-Container-Size', len(keys)))
+        page = keys[start:start + size]
+        return self._container([self._element(k, request.user) for k in page],
+                               size=len(page), totalSize=len(keys), offset=start)
+
+    @route('GET', '/library/sections/(?P<section>\\d+)/all')
+    def all(self, request):
+        section = request.params['section']
+        if section not in (MOVIES, SHOWS):
+            return Response('Not found', 404, content_type='text/html')
+
+        default = '1' if section == MOVIES else '2'
+        media = _TYPES.get(request.query.get('type', default))
+        if (media == 'movie') != (section == MOVIES):
+            return self._container(size=0, totalSize=0)
+
+        guid = request.query.get('guid')
+        if guid is not None:
+            keys = [k for k in self._keys(media) if self._guids(k)[0] == guid]
+        else:
+            keys = self._keys(media)
+
+        filters = {k[:-2]: v for k, v in request.query.items()
+                   if k.endswith('>>')}
+        if filters:
+            keys = [k for k in keys
+                    if _filter(self.state(request.user, k), filters)]
+        return self._page(request, keys)
+
+    @route('GET', '/library/metadata/(?P<key>\\d+)')
+    def metadata(self, request):
+        key = int(request.params['key'])
+        if self._item(key) is None:
+            return Response('Not found', 404, content_type='text/html')
+        return self._container([self._element(key, request.user)], size=1)
+
+    @route('GET', '/library/metadata/(?P<key>\\d+)/allLeaves')
+    def leaves(self, request):
+        item = self._item(int(request.params['key']))
+        if item is None or item[0] != 'show':
+            return Response('Not found', 404, content_type='text/html')
+
+        first = item[1] * data.EPISODES_PER_SHOW
+        last = min(self.size, first + data.EPISODES_PER_SHOW)
+        return self._page(request, [self.rating_key('episode', i)
+                                    for i in range(first, last)])
+
+    @route('GET', '/library/metadata/(?P<key>\\d+)/matches')
+    def matches(self, request):
+        """Looks up an external guid given as title, e.g. ``imdb-tt01``"""
+
+        id_type, _, value = request.query.get('title', '').partition('-')
+        found = data.trakt_id(id_type, value)
+        if found is None:
+            return self._container(size=0)
+
+        media, i = found
+        count = self.shows if media == 'show' else self.size
+        if not 0 <= i < count:
+            return self._container(size=0)
+
+        guid = self._guids(self.rating_key(media, i))[0]
+        return self._container([_xml('SearchResult', guid=guid, score=100,
+                                     name=f'{media.title()} {i}')], size=1)
+
+    @route('GET', '/:/scrobble')
+    def scrobble(self, request):
+        key = int(request.query['key'])
+        state = self.state(request.user, key)
+        self._update(request.user, key,
+                     viewCount=state.get('viewCount', 0) + 1,
+                     lastViewedAt=int(time.time()))
+        return Response('', content_type='text/html')
+
+    @route('GET', '/:/unscrobble')
+    def unscrobble(self, request):
+        self._update(request.user, int(request.query['key']),
+                     viewCount=None, lastViewedAt=None)
+        return Response('', content_type='text/html')
+
+    @route('PUT', '/:/rate')
+    def rate(self, request):
+        rating = float(request.query['rating'])
+        self._update(request.user, int(request.query['key']),
+                     userRating=None if rating < 0 else rating,
+                     lastRatedAt=None if rating < 0 else int(time.time()))
+        return Response('', content_type='text/html')
+
+    def play(self, username, rating_key, state='playing', view_offset=0):
+        """Changes the playback state of a user and notifies listeners
+
+        :param state: ``playing``, ``paused`` or ``stopped``
+        :param view_offset: Playback position in milliseconds
+        :return: The session key
+        """
+
+        with self._state_lock:
+            session_key = str(self._sessions.get(
+                username, (len(self._sessions) + 1,))[0])
+            if state == 'stopped':
+                self._sessions.pop(username, None)
+            else:
+                self._sessions[username] = (session_key, rating_key)
+            listeners = list(self._listeners)
+
+        message = json.dumps({'NotificationContainer': {
+            'type': 'playing', 'size': 1,
+            'PlaySessionStateNotification': [{
+                'sessionKey': session_key, 'ratingKey': str(rating_key),
+                'key': f'/library/metadata/{rating_key}',
+                'viewOffset': view_offset, 'state': state}]}})
+        for listener in listeners:
+            listener.put(message)
+        return session_key
+
+    @route('GET', '/status/sessions')
+    def sessions(self, request):
+        with self._state_lock:
+            sessions = list(self._sessions.items())
+        return self._container([
+            _xml('Video', [_xml('User', title=username),
+                           _xml('Player', state='playing')],
+                 sessionKey=session_key, ratingKey=key, type='movie',
+                 key=f'/library/metadata/{key}', title='Playing')
+            for username, (session_key, key) in sessions
+        ], size=len(sessions))
+
+    @route('GET', '/:/websockets/notifications')
+    def notifications(self, request):
+        """Upgrades the connection and streams play notifications"""
+
+        handler = request.handler
+        key = request.headers['Sec-WebSocket-Key'] + _WEBSOCKET_GUID
+        accept = base64.b64encode(hashlib.sha1(key.encode()).digest())
+        handler.wfile.write(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        handler.wfile.flush()
+
+        messages = queue.Queue()
+        with self._state_lock:
+            self._listeners.append(messages)
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=1).encode()
+                except queue.Empty:
+                    message = None
+                if message is None:
+                    # Ping, which fails once the client has gone away
+                    handler.wfile.write(b'\x89\x00')
+                else:
+                    handler.wfile.write(_frame(message))
+                handler.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self._state_lock:
+                self._listeners.remove(messages)
+        return None
+
+    @route('POST', '/api/v2/pins(?:\\.json)?')
+    def create_pin(self, request):
+        pin = {'id': len(self._pins) + 1, 'code': uuid.uuid4().hex[:4]}
+        self._pins[pin['id']] = pin
+        return Response(pin, 201)
+
+    @route('GET', '/api/v2/pins/(?P<id>\\d+)(?:\\.json)?')
+    def check_pin(self, request):
+        pin = self._pins.get(int(request.params['id']))
+        if pin is None:
+            return Response({'errors': []}, 404)
+        return Response(dict(pin, authToken=self.token('user0')))
+
+    @route('GET', '/users/account(?:\\.json)?')
+    def account(self, request):
+        if request.user is None:
+            return Response({'error': 'Unauthorized'}, 401)
+        return Response({'user': {'username': request.user}})
+
+
+def _frame(payload):
+    """Returns an unmasked websocket text frame"""
+
+    length = len(payload)
+    if length < 126:
+        header = bytes([0x81, length])
+    elif length < 2 ** 16:
+        header = bytes([0x81, 126]) + length.to_bytes(2, 'big')
+    else:
+        header = bytes([0x81, 127]) + length.to_bytes(8, 'big')
+    return header + payload
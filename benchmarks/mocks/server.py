@@ -0,0 +1,221 @@
+"""Routing HTTP server shared by the mock APIs"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from hashlib import md5
+import json
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from trakt import Trakt
+
+from mesh import api
+from mesh.helpers import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class Request:
+    """A parsed request passed to route handlers"""
+
+    def __init__(self, handler, method, match):
+        url = urlsplit(handler.path)
+        self.handler = handler
+        self.method = method
+        self.path = url.path
+        self.params = match.groupdict()
+        self.query = dict(parse_qsl(url.query, keep_blank_values=True))
+        self.headers = handler.headers
+
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        self.json = json.loads(body) if body else None
+
+
+class Response:
+    """A response returned by route handlers
+
+    :param body: Text, or an object serialized as json
+    :param status: HTTP status code
+    :param headers: Additional headers
+    """
+
+    def __init__(self, body='', status=200, headers=None,
+                 content_type='application/json'):
+        if not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.content_type = content_type
+
+
+def route(method, pattern):
+    """Marks a :class:`MockServer` method as the handler of a path pattern"""
+
+    def decorator(function):
+        function.route = (method, re.compile(pattern + '$'))
+        return function
+    return decorator
+
+
+class MockServer:
+    """Threaded HTTP server dispatching requests to routed methods
+
+    :param latency: Seconds added to every response
+    :param jitter: Random seconds, up to this, added to the latency
+    :param error_rate: Fraction of requests answered with 503
+    :param seed: Seed of the random errors and jitter
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._routes = [getattr(self, name).route + (getattr(self, name),)
+                        for name in dir(type(self))
+                        if hasattr(getattr(type(self), name), 'route')]
+        self._server = None
+
+    @property
+    def url(self):
+        """Base url of the running server"""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Starts serving on a free local port"""
+
+        handler = type('Handler', (_Handler,), {'mock': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stops the server"""
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def before(self, request):
+        """Called before each routed request
+
+        :return: A response to send instead of routing the request, or None
+        """
+
+        return None
+
+    def _dispatch(self, handler, method):
+        path = urlsplit(handler.path).path
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if delay:
+            time.sleep(delay)
+
+        for route_method, pattern, function in self._routes:
+            match = pattern.match(path)
+            if route_method != method or match is None:
+                continue
+
+            request = Request(handler, method, match)
+            if failed:
+                return Response({'error': 'Injected failure'}, 503)
+            try:
+                return self.before(request) or function(request)
+            except Exception:
+                logger.exception(f'{method} {handler.path} failed')
+                return Response({'error': 'Mock failure'}, 500)
+        return Response({'error': 'Not found'}, 404)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        response = self.mock._dispatch(self, method)
+        if response is None:  # Connection was taken over, e.g. websockets
+            self.close_connection = True
+            return
+
+        if method == 'GET' and response.status == 200:
+            etag = f'"{md5(response.body).hexdigest()}"'
+            response.headers.setdefault('ETag', etag)
+            if self.headers.get('If-None-Match') == response.headers['ETag']:
+                response = Response(b'', 304, response.headers)
+
+        self.send_response(response.status)
+        self.send_header('Content-Type', response.content_type)
+        self.send_header('Content-Length', str(len(response.body)))
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+@contextmanager
+def trakt_client(trakt, token=None, username='mock', limit=False):
+    """Points the Trakt client at a :class:`MockTrakt` for the duration
+
+    :param token: OAuth response to activate, a new one is created if
+                  None and *username* is given
+    :param limit: Keep Mesh's client side rate limiting, otherwise it is
+                  disabled so the server's limits are exercised
+    """
+
+    base_url, limiters = Trakt.base_url, (api.read_limiter, api.write_limiter)
+    Trakt.base_url = trakt.url
+    if not limit:
+        api.read_limiter = api.write_limiter = RateLimiter(1e9, burst=10 ** 9)
+    Trakt.configuration.defaults.client(id='mock', secret='mock')
+    try:
+        if username is None:
+            yield trakt
+            return
+
+        if token is None:
+            token = trakt.authorize(username)
+        with Trakt.configuration.oauth.from_response(token, username=username):
+            yield trakt
+    finally:
+        Trakt.base_url = base_url
+        api.read_limiter, api.write_limiter = limiters
+
@@ -0,0 +1,366 @@
+"""Stand-in for the Trakt API endpoints used by Mesh"""
+
+from datetime import datetime, timedelta, timezone
+import json
+import math
+import threading
+import time
+import uuid
+
+from benchmarks import data
+from benchmarks.mocks.server import MockServer, Response, route
+from mesh.helpers import ISO8601_str_from_epoch, epoch_from_ISO8601_str
+
+#: Plural Trakt media types and their singular
+TYPES = {'movies': 'movie', 'shows': 'show', 'episodes': 'episode'}
+
+#: Page size of paginated endpoints when no limit is requested
+DEFAULT_LIMIT = 10
+
+
+class _State:
+    """Synchronized data of a single Trakt user"""
+
+    def __init__(self):
+        self.history = []
+        self.ratings = {}
+        self.watchlist = {}
+        self.activities = {}
+        self.next_id = 1
+
+    def touch(self, media, field, when):
+        """Records a change in the user's last activities"""
+        key = (f'{media}s', field)
+        self.activities[key] = max(self.activities.get(key, 0), when)
+
+
+class _Limit:
+    """Non-blocking token bucket per access token
+
+    :param rate: Allowed requests per second
+    :param burst: Requests allowed back to back
+    :param name: Name reported in the ``X-Ratelimit`` header
+    """
+
+    def __init__(self, rate, burst, name):
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self._buckets = {}
+
+    def take(self, key):
+        """Takes a token and returns the ``X-Ratelimit`` state
+
+        :return: Remaining requests and seconds until the next one is
+                 allowed, 0 if this request is allowed
+        """
+
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return math.floor(tokens - 1), 0
+        self._buckets[key] = (tokens, now)
+        return 0, (1 - tokens) / self.rate
+
+
+class MockTrakt(MockServer):
+    """Emulates Trakt's sync, search, season, scrobble and OAuth endpoints
+
+    Searches resolve the synthetic ids of :mod:`benchmarks.data`, items
+    with Trakt ids of *size* or more are reported as not found. Each
+    OAuth access token belongs to a user with their own history, ratings
+    and watchlist, see :meth:`authorize`.
+
+    Rate limits are applied per token on the sync and scrobble endpoints,
+    and reported through the ``X-Ratelimit`` and ``Retry-After`` headers
+    like Trakt does.
+
+    :param size: Number of movies and of episodes known to Trakt
+    :param history: Number of plays each user starts with
+    :param read_rate: Allowed GET requests per second and user
+    :param write_rate: Allowed other requests per second and user
+    :param burst: Requests allowed back to back
+    :param expires_in: Seconds before access tokens expire
+    """
+
+    def __init__(self, size=10000, history=0, read_rate=1000 / 300,
+                 write_rate=1, burst=10, expires_in=7776000, **kwargs):
+        super().__init__(**kwargs)
+        self.size = size
+        self.initial_history = history
+        self.expires_in = expires_in
+        self.rate_limited = 0
+
+        self._limits = {
+            'GET': _Limit(read_rate, burst, 'AUTHED_API_GET_LIMIT'),
+            'POST': _Limit(write_rate, burst, 'AUTHED_API_POST_LIMIT')
+        }
+        self._users = {}
+        self._tokens = {}
+        self._refresh_tokens = {}
+        self._state_lock = threading.RLock()
+
+    @property
+    def shows(self):
+        """Number of shows, their episodes add up to *size*"""
+        return -(-self.size // data.EPISODES_PER_SHOW)
+
+    def authorize(self, username):
+        """Returns a new OAuth token response for *username*
+
+        :rtype: :class:`~python:dict`
+        """
+
+        now = int(time.time())
+        token = {'access_token': uuid.uuid4().hex,
+                 'refresh_token': uuid.uuid4().hex,
+                 'token_type': 'bearer', 'scope': 'public',
+                 'created_at': now, 'expires_in': self.expires_in}
+        with self._state_lock:
+            self._tokens[token['access_token']] = (username,
+                                                   now + self.expires_in)
+            self._refresh_tokens[token['refresh_token']] = username
+            if username not in self._users:
+                self._users[username] = self._initial_state(now)
+        return token
+
+    def _initial_state(self, now):
+        state = _State()
+        for entry in data.history(self.initial_history):
+            entry['id'] = state.next_id
+            state.next_id += 1
+            state.history.append(entry)
+        if state.history:
+            state.touch('movie', 'watched_at', now)
+        return state
+
+    def state(self, username):
+        """Returns the data of a user"""
+        return self._users[username]
+
+    def before(self, request):
+        request.user = None
+        if not request.path.startswith(('/sync', '/scrobble')):
+            return None
+
+        auth = request.headers.get('Authorization', '')
+        username, expires = self._tokens.get(auth[len('Bearer '):], (None, 0))
+        if username is None or expires < time.time():
+            return Response({'error': 'invalid_grant'}, 401)
+        request.user = username
+
+        limit = self._limits['GET' if request.method == 'GET' else 'POST']
+        with self._state_lock:
+            remaining, wait = limit.take(auth)
+        until = datetime.now(timezone.utc) + timedelta(seconds=wait)
+        request.rate_limit = {
+            'X-Ratelimit': json.dumps({
+                'name': limit.name, 'period': 300,
+                'limit': round(limit.rate * 300),
+                'remaining': remaining,
+                'until': until.strftime('%Y-%m-%dT%H:%M:%SZ')})
+        }
+        if wait:
+            with self._lock:
+                self.rate_limited += 1
+            return Response({'error': 'Rate Limit Exceeded'}, 429, dict(
+                request.rate_limit, **{'Retry-After': str(math.ceil(wait))}))
+        return None
+
+    def _response(self, request, body, status=200, headers=None):
+        headers = dict(getattr(request, 'rate_limit', {}), **(headers or {}))
+        return Response(body, status, headers)
+
+    def _page(self, request, items):
+        """Returns a paginated response of *items*"""
+
+        page = int(request.query.get('page', 1))
+        limit = int(request.query.get('limit', DEFAULT_LIMIT))
+        count = max(1, math.ceil(len(items) / limit))
+        headers = {'X-Pagination-Page': str(page),
+                   'X-Pagination-Limit': str(limit),
+                   'X-Pagination-Page-Count': str(count),
+                   'X-Pagination-Item-Count': str(len(items))}
+        body = items[(page - 1) * limit:page * limit]
+        return self._response(request, body, headers=headers)
+
+    def _known(self, media, item):
+        trakt = item.get('ids', {}).get('trakt')
+        return media in ('movie', 'episode') and trakt is not None and \
+            0 <= trakt < self.size
+
+    @route('POST', '/oauth/token')
+    def token(self, request):
+        body = request.json or {}
+        with self._state_lock:
+            username = self._refresh_tokens.pop(body.get('refresh_token'),
+                                                None)
+        if body.get('grant_type') != 'refresh_token' or username is None:
+            return Response({'error': 'invalid_grant'}, 401)
+        return Response(self.authorize(username))
+
+    @route('GET', '/search/(?P<id_type>[a-z]+)/(?P<value>[^/]+)')
+    def search(self, request):
+        found = data.trakt_id(request.params['id_type'],
+                              request.params['value'])
+        media = request.query.get('type')
+        limit = self.shows if found and found[0] == 'show' else self.size
+        if found is None or found[1] >= limit or \
+                (media and found[0] not in media.split(',')):
+            return Response([])
+        return Response([data.trakt_entry(*found, score=1000)])
+
+    @route('GET', r'/shows/(?P<show>\d+)/seasons')
+    def seasons(self, request):
+        show = int(request.params['show'])
+        if show >= self.shows:
+            return Response({'error': 'Not found'}, 404)
+
+        season = {'number': 1, 'ids': {'trakt': show}}
+        if 'episodes' in request.query.get('extended', '').split(','):
+            first = show * data.EPISODES_PER_SHOW
+            last = min(self.size, first + data.EPISODES_PER_SHOW)
+            season['episodes'] = [data.trakt_entry('episode', i)['episode']
+                                  for i in range(first, last)]
+        return Response([season])
+
+    @route('GET', '/sync/last_activities')
+    def last_activities(self, request):
+        with self._state_lock:
+            state = self._users[request.user]
+            activities = {'all': ISO8601_str_from_epoch(
+                max(state.activities.values(), default=0))}
+            for media, fields in (('movies', ('watched_at', 'rated_at',
+                                               'watchlisted_at')),
+                                  ('episodes', ('watched_at', 'rated_at')),
+                                  ('shows', ('rated_at', 'watchlisted_at'))):
+                activities[media] = {
+                    f: ISO8601_str_from_epoch(
+                        state.activities.get((media, f), 0))
+                    for f in fields}
+        return self._response(request, activities)
+
+    @route('GET', '/sync/history(?:/(?P<media>movies|episodes))?')
+    def history(self, request):
+        media = TYPES.get(request.params['media'])
+        start = request.query.get('start_at')
+        start = epoch_from_ISO8601_str(start) if start else None
+        with self._state_lock:
+            items = [e for e in self._users[request.user].history
+                     if media in (None, e['type']) and (
+                         start is None or
+                         epoch_from_ISO8601_str(e['watched_at']) >= start)]
+        items.sort(key=lambda e: e['watched_at'], reverse=True)
+        return self._page(request, items)
+
+    @route('POST', '/sync/history')
+    def add_history(self, request):
+        now = int(time.time())
+        added, not_found = {}, {}
+        with self._state_lock:
+            state = self._users[request.user]
+            for plural, items in (request.json or {}).items():
+                media = TYPES.get(plural)
+                for item in items:
+                    if not self._known(media, item):
+                        not_found.setdefault(plural, []).append(item)
+                        continue
+
+                    watched_at = item.get('watched_at') or \
+                        ISO8601_str_from_epoch(now)
+                    state.history.append(data.trakt_entry(
+                        media, item['ids']['trakt'], id=state.next_id,
+                        watched_at=watched_at))
+                    state.next_id += 1
+                    state.touch(media, 'watched_at', now)
+                    added[plural] = added.get(plural, 0) + 1
+        return self._response(request, {'added': added,
+                                        'not_found': not_found}, 201)
+
+    @route('POST', '/sync/history/remove')
+    def remove_history(self, request):
+        now = int(time.time())
+        with self._state_lock:
+            state = self._users[request.user]
+            removed = {(TYPES.get(p), i['ids']['trakt'])
+                       for p, items in (request.json or {}).items()
+                       for i in items}
+            before = len(state.history)
+            state.history = [
+                e for e in state.history
+                if (e['type'], e[e['type']]['ids']['trakt']) not in removed]
+            for media, _ in removed:
+                state.touch(media, 'watched_at', now)
+        return self._response(request, {'deleted': {
+            'movies': before - len(state.history)}, 'not_found': {}})
+
+    @route('GET', '/sync/ratings(?:/(?P<media>movies|shows|episodes))?')
+    def ratings(self, request):
+        media = TYPES.get(request.params['media'])
+        with self._state_lock:
+            items = [data.trakt_entry(
+                        m, trakt, rating=rating,
+                        rated_at=ISO8601_str_from_epoch(rated_at))
+                     for (m, trakt), (rating, rated_at)
+                     in self._users[request.user].ratings.items()
+                     if media in (None, m)]
+        return self._page(request, items)
+
+    @route('POST', '/sync/ratings(?P<remove>/remove)?')
+    def rate(self, request):
+        now = int(time.time())
+        changed, not_found = {}, {}
+        with self._state_lock:
+            state = self._users[request.user]
+            for plural, items in (request.json or {}).items():
+                media = TYPES.get(plural)
+                for item in items:
+                    key = (media, item.get('ids', {}).get('trakt'))
+                    if not self._known(media, item) and media != 'show':
+                        not_found.setdefault(plural, []).append(item)
+                        continue
+
+                    if request.params['remove']:
+                        state.ratings.pop(key, None)
+                    else:
+                        state.ratings[key] = (item['rating'], now)
+                    state.touch(media, 'rated_at', now)
+                    changed[plural] = changed.get(plural, 0) + 1
+        field = 'deleted' if request.params['remove'] else 'added'
+        return self._response(request, {field: changed,
+                                        'not_found': not_found}, 201)
+
+    @route('GET', '/sync/watchlist(?:/(?P<media>movies|shows))?')
+    def watchlist(self, request):
+        media = TYPES.get(request.params['media'])
+        with self._state_lock:
+            items = [data.trakt_entry(m, trakt,
+                                      listed_at=ISO8601_str_from_epoch(at))
+                     for (m, trakt), at
+                     in self._users[request.user].watchlist.items()
+                     if media in (None, m)]
+        return self._page(request, items)
+
+    @route('POST', '/scrobble/(?P<action>start|pause|stop)')
+    def scrobble(self, request):
+        body = request.json or {}
+        media = 'movie' if 'movie' in body else 'episode'
+        if not self._known(media, body.get(media, {})):
+            return self._response(request, {'error': 'Not found'}, 404)
+
+        action = request.params['action']
+        if action == 'stop' and body.get('progress', 0) >= 80:
+            now = int(time.time())
+            with self._state_lock:
+                state = self._users[request.user]
+                state.history.append(data.trakt_entry(
+                    media, body[media]['ids']['trakt'], id=state.next_id,
+                    watched_at=ISO8601_str_from_epoch(now)))
+                state.next_id += 1
+                state.touch(media, 'watched_at', now)
+            action = 'scrobble'
+        return self._response(request, {
+            'id': 0, 'action': action, 'progress': body.get('progress', 0),
+            media: body[media]}, 201)
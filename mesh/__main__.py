@@ -5,15 +5,29 @@ import json
 import logging
 import os
 import sys
+import time
 
 from trakt import Trakt
 
-from mesh.configuration import get_config
-from mesh.constants import USER_MAPPING_FILE, DATA_DIR
+from mesh import api, metrics
+from mesh.cache import get_cache
+from mesh.configuration import get_config, server_section
+from mesh.constants import USER_MAPPING_FILE, USER_STORE_FILE, DATA_DIR
+from mesh.events import EVENTS, Scheduler
+from mesh.exceptions import SynchronizationError
 from mesh.interactive import first_run_setup, add_user
-from mesh.user import UserManager
+from mesh.matching import get_index
+from mesh.plex import connect
+from mesh.scrobble import Scrobbler
+from mesh.servers import ServerPools
+from mesh.sessions import configure as configure_sessions
+from mesh.synchronize import plan
+from mesh.tokens import get_tokens
+from mesh.user import UserStore
 from mesh.version import __version__
 
+logger = logging.getLogger(__name__)
+
 
 def init_args():
     """Initialize the CLI argument parser"""
@@ -31,6 +45,24 @@ def init_args():
     mode.add_argument('--push', action='store_true', help='Push to Trakt')
     mode.add_argument('--sync', action='store_true', help='Two-way sync')
     mode.add_argument('--add_user', action='store_true', help='Add a new user')
+    mode.add_argument('--scrobble', action='store_true',
+                      help='Scrobble plays to Trakt as they happen')
+    mode.add_argument('--plan', action='store_true',
+                      help='Print the cost of syncing each user as JSON, '
+                           'without writing')
+
+    parser.add_argument(
+            '--daemon', action='store_true', default=None,
+            help='Keep running the selected mode for all users')
+    parser.add_argument(
+            '--interval', type=int,
+            help='Default seconds between runs for each user in daemon mode')
+    parser.add_argument(
+            '--workers', type=int,
+            help='Maximum number of users processed concurrently')
+    parser.add_argument(
+            '--metrics_port', type=int,
+            help='Serve Prometheus metrics on this local port')
     return parser.parse_args()
 
 
@@ -50,6 +82,14 @@ def init_plex():
     plexapi.BASE_HEADERS['X-Plex-Client-Identifier'] = config.mesh.identifier
 
 
+def init_sessions(workers):
+    """Size the shared HTTP connection pools to the number of workers"""
+
+    settings = get_config().sessions._asdict()
+    settings['pool_size'] = max(settings['pool_size'], workers + 1)
+    configure_sessions(**settings)
+
+
 def init_trakt():
     """Set id and secrect for trakt"""
 
@@ -76,11 +116,27 @@ def main():
     init_logging(args.log_level)
     init_plex()
 
+    workers = args.workers
+    scheduling = get_config().scheduler
+    for option in ('daemon', 'interval', 'workers'):
+        if getattr(args, option) is None:
+            setattr(args, option, getattr(scheduling, option))
+    init_sessions(args.workers)
+
     config = get_config()
+    metrics_port = args.metrics_port
+    if metrics_port is None:
+        metrics_port = config.metrics.port
+    if metrics_port:
+        metrics.serve(metrics_port, config.metrics.host)
+
     if config.is_new:
-        identifier, token = first_run_setup()
+        (_, identifier, token), *others = first_run_setup()
         config.set('plex', 'identifier',  identifier)
         config.set('plex', 'token',  token)
+        for name, identifier, token in others:
+            config.set(server_section(name), 'identifier', identifier)
+            config.set(server_section(name), 'token', token)
         config.save()
 
     has_trakt_oauth = init_trakt()
@@ -90,13 +146,95 @@ def main():
         quit()
 
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    user_manager = UserManager(USER_MAPPING_FILE)
+    api.response_cache = get_cache(max_size=config.cache.max_size)
+    user_manager = UserStore(USER_STORE_FILE)
+    if not len(user_manager) and USER_MAPPING_FILE.exists():
+        user_manager.import_json(USER_MAPPING_FILE)
+    tokens = get_tokens(user_manager,
+                        renew_before=config.tokens.renew_before,
+                        interval=config.tokens.check_interval)
 
     if args.add_user:
         new_user = add_user()
         if new_user is not None:
             user_manager.add(new_user)
-            user_manager.save()
+
+    if args.scrobble:
+        scrobblers = []
+        for plex in config.servers():
+            connection = connect(plex.identifier, plex.token)
+            if connection is None:
+                print(f'Unable to connect to the Plex server "{plex.name}"')
+                quit(1)
+            scrobblers.append(
+                Scrobbler(connection.server, user_manager.users, get_index()))
+
+        for scrobbler in scrobblers:
+            scrobbler.start()
+        tokens.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for scrobbler in scrobblers:
+                scrobbler.stop()
+            tokens.stop()
+
+    if args.plan:
+        servers = ServerPools(config.servers(), workers=args.workers)
+        plans = []
+        for user in user_manager.users:
+            try:
+                plans.append(plan(user, servers,
+                                  config.sync.batch_size).as_dict())
+            except SynchronizationError as e:
+                logger.error(f'Unable to plan the sync of "{user.name}": {e}')
+        servers.shutdown()
+        print(json.dumps({
+            'users': plans,
+            'seconds': round(sum(p['seconds'] for p in plans), 1),
+            'memory': max((p['memory'] for p in plans), default=0)
+        }, indent=2))
+
+    mode = next((m for m in EVENTS if getattr(args, m)), None)
+    if mode is not None:
+        servers = ServerPools(config.servers(), workers=args.workers)
+        scheduler = Scheduler(
+            servers, workers=args.workers,
+            jitter=config.scheduler.jitter,
+            on_complete=lambda event: user_manager.update(event.user),
+            batch_size=config.sync.batch_size)
+        interval = args.interval if args.daemon else 0
+        scheduler.schedule_users(user_manager.users, mode, interval)
+
+        if args.daemon:
+            def retune(config):
+                """Applies reloaded tuning options, unless set on the CLI"""
+
+                scheduler_workers = workers or config.scheduler.workers
+                init_sessions(scheduler_workers)
+                servers.configure(scheduler_workers)
+                scheduler.configure(workers=scheduler_workers,
+                                    jitter=config.scheduler.jitter,
+                                    batch_size=config.sync.batch_size)
+                tokens.renew_before = config.tokens.renew_before
+                tokens.interval = config.tokens.check_interval
+
+            config.add_listener(retune)
+            config.watch()
+            tokens.start()
+
+        try:
+            scheduler.run(until_idle=not args.daemon)
+        except KeyboardInterrupt:
+            scheduler.stop()
+        config.unwatch()
+        tokens.stop()
+        servers.shutdown()
+
+    for line in metrics.summary():
+        logger.info(line)
+    user_manager.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+"""This module contains the request helpers used for all Trakt calls
+
+Every request passes through a :class:`mesh.helpers.RateLimiter`, keyed
+by the Trakt username of the active OAuth configuration, so concurrent
+workers stay within Trakt's rate limits, and is recorded in
+:mod:`mesh.metrics`. GET requests of cacheable endpoints are answered or
+revalidated by the :data:`response_cache`, see :mod:`mesh.cache`.
+"""
+
+from datetime import datetime, timezone
+import json
+import logging
+import time
+
+from trakt import Trakt
+
+from mesh import metrics
+from mesh.exceptions import RateLimitExceeded, SynchronizationError
+from mesh.helpers import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+#: Number of items requested per page from paginated Trakt endpoints
+PAGE_SIZE = 1000
+
+#: Seconds to wait after a rate limited request without ``Retry-After``
+DEFAULT_RETRY_AFTER = 10
+
+#: Limits GET requests (Trakt allows 1000 per 5 minutes)
+read_limiter = RateLimiter(1000 / 300, burst=10)
+
+#: Limits POST, PUT and DELETE requests (Trakt allows 1 per second)
+write_limiter = RateLimiter(1)
+
+#: Cache of GET responses, see :func:`mesh.cache.get_cache`.
+#: Responses are not cached while None.
+response_cache = None
+
+
+def request(method, path, query=None, data=None, authenticated=True):
+    """Performs a request against Trakt
+
+    Authenticated requests must be made within an OAuth configuration
+    context, e.g. ``Trakt.configuration.oauth.from_response(...)``.
+
+    :param method: HTTP method
+    :param path: Path relative to the Trakt API url
+    :param query: Query parameters
+    :param data: Request body
+    :param authenticated: Whether or not the request requires OAuth
+    :return: The successful response
+    :rtype: :class:`~requests.Response`
+    :raises: :class:`mesh.exceptions.RateLimitExceeded` if Trakt rejects
+             the request due to rate limiting,
+             :class:`mesh.exceptions.SynchronizationError` on other failures
+    """
+
+    username = Trakt.configuration['oauth.username']
+    lookup = None
+    if response_cache is not None:
+        lookup = response_cache.lookup(method, path, query, username)
+        if lookup is not None and lookup.fresh:
+            metrics.registry.inc('mesh_cache_requests_total', result='hit')
+            return lookup.response()
+
+    key = username if authenticated else None
+    waited = limiter(method).acquire(key)
+    if waited:
+        metrics.registry.inc('mesh_rate_limit_wait_seconds_total', waited,
+                             limiter=_kind(method))
+
+    start = time.perf_counter()
+    response = Trakt.http.request(method, path, query=query, data=data,
+                                  authenticated=authenticated,
+                                  headers=lookup.validators if lookup else None)
+    metrics.record_request('trakt', method, f'/{path}',
+                           getattr(response, 'status_code', None),
+                           time.perf_counter() - start)
+    if lookup is not None:
+        response = response_cache.complete(lookup, response)
+    return check_response(method, path, response, key)
+
+
+def limiter(method):
+    """Returns the rate limiter of requests with *method*"""
+    return read_limiter if method == 'GET' else write_limiter
+
+
+def _kind(method):
+    return 'read' if method == 'GET' else 'write'
+
+
+def check_response(method, path, response, key=None):
+    """Applies Trakt's rate limit headers and checks the response status
+
+    :param method: HTTP method of the request
+    :param path: Path of the request, used in error messages
+    :param response: The response, or None if the request failed
+    :param key: Rate limiter key of the request
+    :return: The successful response
+    :raises: See :func:`request`
+    """
+
+    if response is not None:
+        wait = rate_limit_wait(response.headers)
+        if response.status_code == 429:
+            wait = wait or DEFAULT_RETRY_AFTER
+        if wait:
+            logger.info(f'Rate limit reached, pausing for {wait:.1f}s')
+            limiter(method).pause(key, wait)
+        if response.status_code == 429:
+            metrics.registry.inc('mesh_rate_limited_total',
+                                 limiter=_kind(method))
+            raise RateLimitExceeded(f'Request to "{path}" was rate limited',
+                                    wait)
+
+    if response is None or not 200 <= response.status_code < 300:
+        status = getattr(response, 'status_code', None)
+        raise SynchronizationError(f'Request to "{path}" failed ({status})')
+    return response
+
+
+def rate_limit_wait(headers):
+    """Returns the seconds to wait according to Trakt's rate limit headers
+
+    ``Retry-After`` is sent with rejected requests, while ``X-Ratelimit``
+    describes the remaining requests of the current period.
+
+    :param headers: Response headers
+    :rtype: :class:`~python:float`
+    """
+
+    if 'Retry-After' in headers:
+        return float(headers['Retry-After'])
+
+    try:
+        ratelimit = json.loads(headers.get('X-Ratelimit', '{}'))
+    except ValueError:
+        return 0
+    if ratelimit.get('remaining', 1) > 0 or not ratelimit.get('until'):
+        return 0
+
+    until = datetime.fromisoformat(ratelimit['until'].replace('Z', '+00:00'))
+    return max(0, (until - datetime.now(timezone.utc)).total_seconds())
+
+
+def get(path, query=None, authenticated=True):
+    """Performs a GET request against Trakt, see :func:`request`"""
+    return request('GET', path, query=query, authenticated=authenticated)
+
+
+def post(path, data, authenticated=True):
+    """Performs a POST request against Trakt, see :func:`request`"""
+    return request('POST', path, data=data, authenticated=authenticated)
+
+
+def fetch(path, query=None):
+    """Yields all items from a paginated Trakt endpoint"""
+
+    page, page_count = 1, 1
+    while page <= page_count:
+        response = get(path, dict(query or {}, page=page, limit=PAGE_SIZE))
+        page_count = int(response.headers.get('X-Pagination-Page-Count', 1))
+        yield from response.json()
+        page += 1
@@ -0,0 +1,267 @@
+"""This module contains the on-disk cache of Trakt responses
+
+GET responses of the endpoints in :data:`POLICIES` are stored with an
+expiry time. Fresh responses are served without a request, expired ones
+are revalidated with ``If-None-Match`` and ``If-Modified-Since`` so that
+unchanged data costs a 304 rather than a full payload. Responses of
+shared endpoints, e.g. searches, are reused across users.
+
+The cache is bounded in size, the least recently used responses are
+evicted first.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from mesh import metrics
+from mesh.constants import CACHE_MAX_SIZE, RESPONSE_CACHE_FILE
+
+logger = logging.getLogger(__name__)
+
+#: Default maximum size in bytes of the cached bodies
+MAX_SIZE = CACHE_MAX_SIZE
+
+#: Cached endpoints, matching the path relative to the API url
+CachePolicy = namedtuple('CachePolicy', ['pattern', 'ttl', 'shared'])
+
+#: Policies of the cached endpoints, the first matching policy applies.
+#: Shared responses are the same for all users.
+POLICIES = (
+    CachePolicy(re.compile(r'search/'), 7 * 24 * 60 * 60, True),
+    CachePolicy(re.compile(r'(movies|shows)/[^/]+(/seasons(/[^/]+)?)?$'),
+                24 * 60 * 60, True),
+    CachePolicy(re.compile(r'users/[^/]+/lists(/.*)?$'), 60 * 60, False)
+)
+
+#: Headers which are not stored, they only apply to the original response
+_TRANSIENT = {'retry-after', 'x-ratelimit', 'date', 'connection',
+              'set-cookie', 'transfer-encoding', 'content-encoding',
+              'content-length'}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+'''
+
+
+def policy(method, path):
+    """Returns the :class:`CachePolicy` of a request or None"""
+
+    if method != 'GET':
+        return None
+    return next((p for p in POLICIES if p.pattern.match(path)), None)
+
+
+class Lookup:
+    """A cacheable request, see :meth:`ResponseCache.lookup`
+
+    :param key: Cache key of the request
+    :param policy: The policy of the endpoint
+    :param headers: Headers of the cached response, None if not cached
+    :param body: Body of the cached response
+    :param expires_at: Time the cached response expires
+    """
+
+    def __init__(self, key, policy, headers=None, body=None, expires_at=0):
+        self.key = key
+        self.policy = policy
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        """Whether the cached response can be used without a request"""
+        return self.headers is not None and time.time() < self.expires_at
+
+    @property
+    def validators(self):
+        """Conditional request headers revalidating the cached response"""
+
+        if self.headers is None:
+            return {}
+        validators = {}
+        if 'ETag' in self.headers:
+            validators['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def response(self):
+        """Returns the cached response as a :class:`~requests.Response`"""
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.body
+        response.encoding = 'utf-8'
+        return response
+
+
+class ResponseCache:
+    """Size-bounded, persistent cache of Trakt responses
+
+    Thread safe. Use :func:`get_cache` to access the cache shared by all
+    users.
+
+    :param path: Full path to the database file
+    :param max_size: Maximum size in bytes of the cached bodies
+    :type path: :class:`~python:pathlib:Path`
+    :type max_size: :class:`~python:int`
+    """
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(_SCHEMA)
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses'
+        ).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    @property
+    def size(self):
+        """Total size in bytes of the cached bodies"""
+        return self._size
+
+    def lookup(self, method, path, query=None, username=None):
+        """Returns the cache state of a request, None if not cacheable
+
+        :param method: HTTP method
+        :param path: Path relative to the Trakt API url
+        :param query: Query parameters
+        :param username: The user making the request, responses of
+                         personal endpoints are cached per user
+        :rtype: :class:`Lookup`
+        """
+
+        endpoint = policy(method, path)
+        if endpoint is None or (not endpoint.shared and username is None):
+            return None
+
+        owner = '*' if endpoint.shared else username
+        query = urlencode(sorted((query or {}).items()))
+        key = f'{owner} {path}?{query}'
+        with self._lock:
+            row = self._db.execute(
+                'SELECT headers, body, expires_at FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return Lookup(key, endpoint)
+            with self._db:
+                self._db.execute('UPDATE responses SET accessed_at = ? '
+                                 'WHERE key = ?', (time.time(), key))
+        return Lookup(key, endpoint, json.loads(row[0]), row[1], row[2])
+
+    def complete(self, lookup, response):
+        """Updates the cache with the response to a looked up request
+
+        A 304 response is replaced by the cached response, whose expiry
+        is renewed. Other successful responses are stored.
+
+        :param lookup: The lookup of the request
+        :param response: The response, or None if the request failed
+        :type lookup: :class:`Lookup`
+        :return: The response to use
+        """
+
+        status = getattr(response, 'status_code', None)
+        if status == 304 and lookup.headers is not None:
+            lookup.expires_at = time.time() + lookup.policy.ttl
+            with self._lock, self._db:
+                self._db.execute('UPDATE responses SET expires_at = ? '
+                                 'WHERE key = ?',
+                                 (lookup.expires_at, lookup.key))
+            metrics.registry.inc('mesh_cache_requests_total',
+                                 result='revalidated')
+            return lookup.response()
+
+        metrics.registry.inc('mesh_cache_requests_total', result='miss')
+        if status == 200:
+            headers = {k: v for k, v in response.headers.items()
+                       if k.lower() not in _TRANSIENT}
+            self.store(lookup.key, headers, response.content,
+                       lookup.policy.ttl)
+        return response
+
+    def store(self, key, headers, body, ttl):
+        """Stores a response and evicts the least recently used ones
+
+        :param key: Cache key, see :meth:`lookup`
+        :param headers: Response headers
+        :param body: Response body
+        :param ttl: Seconds the response is fresh
+        """
+
+        if len(body) > self.max_size:
+            return
+
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute('SELECT LENGTH(body) FROM responses '
+                                   'WHERE key = ?', (key,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(dict(headers)), body, now + ttl, now))
+            self._size += len(body) - (old[0] if old else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used responses to fit the limit"""
+
+        rows = self._db.execute('SELECT key, LENGTH(body) FROM responses '
+                                'ORDER BY accessed_at')
+        evicted = []
+        for key, size in rows:
+            if self._size <= self.max_size:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        logger.debug(f'Evicted {len(evicted)} cached responses')
+
+    def clear(self):
+        """Removes all cached responses"""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+            self._size = 0
+
+    def close(self):
+        """Closes the underlying database"""
+        self._db.close()
+
+
+def get_cache(path=None, max_size=MAX_SIZE):
+    global _cache
+
+    if path is None:
+        path = RESPONSE_CACHE_FILE
+
+    if _cache is None:
+        _cache = ResponseCache(path, max_size)
+    return _cache
+
+
+#: Instantiated :class:`ResponseCache` object shared by all users.
+_cache = None
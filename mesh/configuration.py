@@ -2,13 +2,29 @@ from collections import namedtuple
 import configparser
 import logging
 import os
+import re
+import threading
 import uuid
 
-from mesh.constants import CONFIG_FILE
+from mesh.constants import (CACHE_MAX_SIZE, CONFIG_FILE, SESSION_BACKOFF,
+                            SESSION_POOL_HOSTS, SESSION_POOL_SIZE,
+                            SESSION_RETRIES, SESSION_TIMEOUT,
+                            SYNC_BATCH_SIZE, TOKEN_CHECK_INTERVAL,
+                            TOKEN_RENEW_BEFORE)
 from mesh.exceptions import InvalidConfiguration
+from mesh.servers import Server
 
 logger = logging.getLogger(__name__)
 
+#: Prefix of environment variables overriding configuration options
+ENV_PREFIX = 'MESH_'
+
+#: Seconds between checks for changes of a watched configuration file
+WATCH_INTERVAL = 5
+
+#: Prefix of the sections of additional Plex servers, e.g. ``[plex:den]``
+SERVER_PREFIX = 'plex:'
+
 
 class Configuration:
     """Application configuration data class
@@ -19,6 +35,11 @@ class Configuration:
     Each configuration section is available as an instance attribute
     which returns a :class:`~python:namedtuple` containing the options.
 
+    Section views are built once and cached until the section changes
+    through :meth:`set` or :meth:`reload`. Options of the tuning sections
+    in :data:`TUNING` are optional and converted to their declared type,
+    all other options are strings.
+
     :example:
     >>> config = Configuration(path_to_config)
     >>> config.plex.identifier
@@ -41,6 +62,13 @@ class Configuration:
 
         self._config_parser = configparser.ConfigParser()
 
+        #: Cached section views, see :meth:`_view`
+        self._views = {}
+
+        self._mtime = None
+        self._listeners = []
+        self._watcher = None
+
         if not os.path.exists(path):
             logger.warning('Configuration file does not exist. '
                            'Generating new...')
@@ -48,12 +76,83 @@ class Configuration:
         else:
             self._load()
 
-    def __getattribute__(self, attr):
-        parser = object.__getattribute__(self, '_config_parser')
-        if parser.has_section(attr):
-            ops, vals = zip(*parser.items(attr))
-            return namedtuple(attr, ops)(*vals)
-        return object.__getattribute__(self, attr)
+    def __getattr__(self, attr):
+        # Only called when regular attribute lookup fails, validation
+        # makes sure sections never overshadow regular attributes
+        views = self.__dict__.get('_views')
+        if views is None:
+            raise AttributeError(attr)
+        if attr in views:
+            return views[attr]
+
+        view = self._view(attr)
+        if view is None:
+            raise AttributeError(
+                f'{type(self).__name__!r} object has no attribute {attr!r}')
+        views[attr] = view
+        return view
+
+    def _view(self, section, parser=None):
+        """Returns a new immutable view of *section* or None
+
+        Environment variables named ``MESH_<SECTION>_<OPTION>`` override
+        the options of the file, e.g. ``MESH_SYNC_BATCH_SIZE``.
+
+        :raises: :class:`mesh.exceptions.InvalidConfiguration` if a tuning
+                 option can not be converted to its type
+        """
+
+        if parser is None:
+            parser = self._config_parser
+
+        types = TUNING.get(section, {})
+        if not types and not parser.has_section(section):
+            return None
+
+        options = {o: d for o, (_, d) in types.items()}
+        if parser.has_section(section):
+            options.update(parser.items(section))
+
+        for option in options:
+            env = f'{ENV_PREFIX}{section}_{option}'.upper()
+            if env in os.environ:
+                options[option] = os.environ[env]
+
+        for option, (convert, _) in types.items():
+            try:
+                options[option] = convert(options[option])
+            except ValueError as e:
+                raise InvalidConfiguration(
+                    f'Invalid value for "[{section}] {option}": {e}') from e
+        return namedtuple(section, options)(**options)
+
+    def servers(self):
+        """Returns the Plex servers to synchronize
+
+        The server of the ``[plex]`` section comes first, followed by the
+        servers of the ``[plex:<name>]`` sections, which hold the same
+        options. The optional ``workers`` option of each server limits
+        the number of users synchronized with it concurrently.
+
+        :rtype: :class:`~python:list` [ :class:`mesh.servers.Server` ]
+        :raises: :class:`mesh.exceptions.InvalidConfiguration` if the
+                 workers of a server are not a number
+        """
+
+        parser = self._config_parser
+        sections = ['plex'] + [s for s in parser.sections()
+                               if s.startswith(SERVER_PREFIX)]
+        servers = []
+        for section in sections:
+            name = section[len(SERVER_PREFIX):] or section
+            try:
+                workers = parser.getint(section, 'workers', fallback=0)
+            except ValueError as e:
+                raise InvalidConfiguration(
+                    f'Invalid value for "[{section}] workers": {e}') from e
+            servers.append(Server(name, parser.get(section, 'identifier'),
+                                  parser.get(section, 'token'), workers))
+        return servers
 
     def _generate(self):
         """Generates a new configuration file"""
@@ -64,45 +163,132 @@ class Configuration:
     def _load(self):
         """Loads the configuration file
 
+        The file is parsed and validated completely before the current
+        settings are replaced, so readers on other threads see either
+        the old or the new configuration.
+
         :raises: :class:`mesh.exceptions.InvalidConfiguration`
                  if duplicate configuration keys are encountered
                  or if the configurations is missing a required key.
                  Will also be raised if validation fails.
         """
 
+        parser = configparser.ConfigParser()
         try:
-            self._config_parser.read(self._path)
-        except configparser.ParsingError as e:
+            mtime = os.stat(self._path).st_mtime
+            parser.read(self._path)
+        except (OSError, configparser.Error) as e:
             logger.exception(f'Failed to parse "{self._path}"', exc_info=e)
             raise InvalidConfiguration('Unable to parse file') from e
 
-        status = self._validate()
+        status = self._validate(parser)
         if not status.success:
             raise InvalidConfiguration(status.msg)
 
-    def _validate(self):
-        """Validates the current configuration"""
+        views = {s: self._view(s, parser) for s in TUNING}
+        self._config_parser, self._views = parser, views
+        self._mtime = mtime
+
+    def reload(self):
+        """Reloads the configuration file and drops all cached views
+
+        Listeners added through :meth:`add_listener` are called after a
+        successful reload.
+
+        :raises: :class:`mesh.exceptions.InvalidConfiguration`, see
+                 :meth:`_load`. The previous configuration is kept.
+        """
+
+        self._load()
+        logger.info(f'Reloaded configuration from "{self._path}"')
+        for listener in list(self._listeners):
+            try:
+                listener(self)
+            except Exception:
+                logger.exception('Configuration listener failed')
+
+    def add_listener(self, listener):
+        """Calls *listener* with the configuration after each reload"""
+        self._listeners.append(listener)
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Reloads the configuration whenever its file changes
+
+        The modification time of the file is polled on a daemon thread
+        every *interval* seconds. Invalid changes are logged and ignored
+        until the file is fixed.
+
+        :param interval: Seconds between checks
+        :type interval: :class:`~python:float`
+        """
+
+        if self._watcher is not None:
+            return
+
+        stopped = threading.Event()
+
+        def poll():
+            while not stopped.wait(interval):
+                try:
+                    mtime = os.stat(self._path).st_mtime
+                except OSError:
+                    continue
+                if mtime == self._mtime:
+                    continue
+
+                try:
+                    self.reload()
+                except InvalidConfiguration as e:
+                    logger.warning(f'Configuration not reloaded: {e}')
+                    self._mtime = mtime
+
+        self._watcher = (threading.Thread(target=poll, daemon=True), stopped)
+        self._watcher[0].start()
+
+    def unwatch(self):
+        """Stops watching the configuration file"""
+
+        if self._watcher is not None:
+            thread, stopped = self._watcher
+            stopped.set()
+            thread.join()
+            self._watcher = None
+
+    def _validate(self, config_parser=None):
+        """Validates the current configuration, or that of *config_parser*"""
+
+        if config_parser is None:
+            config_parser = self._config_parser
+
         parser = configparser.ConfigParser()
         parser.read_dict(_TEMPLATE)
 
         status = namedtuple('Validation', ['success', 'msg'])
 
-        # Check is required since namedtuple is used in __getattribute__
+        # Check is required since sections are viewed as namedtuples
         # (namedtuple does not allow attributes starting with _)
-        for s in self._config_parser.sections():
-            if any([o.startswith('_') for o in self._config_parser.options(s)]):
+        for s in config_parser.sections():
+            if any([o.startswith('_') for o in config_parser.options(s)]):
                 return status(False, f'Options starting with _ are not allowed')
 
         # Assert that no internal attribute/method is overshadowed
-        if any([s in self.__dir__() for s in self._config_parser.sections()]):
+        if any([s in self.__dir__() for s in config_parser.sections()]):
             return status(False, f'Forbidden section name')
 
         # Check that all required sections and options are available
         for s in parser.sections():
-            if not self._config_parser.has_section(s):
+            if not config_parser.has_section(s):
                 return status(False, f'Missing section "[{s}]"')
             for o in parser.options(s):
-                if not self._config_parser.has_option(s, o):
+                if not config_parser.has_option(s, o):
+                    return status(False, f'Missing option "[{s}] {o}"')
+
+        # Additional servers require the options of the primary server
+        for s in config_parser.sections():
+            if not s.startswith(SERVER_PREFIX):
+                continue
+            for o in parser.options('plex'):
+                if not config_parser.has_option(s, o):
                     return status(False, f'Missing option "[{s}] {o}"')
         return status(True, '')
 
@@ -115,24 +301,107 @@ class Configuration:
         :type section: :class:`~python:str`
         :type option: :class:`~python:str`
         :type value: :class:`~python:str`
-        :raises: :class:`~python:ValueError` if the option name starts with _
-                 or if the section does not exist
+        :raises: :class:`~python:ValueError` if the option name starts with _,
+                 if the section does not exist or if the value is invalid
+                 for a tuning option or the workers of a server
         """
 
         if option.startswith('_'):
             raise ValueError('Options starting with "_" are not allowed')
 
+        convert = TUNING.get(section, {}).get(option, (None,))[0]
+        if convert is None and option == 'workers' and \
+                (section == 'plex' or section.startswith(SERVER_PREFIX)):
+            convert = int
+        if convert is not None:
+            try:
+                convert(value)
+            except ValueError as e:
+                raise ValueError(
+                    f'Invalid value for "[{section}] {option}": {e}') from e
+
+        optional = section in TUNING or section.startswith(SERVER_PREFIX)
+        if optional and not self._config_parser.has_section(section):
+            self._config_parser.add_section(section)
+
         try:
             self._config_parser.set(section, option, value)
         except configparser.NoSectionError as e:
             logger.exception(e)
             raise ValueError(f'"section" must be an existing section') from e
+        self._views.pop(section, None)
 
     def save(self):
         """Saves the configuration to file"""
         with open(self._path, 'w') as f:
             self._config_parser.write(f)
+        self._mtime = os.stat(self._path).st_mtime
+
+
+def duration(value):
+    """Returns the seconds of a duration such as ``90``, ``15m`` or ``1h30m``
 
+    :raises: :class:`~python:ValueError` if *value* is not a duration
+    """
+
+    if isinstance(value, (int, float)):
+        return value
+
+    value = value.strip().lower()
+    if value.isdigit():
+        return int(value)
+
+    match = _DURATION.fullmatch(value)
+    if not value or match is None:
+        raise ValueError(f'"{value}" is not a duration')
+    return sum(int(n or 0) * unit for n, unit in
+               zip(match.groups(), (86400, 3600, 60, 1)))
+
+
+def boolean(value):
+    """Returns the :class:`~python:bool` of a configparser boolean string"""
+
+    if isinstance(value, bool):
+        return value
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError(f'"{value}" is not a boolean') from None
+
+
+_DURATION = re.compile(r'(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?')
+
+#: Optional performance tuning sections. Each option maps to its type
+#: and default value, options missing from the file use the default.
+TUNING = {
+    'sessions': {
+        'pool_size': (int, SESSION_POOL_SIZE),
+        'pool_hosts': (int, SESSION_POOL_HOSTS),
+        'timeout': (float, SESSION_TIMEOUT),
+        'retries': (int, SESSION_RETRIES),
+        'backoff': (float, SESSION_BACKOFF)
+    },
+    'scheduler': {
+        'workers': (int, 4),
+        'interval': (duration, 3600),
+        'jitter': (float, 0.1),
+        'daemon': (boolean, False)
+    },
+    'sync': {
+        'batch_size': (int, SYNC_BATCH_SIZE)
+    },
+    'metrics': {
+        'port': (int, 0),
+        'host': (str, '127.0.0.1')
+    },
+    'cache': {
+        'max_size': (int, CACHE_MAX_SIZE)
+    },
+    'tokens': {
+        'renew_before': (duration, TOKEN_RENEW_BEFORE),
+        'check_interval': (duration, TOKEN_CHECK_INTERVAL)
+    }
+}
 
 _TEMPLATE = {
     'mesh': {'identifier': str(uuid.uuid4())},
@@ -143,6 +412,17 @@ _TEMPLATE = {
 }
 
 
+def server_section(name):
+    """Returns the configuration section of an additional Plex server
+
+    :param name: The server's name, e.g. ``Living Room``
+    :rtype: :class:`~python:str`
+    """
+
+    slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+    return f'{SERVER_PREFIX}{slug or "server"}'
+
+
 def get_config(path=None):
     global _config
 
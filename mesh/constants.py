@@ -4,4 +4,20 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR.joinpath('data')
 
 USER_MAPPING_FILE = DATA_DIR.joinpath('usermapping')
+USER_STORE_FILE = DATA_DIR.joinpath('users.db')
+ID_INDEX_FILE = DATA_DIR.joinpath('idindex.db')
+JOURNAL_FILE = DATA_DIR.joinpath('journal.db')
+RESPONSE_CACHE_FILE = DATA_DIR.joinpath('responses.db')
+OUTBOX_FILE = DATA_DIR.joinpath('outbox.db')
 CONFIG_FILE = BASE_DIR.joinpath('config')
+
+# Defaults of the tuning options, see mesh.configuration.TUNING
+SESSION_POOL_SIZE = 10
+SESSION_POOL_HOSTS = 20
+SESSION_TIMEOUT = 30
+SESSION_RETRIES = 3
+SESSION_BACKOFF = 0.5
+SYNC_BATCH_SIZE = 1000
+CACHE_MAX_SIZE = 64 * 2 ** 20
+TOKEN_RENEW_BEFORE = 7 * 24 * 60 * 60
+TOKEN_CHECK_INTERVAL = 60 * 60
@@ -1 +1,267 @@
 """This module defines all events run by the scheduler"""
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import heapq
+import logging
+import random
+import threading
+import time
+
+from mesh import metrics
+from mesh.synchronize import BATCH_SIZE, pull, push, sync
+from mesh.user import User
+
+logger = logging.getLogger(__name__)
+
+#: Seconds before an event is retried when its user is busy
+BUSY_DELAY = 5
+
+
+@dataclass(order=True)
+class Event(ABC):
+    """Base class for events run by the :class:`Scheduler`
+
+    Events are ordered by the time they are due.
+
+    :param due: The :func:`~python:time.monotonic` time the event is due
+    :param user: The user the event runs for
+    :param interval: Seconds between repeated runs, 0 runs the event once
+    :param batch_size: Maximum number of items per Trakt request
+    """
+
+    due: float
+    user: User = field(compare=False)
+    interval: float = field(default=0, compare=False)
+    batch_size: int = field(default=BATCH_SIZE, compare=False)
+
+    @abstractmethod
+    def run(self, servers):
+        """Runs the event against the Plex servers
+
+        :param servers: Plex server identifier, or the pools of the servers
+        :type servers: :class:`~python:str` or
+                       :class:`mesh.servers.ServerPools`
+        """
+
+
+class PullEvent(Event):
+    """Pulls the user's Trakt changes into Plex"""
+
+    def run(self, servers):
+        pull(self.user, servers)
+
+
+class PushEvent(Event):
+    """Pushes the user's Plex plays to Trakt"""
+
+    def run(self, servers):
+        push(self.user, servers, self.batch_size)
+
+
+class SyncEvent(Event):
+    """Two-way synchronizes the user's Plex and Trakt data"""
+
+    def run(self, servers):
+        sync(self.user, servers, self.batch_size)
+
+
+#: Event classes for each CLI mode
+EVENTS = {
+    'pull': PullEvent,
+    'push': PushEvent,
+    'sync': SyncEvent
+}
+
+
+class Scheduler:
+    """Runs events for many users on a bounded pool of worker threads
+
+    At most *workers* events run concurrently and each user has at most
+    one event in flight, so events never modify a user concurrently.
+    Repeating events are rescheduled after their interval, randomly
+    stretched or shrunk by up to *jitter* to spread the load. Work on
+    each of several Plex servers is further bounded by the server's own
+    pool, see :class:`mesh.servers.ServerPools`.
+
+    :param servers: Plex server identifier, or the pools of the servers
+    :param workers: Maximum number of concurrent events
+    :param jitter: Fraction of the interval used for random jitter
+    :param on_complete: Called with each completed event, never
+                        concurrently, e.g. to save the users
+    :param batch_size: Maximum number of items per Trakt request
+    :type servers: :class:`~python:str` or
+                   :class:`mesh.servers.ServerPools`
+    :type workers: :class:`~python:int`
+    :type jitter: :class:`~python:float`
+    :type batch_size: :class:`~python:int`
+    """
+
+    def __init__(self, servers, workers=4, jitter=0.1, on_complete=None,
+                 batch_size=BATCH_SIZE):
+        self.servers = servers
+        self.workers = workers
+        self.jitter = jitter
+        self.on_complete = on_complete
+        self.batch_size = batch_size
+
+        self._queue = []
+        self._busy = set()
+        self._running = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _report(self):
+        """Records the queue depths, the condition must be held"""
+
+        metrics.registry.set('mesh_scheduler_queued_events', len(self._queue))
+        metrics.registry.set('mesh_scheduler_running_events', self._running)
+
+    def _jittered(self, seconds):
+        return seconds * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def schedule(self, event):
+        """Adds an event to the queue"""
+
+        with self._condition:
+            heapq.heappush(self._queue, event)
+            self._report()
+            self._condition.notify()
+
+    def schedule_users(self, users, mode, interval=0):
+        """Schedules an event of *mode* for each user
+
+        The first runs are spread over the jitter window of the interval.
+        Users with their own :attr:`mesh.user.User.interval` use it
+        instead of *interval*, unless the events only run once.
+
+        :param users: The users to schedule
+        :param mode: Key in :data:`EVENTS`
+        :param interval: Default seconds between runs, 0 runs once
+        """
+
+        now = time.monotonic()
+        for user in users:
+            user_interval = (user.interval or interval) if interval else 0
+            delay = random.uniform(0, user_interval * self.jitter)
+            self.schedule(EVENTS[mode](now + delay, user, user_interval,
+                                       self.batch_size))
+
+    def configure(self, workers=None, jitter=None, batch_size=None):
+        """Changes the settings of a running scheduler
+
+        Running events finish with the settings they were started with,
+        while queued events pick up the new ones.
+
+        :param workers: Maximum number of concurrent events
+        :param jitter: Fraction of the interval used for random jitter
+        :param batch_size: Maximum number of items per Trakt request
+        """
+
+        with self._condition:
+            if workers is not None:
+                self.workers = workers
+            if jitter is not None:
+                self.jitter = jitter
+            if batch_size is not None:
+                self.batch_size = batch_size
+                for event in self._queue:
+                    event.batch_size = batch_size
+            self._condition.notify()
+
+    def stop(self):
+        """Stops the scheduler, running events are allowed to finish"""
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self, until_idle=False):
+        """Runs events as they become due until stopped
+
+        :param until_idle: Return once no events remain
+        :type until_idle: :class:`~python:bool`
+        """
+
+        pools = []
+        try:
+            self._dispatch(pools, until_idle)
+        finally:
+            for pool in pools:
+                pool.shutdown(wait=True)
+
+    def _dispatch(self, pools, until_idle):
+        """Submits due events to the last pool, see :meth:`run`
+
+        A new pool is added when the number of workers changes, the old
+        pools finish their running events.
+        """
+
+        size = 0
+        with self._condition:
+            while not self._stopped:
+                if not self._queue:
+                    if until_idle and not self._running:
+                        break
+                    self._condition.wait()
+                    continue
+
+                delay = self._queue[0].due - time.monotonic()
+                if self._running >= self.workers:
+                    self._condition.wait()
+                    continue
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                event = heapq.heappop(self._queue)
+                if event.user.name in self._busy:
+                    event.due = time.monotonic() + BUSY_DELAY
+                    heapq.heappush(self._queue, event)
+                    continue
+
+                if size != self.workers:
+                    if pools:
+                        pools[-1].shutdown(wait=False)
+                    size = self.workers
+                    pools.append(ThreadPoolExecutor(size))
+
+                self._busy.add(event.user.name)
+                self._running += 1
+                self._report()
+                pools[-1].submit(self._run, event)
+
+    def _run(self, event):
+        """Runs an event on a worker thread and reschedules it"""
+
+        name = type(event).__name__
+        start = time.monotonic()
+        result = 'success'
+        try:
+            event.run(self.servers)
+        except Exception:
+            result = 'failure'
+            logger.exception(f'{name} failed for user "{event.user.name}"')
+        elapsed = time.monotonic() - start
+        logger.debug(f'{name} for "{event.user.name}" took {elapsed:.2f}s')
+        metrics.registry.inc('mesh_events_total', event=name, result=result)
+        metrics.registry.observe('mesh_event_seconds', elapsed, event=name)
+
+        with self._condition:
+            self._busy.discard(event.user.name)
+            self._running -= 1
+            if event.interval and not self._stopped:
+                event.batch_size = self.batch_size
+                event.due = time.monotonic() + self._jittered(event.interval)
+                heapq.heappush(self._queue, event)
+            self._report()
+            if self.on_complete is not None:
+                try:
+                    self.on_complete(event)
+                except Exception:
+                    logger.exception('Event completion callback failed')
+            self._condition.notify()
@@ -1,2 +1,17 @@
 class InvalidConfiguration(Exception):
     """The error raised when the application configuration is invalid"""
+
+
+class SynchronizationError(Exception):
+    """The error raised when Mesh fails to communicate with Trakt or Plex"""
+
+
+class RateLimitExceeded(SynchronizationError):
+    """The error raised when Trakt rejects a request due to rate limiting
+
+    :param retry_after: Seconds to wait before retrying
+    """
+
+    def __init__(self, msg, retry_after):
+        super().__init__(msg)
+        self.retry_after = retry_after
@@ -1,23 +1,218 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ISO8601_DATE_STR = '%Y-%m-%dT%H:%M:%S.%fZ'
 TRAKT_TIMESTR = ISO8601_DATE_STR
 
+#: Length of a zero-padded Trakt time, e.g. ``2020-01-01T00:00:00.000Z``
+_ISO8601_LEN = 24
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
 
 def zero_pad_year(date_str):
     padding = 4 - date_str.index('-')
     return f'{"0" * padding}{date_str}'
 
 
+def _parse(date_str):
+    """Returns the fields of a Trakt time or None if it is not one"""
+
+    if len(date_str) != _ISO8601_LEN or date_str[4] != '-':
+        date_str = zero_pad_year(date_str)
+        if len(date_str) != _ISO8601_LEN:
+            return None
+
+    try:
+        return (int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+                int(date_str[11:13]), int(date_str[14:16]),
+                int(date_str[17:19]), int(date_str[20:23]))
+    except ValueError:
+        return None
+
+
+def _days_from_civil(year, month, day):
+    """Returns the days between 1970-01-01 and a proleptic Gregorian date"""
+
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+                  + day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+
 def datetime_from_ISO8601_str(date_str):
     """Parse ISO8601 formatted `:class:str` to `:class:datetime.datetime`"""
 
-    padding = 4 - date_str.index('-')  # Zero-pad year by this amount
-    return datetime.strptime(zero_pad_year(date_str), ISO8601_DATE_STR).replace(tzinfo=timezone.utc)
+    if len(date_str) != _ISO8601_LEN or date_str[4] != '-':
+        date_str = zero_pad_year(date_str)
+
+    try:
+        return datetime.fromisoformat(date_str[:-1]).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return datetime.strptime(date_str, ISO8601_DATE_STR).replace(tzinfo=timezone.utc)
 
 
 def datetime_to_ISO8601_str(datetime_obj):
     """Returns ISO8601 `:class:str` from `:class:datetime.datetime`"""
 
-    return zero_pad_year(datetime_obj.replace(microsecond=0).strftime(ISO8601_DATE_STR)[:-4] + 'Z')
+    d = datetime_obj
+    return (f'{d.year:04d}-{d.month:02d}-{d.day:02d}T'
+            f'{d.hour:02d}:{d.minute:02d}:{d.second:02d}.000Z')
+
+
+def epoch_from_ISO8601_str(date_str):
+    """Returns the whole seconds since the epoch of an ISO8601 `:class:str`"""
+
+    fields = _parse(date_str)
+    if fields is None:
+        return int((datetime_from_ISO8601_str(date_str) - _EPOCH).total_seconds())
+
+    year, month, day, hour, minute, second, _ = fields
+    return (_days_from_civil(year, month, day) * 86400
+            + hour * 3600 + minute * 60 + second)
+
+
+def ISO8601_str_from_epoch(epoch):
+    """Returns ISO8601 `:class:str` from seconds since the epoch"""
+    return datetime_to_ISO8601_str(_EPOCH + timedelta(seconds=epoch))
+
+
+def epochs_from_ISO8601_strs(date_strs):
+    """Returns the seconds since the epoch of many ISO8601 strings
+
+    Uses NumPy when it is installed, in which case an ``int64`` array is
+    returned, otherwise a :class:`~python:list` of ints.
+
+    :param date_strs: ISO8601 formatted strings
+    :type date_strs: :class:`~python:list` [ :class:`~python:str` ]
+    """
+
+    if numpy is None or not date_strs:
+        return [epoch_from_ISO8601_str(s) for s in date_strs]
+
+    # NumPy expects four digit years and rejects the UTC designator,
+    # fractions are dropped like in epoch_from_ISO8601_str
+    padded = [(s if s[4:5] == '-' else zero_pad_year(s))[:19] for s in date_strs]
+    return numpy.array(padded, dtype='datetime64[s]').astype(numpy.int64)
+
+
+def ISO8601_strs_from_epochs(epochs):
+    """Returns ISO8601 strings from many seconds since the epoch
+
+    Uses NumPy when it is installed.
+
+    :param epochs: Seconds since the epoch
+    :rtype: :class:`~python:list` [ :class:`~python:str` ]
+    """
+
+    if numpy is None or not len(epochs):
+        return [ISO8601_str_from_epoch(int(e)) for e in epochs]
+
+    values = numpy.asarray(epochs, dtype='datetime64[s]')
+    return [f'{s}.000Z' for s in numpy.datetime_as_string(values, unit='s')]
+
+
+def deep_sizeof(obj):
+    """Returns the approximate bytes used by an object and its contents
+
+    Dicts, lists, tuples and sets are followed, objects referenced more
+    than once are counted once.
+
+    :rtype: :class:`~python:int`
+    """
+
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+def chunked(iterable, size):
+    """Yields lists of up to *size* items from *iterable*"""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of calls per key
+
+    Each key, e.g. a username, gets a bucket holding up to *burst* tokens
+    which is refilled at *rate* tokens per second. Thread safe.
+
+    :param rate: Allowed calls per second
+    :param burst: Number of calls allowed back to back
+    :type rate: :class:`~python:float`
+    :type burst: :class:`~python:int`
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _take(self, key):
+        """Takes a token for *key* if one is available
+
+        :return: 0 if a token was taken, otherwise the seconds until the
+                 next token is available
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def acquire(self, key=None):
+        """Blocks until a call for *key* is allowed
+
+        :return: Seconds spent waiting
+        :rtype: :class:`~python:float`
+        """
+
+        waited = 0
+        while True:
+            delay = self._take(key)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, key, seconds):
+        """Blocks calls for *key* during the given number of seconds"""
+
+        with self._lock:
+            self._buckets[key] = (1 - seconds * self.rate, time.monotonic())
@@ -0,0 +1,189 @@
+"""This module contains the compact watch history used for diffing
+
+Plays are stored as two sorted columns of 64 bit integers, an item key
+combining the Trakt media type and id, and the watch time in seconds
+since the epoch. A play takes 16 bytes, compared to several hundred for
+a dictionary, and differences between histories are computed by merging
+the sorted columns in linear time.
+"""
+
+from array import array
+
+from mesh.helpers import chunked, epochs_from_ISO8601_strs
+
+#: Trakt media types which can be stored, the index is encoded in the key
+MEDIA = ('movie', 'episode')
+
+
+def encode(media, trakt):
+    """Returns the item key of a Trakt media type and id"""
+    return trakt * len(MEDIA) + MEDIA.index(media)
+
+
+def decode(key):
+    """Returns the Trakt media type and id of an item key"""
+    trakt, media = divmod(key, len(MEDIA))
+    return MEDIA[media], trakt
+
+
+class History:
+    """Sorted, immutable collection of plays
+
+    Iterating yields tuples of Trakt media type, Trakt id and watch time
+    in seconds since the epoch, ordered by item and time.
+
+    :param plays: Tuples of Trakt media type, Trakt id and watch time
+    :type plays: :class:`~python:list` [ :class:`~python:tuple` ]
+    """
+
+    def __init__(self, plays=()):
+        keys, times = array('q'), array('q')
+        for media, trakt, watched_at in plays:
+            keys.append(encode(media, trakt))
+            times.append(int(watched_at))
+
+        if times:
+            # Plays are sorted as single integers packing the key above
+            # the time offset, rather than as a tuple per play
+            low = min(times)
+            shift = (max(times) - low).bit_length()
+            mask = (1 << shift) - 1
+            rows = sorted(key << shift | watched_at - low
+                          for key, watched_at in zip(keys, times))
+            for i, row in enumerate(rows):
+                keys[i], times[i] = row >> shift, (row & mask) + low
+        self._keys, self._times = keys, times
+
+    @classmethod
+    def _from_columns(cls, keys, times):
+        history = cls.__new__(cls)
+        history._keys, history._times = keys, times
+        return history
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Returns the history of Trakt history entries
+
+        Entries of other media types than :data:`MEDIA` are skipped. The
+        entries are converted in chunks, so a generator of entries is
+        never held in memory as a whole.
+
+        :param entries: Entries from Trakt's ``sync/history``
+        :type entries: :class:`~python:list` [ :class:`~python:dict` ]
+        """
+
+        def plays():
+            for chunk in chunked(entries, 1000):
+                chunk = [e for e in chunk if e['type'] in MEDIA]
+                times = epochs_from_ISO8601_strs(
+                    [e['watched_at'] for e in chunk])
+                for entry, watched_at in zip(chunk, times):
+                    media = entry['type']
+                    yield media, entry[media]['ids']['trakt'], watched_at
+
+        return cls(plays())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for key, watched_at in zip(self._keys, self._times):
+            yield (*decode(key), watched_at)
+
+    def __contains__(self, play):
+        return len(self._find(*play, 0)) > 0
+
+    def __eq__(self, other):
+        if not isinstance(other, History):
+            return NotImplemented
+        return self._keys == other._keys and self._times == other._times
+
+    def _find(self, media, trakt, watched_at, tolerance):
+        """Returns the indices of matching plays as a range"""
+
+        key = encode(media, trakt)
+        low = self._bisect((key, watched_at - tolerance))
+        high = self._bisect((key, watched_at + tolerance + 1))
+        return range(low, high)
+
+    def _bisect(self, row):
+        """Returns the index of the first play not before *row*"""
+
+        low, high = 0, len(self._keys)
+        while low < high:
+            middle = (low + high) // 2
+            if (self._keys[middle], self._times[middle]) < row:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def difference(self, other, tolerance=0):
+        """Returns the plays which have no matching play in *other*
+
+        Plays match when they are of the same item and their watch times
+        are at most *tolerance* seconds apart. Each play in *other*
+        matches at most one play, so repeated plays are kept.
+
+        :param other: The history to subtract
+        :param tolerance: Maximum difference in seconds between matches
+        :type other: :class:`History`
+        :type tolerance: :class:`~python:int`
+        :rtype: :class:`History`
+        """
+
+        keys, times = array('q'), array('q')
+        other_keys, other_times = other._keys, other._times
+        j, count = 0, len(other_keys)
+        for key, watched_at in zip(self._keys, self._times):
+            # Skip plays of *other* which can no longer match
+            while j < count and (other_keys[j], other_times[j]) < \
+                    (key, watched_at - tolerance):
+                j += 1
+
+            if j < count and other_keys[j] == key and \
+                    other_times[j] <= watched_at + tolerance:
+                j += 1
+                continue
+            keys.append(key)
+            times.append(watched_at)
+        return self._from_columns(keys, times)
+
+    def latest(self):
+        """Returns the history with only the latest play of each item
+
+        :rtype: :class:`History`
+        """
+
+        keys, times = array('q'), array('q')
+        for i, key in enumerate(self._keys):
+            if i + 1 < len(self._keys) and self._keys[i + 1] == key:
+                continue
+            keys.append(key)
+            times.append(self._times[i])
+        return self._from_columns(keys, times)
+
+    def join(self, other):
+        """Yields the items watched in both histories
+
+        The latest plays of both histories are merge joined on their item.
+
+        :param other: The history to join with
+        :type other: :class:`History`
+        :return: Tuples of Trakt media type, Trakt id and the latest
+                 watch times in this and the *other* history
+        :rtype: :class:`~python:tuple`
+        """
+
+        left, right = self.latest(), other.latest()
+        i = j = 0
+        while i < len(left._keys) and j < len(right._keys):
+            key, other_key = left._keys[i], right._keys[j]
+            if key < other_key:
+                i += 1
+            elif key > other_key:
+                j += 1
+            else:
+                yield (*decode(key), left._times[i], right._times[j])
+                i += 1
+                j += 1
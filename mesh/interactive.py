@@ -13,7 +13,7 @@ def first_run_setup():
     print('As such, some setup is required.')
     print('(You can abort this setup anytime by pressing "Ctrl + c")')
 
-    print('\nFirst, you must select the Plex server you wish to synchronize '
+    print('\nFirst, you must select the Plex servers you wish to synchronize '
           'with Trakt.')
     print('(Neither your username nor password will be stored)\n')
 
@@ -33,24 +33,23 @@ def first_run_setup():
     for i, server in enumerate(servers):
         print(f'[{i}]: {server[0]}')
 
-    selected_server = None
     while True:
-        sid = input('Enter the number of the server you wish to select: ')
+        sids = input('Enter the numbers of the servers you wish to select, '
+                     'separated by commas: ')
 
         try:
-            sid = int(sid)
+            sids = list(dict.fromkeys(int(s) for s in sids.split(',')))
         except ValueError:
-            print(f'"{sid}" is not a valid number, try again.')
+            print(f'"{sids}" is not a valid list of numbers, try again.')
             continue
 
-        if sid not in range(len(servers)):
-            print('The selected number must be in the available range')
+        if any(sid not in range(len(servers)) for sid in sids):
+            print('The selected numbers must be in the available range')
             continue
 
-        print(f'Server "{servers[sid][0]}" selected')
-        selected_server = servers[sid]
-        break
-    return selected_server[1:]
+        for sid in sids:
+            print(f'Server "{servers[sid][0]}" selected')
+        return [servers[sid] for sid in sids]
 
 
 def plex_oauth():
@@ -0,0 +1,121 @@
+"""This module contains the per-user change journal used by two-way sync"""
+
+from collections import namedtuple
+import sqlite3
+import threading
+
+from mesh.constants import JOURNAL_FILE
+from mesh.helpers import chunked
+
+#: The state of an item when it was last synchronized. Watch and rating
+#: times are kept per side, in seconds since the epoch, since each side
+#: records its own time for the writes Mesh makes to it.
+JournalEntry = namedtuple(
+    'JournalEntry',
+    ['plex_watched_at', 'trakt_watched_at', 'rating',
+     'plex_rated_at', 'trakt_rated_at'],
+    defaults=(0, 0, 0, 0, 0)
+)
+
+#: Maximum number of ids per SQLite query
+_QUERY_SIZE = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS journal (
+    user TEXT NOT NULL,
+    media TEXT NOT NULL,
+    trakt INTEGER NOT NULL,
+    plex_watched_at INTEGER NOT NULL,
+    trakt_watched_at INTEGER NOT NULL,
+    rating INTEGER NOT NULL,
+    plex_rated_at INTEGER NOT NULL,
+    trakt_rated_at INTEGER NOT NULL,
+    PRIMARY KEY (user, media, trakt)
+)
+'''
+
+
+class Journal:
+    """Persistent record of each user's last synchronized item states
+
+    Items are keyed by user, Trakt media type and Trakt id. Only the
+    items involved in a sync are read and written, so the cost of a
+    sync follows the number of changes rather than the library size.
+
+    :param path: Full path to the database file
+    :type path: :class:`~python:pathlib:Path`
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(_SCHEMA)
+
+    def get(self, username, keys):
+        """Returns the journal entries of the given items
+
+        :param username: Name of the user
+        :param keys: Tuples of Trakt media type and Trakt id
+        :return: Entries of the journaled items, keyed like *keys*
+        :rtype: :class:`~python:dict`
+        """
+
+        by_media = {}
+        for media, trakt in keys:
+            by_media.setdefault(media, []).append(trakt)
+
+        entries = {}
+        with self._lock:
+            for media, ids in by_media.items():
+                for chunk in chunked(ids, _QUERY_SIZE):
+                    rows = self._db.execute(
+                        'SELECT trakt, plex_watched_at, trakt_watched_at, '
+                        'rating, plex_rated_at, trakt_rated_at FROM journal '
+                        'WHERE user = ? AND media = ? AND trakt IN '
+                        f'({",".join("?" * len(chunk))})',
+                        [username, media] + chunk)
+                    for trakt, *state in rows:
+                        entries[(media, trakt)] = JournalEntry(*state)
+        return entries
+
+    def update(self, username, entries):
+        """Stores the entries of several items in a single transaction
+
+        :param username: Name of the user
+        :param entries: :class:`JournalEntry` keyed by Trakt media type
+                        and Trakt id
+        :type entries: :class:`~python:dict`
+        """
+
+        rows = [(username, media, trakt, *entry)
+                for (media, trakt), entry in entries.items()]
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+
+    def clear(self, username):
+        """Removes all entries of a user, the next sync becomes a full sync"""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM journal WHERE user = ?', (username,))
+
+    def close(self):
+        """Closes the underlying database"""
+        self._db.close()
+
+
+def get_journal(path=None):
+    global _journal
+
+    if path is None:
+        path = JOURNAL_FILE
+
+    if _journal is None:
+        _journal = Journal(path)
+    return _journal
+
+
+#: Instantiated :class:`Journal` object shared by all users.
+_journal = None
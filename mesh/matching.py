@@ -0,0 +1,365 @@
+"""This module contains the Plex to Trakt id resolution index"""
+
+from collections import namedtuple, OrderedDict
+import logging
+import sqlite3
+import threading
+import time
+
+from mesh import api, metrics
+from mesh.constants import ID_INDEX_FILE
+
+logger = logging.getLogger(__name__)
+
+#: Legacy Plex agents and the type of id found in their guids
+LEGACY_AGENTS = {
+    'com.plexapp.agents.imdb': 'imdb',
+    'com.plexapp.agents.themoviedb': 'tmdb',
+    'com.plexapp.agents.thetvdb': 'tvdb'
+}
+
+#: Id types accepted by Trakt's id search, in order of preference
+SEARCHABLE = ('imdb', 'tmdb', 'tvdb')
+
+#: Seconds before an unresolvable guid is looked up again
+MISS_TTL = 7 * 24 * 60 * 60
+
+#: Number of show season trees kept in memory, see :meth:`IdIndex.episodes`
+TREE_CACHE_SIZE = 256
+
+#: The show and numbering of a Plex episode, where *show* holds the
+#: normalized guids of the show. Used to match episodes through the
+#: season tree of their show, see :meth:`IdIndex.resolve_many`
+Episode = namedtuple('Episode', ['show', 'season', 'number'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ids (
+    guid TEXT NOT NULL,
+    media TEXT NOT NULL,
+    trakt INTEGER,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (guid, media)
+)
+'''
+
+
+def normalize_guid(guid):
+    """Returns *guid* in the ``<type>://<id>`` form used by the index
+
+    Legacy agent guids such as ``com.plexapp.agents.imdb://tt0944947?lang=en``
+    are converted to ``imdb://tt0944947``, while guids from the new Plex
+    agents are kept as is. Guids which can not be matched against Trakt,
+    e.g. ``local://`` guids, return None.
+
+    :param guid: Plex guid
+    :type guid: :class:`~python:str`
+    :rtype: :class:`~python:str` or None
+    """
+
+    scheme, sep, rest = guid.partition('://')
+    if not sep or not rest:
+        return None
+
+    rest = rest.split('?', 1)[0]
+    if scheme == 'plex' or scheme in SEARCHABLE:
+        return f'{scheme}://{rest}'
+
+    scheme = LEGACY_AGENTS.get(scheme)
+    if scheme is None:
+        return None
+    return f'{scheme}://{rest}'
+
+
+def search(media, guids):
+    """Looks up the Trakt id of an item through Trakt's id search
+
+    :param media: Trakt media type (movie, show or episode)
+    :param guids: Normalized guids of the item
+    :return: The Trakt id or None if Trakt does not know the item
+    :raises: :class:`mesh.exceptions.SynchronizationError` if a request fails
+    """
+
+    for guid in guids:
+        id_type, _, value = guid.partition('://')
+        if id_type not in SEARCHABLE or '/' in value:
+            continue
+
+        response = api.get(f'search/{id_type}/{value}', {'type': media},
+                           authenticated=False)
+        for result in response.json():
+            if result.get('type') == media:
+                return result[media]['ids']['trakt']
+    return None
+
+
+def season_tree(show):
+    """Returns the Trakt ids of all episodes of a show
+
+    The seasons and their episodes are fetched in a single request.
+
+    :param show: Trakt id of the show
+    :return: Trakt episode ids keyed by season and episode number
+    :rtype: :class:`~python:dict`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if the
+             request fails
+    """
+
+    response = api.get(f'shows/{show}/seasons', {'extended': 'episodes'},
+                       authenticated=False)
+    return {(episode['season'], episode['number']): episode['ids']['trakt']
+            for season in response.json()
+            for episode in season.get('episodes') or ()}
+
+
+class IdIndex:
+    """Persistent mapping between Plex guids and Trakt ids
+
+    The mapping is stored in a SQLite database and mirrored in memory,
+    so each lookup is a dictionary hit. Guids are stored normalized
+    (see :func:`normalize_guid`) and per Trakt media type, since the same
+    TMDb and TVDb ids are reused between movies and shows. Guids which
+    Trakt can not resolve are remembered for :data:`MISS_TTL` seconds.
+    Episodes are preferably matched by number within the season tree of
+    their show, which takes one request per show instead of one per
+    episode.
+
+    The mapping is independent of users, use :func:`get_index` to
+    access the index shared by all of them.
+
+    :param path: Full path to the database file
+    :type path: :class:`~python:pathlib:Path`
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(_SCHEMA)
+
+        self._ids = {}
+        self._guids = {}
+        self._trees = OrderedDict()
+        rows = self._db.execute('SELECT guid, media, trakt, updated_at FROM ids')
+        for guid, media, trakt, updated_at in rows:
+            self._cache(media, guid, trakt, updated_at)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _cache(self, media, guid, trakt, updated_at):
+        self._ids[(media, guid)] = (trakt, updated_at)
+        if trakt is not None:
+            self._guids.setdefault((media, trakt), set()).add(guid)
+
+    def _uncache(self, media, guid):
+        trakt, _ = self._ids.pop((media, guid), (None, None))
+        guids = self._guids.get((media, trakt))
+        if guids is not None:
+            guids.discard(guid)
+            if not guids:
+                del self._guids[(media, trakt)]
+
+    def lookup(self, media, guids):
+        """Returns whether any of the guids is indexed, and its Trakt id
+
+        Expired misses are treated as unknown guids.
+
+        :param media: Trakt media type
+        :param guids: Normalized guids of a single item
+        :rtype: :class:`~python:tuple` [ :class:`~python:bool`,
+                :class:`~python:int` or None ]
+        """
+
+        now = time.time()
+        known = False
+        with self._lock:
+            for guid in guids:
+                trakt, updated_at = self._ids.get((media, guid), (None, None))
+                if trakt is not None:
+                    return True, trakt
+                if updated_at is not None and now - updated_at < MISS_TTL:
+                    known = True
+        return known, None
+
+    def get(self, media, guids):
+        """Returns the Trakt id of the first indexed guid or None"""
+        return self.lookup(media, guids)[1]
+
+    def guid(self, media, trakt, scheme='plex'):
+        """Returns an indexed guid of *scheme* for the Trakt id or None"""
+
+        prefix = f'{scheme}://'
+        with self._lock:
+            for guid in self._guids.get((media, trakt), ()):
+                if guid.startswith(prefix):
+                    return guid
+        return None
+
+    def update(self, entries):
+        """Stores several mappings in a single transaction
+
+        :param entries: Tuples of media type, guids and Trakt id, where
+                        a Trakt id of None records an unresolvable item
+        :type entries: :class:`~python:list` [ :class:`~python:tuple` ]
+        """
+
+        now = int(time.time())
+        rows = [(guid, media, trakt, now)
+                for media, guids, trakt in entries for guid in guids]
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?)', rows)
+            for guid, media, trakt, updated_at in rows:
+                self._uncache(media, guid)
+                self._cache(media, guid, trakt, updated_at)
+
+    def add(self, media, guids, trakt):
+        """Maps all the guids to the Trakt id"""
+        self.update([(media, guids, trakt)])
+
+    def invalidate(self, media=None, guids=None):
+        """Removes mappings from the index
+
+        With neither argument the whole index is cleared, with only
+        *media* all mappings of that type are removed and with only
+        *guids* the mappings of those guids to any type are removed.
+
+        :param media: Trakt media type
+        :param guids: Normalized guids to remove
+        """
+
+        with self._lock, self._db:
+            if guids is not None and media is not None:
+                keys = [(media, g) for g in guids]
+            elif guids is not None:
+                guids = set(guids)
+                keys = [k for k in self._ids if k[1] in guids]
+            else:
+                keys = [k for k in self._ids if media in (None, k[0])]
+
+            self._db.executemany('DELETE FROM ids WHERE media = ? AND guid = ?',
+                                 keys)
+            for key in keys:
+                self._uncache(*key)
+            if media in (None, 'show', 'episode'):
+                self._trees.clear()
+
+    def episodes(self, show):
+        """Returns the season tree of a show, see :func:`season_tree`
+
+        The :data:`TREE_CACHE_SIZE` most recently used trees are kept in
+        memory.
+
+        :param show: Trakt id of the show
+        :rtype: :class:`~python:dict`
+        """
+
+        with self._lock:
+            tree = self._trees.get(show)
+            if tree is not None:
+                self._trees.move_to_end(show)
+                return tree
+
+        tree = season_tree(show)
+        with self._lock:
+            self._trees[show] = tree
+            if len(self._trees) > TREE_CACHE_SIZE:
+                self._trees.popitem(last=False)
+        return tree
+
+    def resolve(self, media, guids):
+        """Returns the Trakt id for an item, searching Trakt if required"""
+        return self.resolve_many([(media, guids)])[0]
+
+    def resolve_many(self, items):
+        """Returns the Trakt ids of several items
+
+        Items missing from the index are searched for on Trakt and all
+        results are stored in a single transaction. Episodes given with
+        their :class:`Episode` are grouped by show, each show is resolved
+        once and its episodes are looked up in its season tree. Episodes
+        missing from the tree are searched for individually.
+
+        :param items: Tuples of media type and normalized guids,
+                      optionally followed by an :class:`Episode` or None
+        :type items: :class:`~python:list` [ :class:`~python:tuple` ]
+        :return: Trakt id, or None, for each item
+        :rtype: :class:`~python:list`
+        :raises: :class:`mesh.exceptions.SynchronizationError` if a
+                 Trakt request fails
+        """
+
+        ids = []
+        resolved = []
+        shows = {}
+        misses = 0
+        try:
+            for media, guids, *episode in items:
+                known, trakt = self.lookup(media, guids)
+                if not known:
+                    misses += 1
+                    episode = episode[0] if episode else None
+                    if media == 'episode' and episode and episode.show:
+                        shows.setdefault(tuple(episode.show), []).append(
+                            (len(ids), guids, episode))
+                    else:
+                        trakt = search(media, guids)
+                        resolved.append((media, guids, trakt))
+                ids.append(trakt)
+
+            for show, episodes in shows.items():
+                for position, trakt in self._resolve_episodes(
+                        list(show), episodes, resolved):
+                    ids[position] = trakt
+        finally:
+            metrics.registry.inc('mesh_index_lookups_total',
+                                 len(ids) - misses, result='hit')
+            metrics.registry.inc('mesh_index_lookups_total', misses,
+                                 result='miss')
+            if resolved:
+                logger.debug(f'Resolved {len(resolved)} items through Trakt')
+                self.update(resolved)
+        return ids
+
+    def _resolve_episodes(self, show, episodes, resolved):
+        """Yields the position and Trakt id of episodes of a single show
+
+        :param show: Normalized guids of the show
+        :param episodes: Position, normalized guids and :class:`Episode`
+                         of each episode
+        :param resolved: Entries to store, new entries are appended
+        """
+
+        known, trakt = self.lookup('show', show)
+        if not known:
+            trakt = search('show', show)
+            resolved.append(('show', show, trakt))
+        tree = self.episodes(trakt) if trakt is not None else {}
+
+        for position, guids, episode in episodes:
+            trakt = tree.get((episode.season, episode.number))
+            if trakt is None:
+                trakt = search('episode', guids)
+            resolved.append(('episode', guids, trakt))
+            yield position, trakt
+
+    def close(self):
+        """Closes the underlying database"""
+        self._db.close()
+
+
+def get_index(path=None):
+    global _index
+
+    if path is None:
+        path = ID_INDEX_FILE
+
+    if _index is None:
+        _index = IdIndex(path)
+    return _index
+
+
+#: Instantiated :class:`IdIndex` object shared by all users.
+#: Should **always** be used when ids need to be resolved.
+_index = None
@@ -0,0 +1,408 @@
+"""This module contains the runtime metrics of Mesh
+
+Counters, gauges and latency histograms are kept in memory by the
+:data:`registry` shared by all threads. They can be exposed in the
+Prometheus text format through a local HTTP endpoint, see :func:`serve`,
+and summarized at the end of a run, see :func:`summary`.
+
+Pull, push, sync and scrobbling are split into phases: ``fetch`` reads
+changes from Plex or Trakt, ``match`` resolves items between them,
+``diff`` compares both sides and ``apply`` writes the changes. The time
+spent in each phase and the number of items it processed are recorded
+per mode, so a slow run can be traced to one side or to the matching.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#: Type and description of each metric
+METRICS = {
+    'mesh_http_requests_total': (
+        'counter', 'HTTP requests by service, endpoint and status'),
+    'mesh_http_request_seconds': (
+        'histogram', 'HTTP request latency by service and endpoint'),
+    'mesh_rate_limit_wait_seconds_total': (
+        'counter', 'Seconds spent waiting for the Trakt rate limits'),
+    'mesh_rate_limited_total': (
+        'counter', 'Trakt requests rejected due to rate limiting'),
+    'mesh_phase_seconds_total': (
+        'counter', 'Seconds spent in each phase of each mode'),
+    'mesh_phase_items_total': (
+        'counter', 'Items processed in each phase of each mode'),
+    'mesh_index_lookups_total': (
+        'counter', 'Id index lookups by result, hit or miss'),
+    'mesh_cache_requests_total': (
+        'counter', 'Cacheable Trakt requests by result, hit, revalidated '
+                   'or miss'),
+    'mesh_outbox_writes_total': (
+        'counter', 'Trakt writes passed through the outbox by state, '
+                   'enqueued or delivered'),
+    'mesh_events_total': (
+        'counter', 'Scheduler events run by event and result'),
+    'mesh_event_seconds': (
+        'histogram', 'Scheduler event duration by event'),
+    'mesh_scheduler_queued_events': (
+        'gauge', 'Events waiting in the scheduler queue'),
+    'mesh_scheduler_running_events': (
+        'gauge', 'Events running on the scheduler workers'),
+    'mesh_scrobbles_total': (
+        'counter', 'Scrobbles sent to Trakt by action'),
+    'mesh_token_renewals_total': (
+        'counter', 'Trakt token renewals by result')
+}
+
+
+class Histogram:
+    """Bucketed observations of a single series
+
+    :param buckets: Upper bounds of the buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yields the upper bound and cumulative count of each bucket"""
+
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+        yield float('inf'), self.count
+
+
+class Registry:
+    """Thread safe store of labelled metrics
+
+    Every metric must be declared in :data:`METRICS`. Label values are
+    converted to strings and each combination is a separate series.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        if name not in METRICS:
+            raise KeyError(f'Unknown metric "{name}"')
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increases a counter"""
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge"""
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._series[key] = value
+
+    def observe(self, name, value, **labels):
+        """Records a value in a histogram"""
+
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._series.get(key)
+            if histogram is None:
+                histogram = self._series[key] = Histogram()
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        """Returns the value of a series, 0 or None if it was never set
+
+        :rtype: :class:`~python:float` or :class:`Histogram`
+        """
+
+        key = self._key(name, labels)
+        default = None if METRICS[name][0] == 'histogram' else 0
+        return self._series.get(key, default)
+
+    def collect(self, name):
+        """Returns the labels and value of each series of a metric
+
+        :rtype: :class:`~python:list` [ :class:`~python:tuple` [
+                :class:`~python:dict`, :class:`~python:float` or
+                :class:`Histogram` ] ]
+        """
+
+        with self._lock:
+            return [(dict(labels), value)
+                    for (n, labels), value in self._series.items()
+                    if n == name]
+
+    def reset(self):
+        """Removes all series"""
+
+        with self._lock:
+            self._series.clear()
+
+
+def endpoint(path):
+    """Returns a path with its ids replaced, for use as a label
+
+    Segments containing digits are replaced by ``{id}``, so requests for
+    different items share a series, e.g. ``/library/metadata/{id}``.
+    """
+
+    return '/'.join('{id}' if any(c.isdigit() for c in segment) else segment
+                    for segment in path.split('/'))
+
+
+def record_request(service, method, path, status, seconds):
+    """Records a completed HTTP request
+
+    :param service: ``plex``, ``plex.tv`` or ``trakt``
+    :param path: The request path, ids are replaced, see :func:`endpoint`
+    :param status: The response status code
+    :param seconds: Time until the response arrived
+    """
+
+    path = endpoint(path)
+    registry.inc('mesh_http_requests_total', service=service, endpoint=path,
+                 method=method, status=status)
+    registry.observe('mesh_http_request_seconds', seconds, service=service,
+                     endpoint=path)
+
+
+def _labels(labels, **extra):
+    pairs = sorted(labels.items()) + list(extra.items())
+    if not pairs:
+        return ''
+    pairs = ','.join(f'{k}="{_escape(str(v))}"' for k, v in pairs)
+    return f'{{{pairs}}}'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None):
+    """Returns the metrics in the Prometheus text exposition format
+
+    :param metrics: The registry to render, :data:`registry` by default
+    :type metrics: :class:`Registry`
+    :rtype: :class:`~python:str`
+    """
+
+    metrics = metrics or registry
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        series = metrics.collect(name)
+        if not series:
+            continue
+
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series, key=lambda s: sorted(s[0].items())):
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+
+            for bound, count in value.cumulative():
+                lines.append(f'{name}_bucket{_labels(labels, le=_number(bound))}'
+                             f' {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(value.sum)}')
+            lines.append(f'{name}_count{_labels(labels)} {value.count}')
+    return '\n'.join(lines) + '\n'
+
+
+_local = threading.local()
+
+
+@contextmanager
+def mode(name):
+    """Labels the phases run by the current thread with a mode
+
+    Can be used as a decorator, e.g. on :func:`mesh.synchronize.push`.
+
+    :param name: The mode, e.g. ``push``
+    """
+
+    previous = getattr(_local, 'mode', None)
+    _local.mode = name
+    try:
+        yield
+    finally:
+        _local.mode = previous
+
+
+def current_mode():
+    """Returns the mode of the current thread or None, see :func:`mode`"""
+    return getattr(_local, 'mode', None)
+
+
+class Phase:
+    """Items processed by a running phase, see :func:`phase`"""
+
+    def __init__(self):
+        self.items = 0
+
+
+@contextmanager
+def phase(name, items=0):
+    """Records the time spent in a phase of the current mode
+
+    :param name: ``fetch``, ``match``, ``diff`` or ``apply``
+    :param items: Number of items processed, can also be added to the
+                  ``items`` attribute of the yielded :class:`Phase`
+    """
+
+    record = Phase()
+    record.items = items
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        labels = {'mode': current_mode() or 'other',
+                  'phase': name}
+        registry.inc('mesh_phase_seconds_total',
+                     time.perf_counter() - start, **labels)
+        registry.inc('mesh_phase_items_total', record.items, **labels)
+
+
+def measured(iterable, name, count=len):
+    """Yields from *iterable*, recording the time spent producing values
+
+    Suited to generators which fetch lazily, e.g. :func:`mesh.plex.walk`.
+
+    :param name: The phase, see :func:`phase`
+    :param count: Returns the number of items in a value
+    """
+
+    iterator = iter(iterable)
+    while True:
+        with phase(name) as record:
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            record.items = count(value)
+        yield value
+
+
+def summary(metrics=None):
+    """Returns a readable summary of the phases, requests and matching
+
+    :param metrics: The registry to summarize, :data:`registry` by default
+    :type metrics: :class:`Registry`
+    :rtype: :class:`~python:list` [ :class:`~python:str` ]
+    """
+
+    metrics = metrics or registry
+    lines = []
+
+    items = {(l['mode'], l['phase']): v
+             for l, v in metrics.collect('mesh_phase_items_total')}
+    for labels, seconds in sorted(metrics.collect('mesh_phase_seconds_total'),
+                                  key=lambda s: (s[0]['mode'], s[0]['phase'])):
+        key = (labels['mode'], labels['phase'])
+        rate = items.get(key, 0) / seconds if seconds else 0
+        lines.append(f'{key[0]} {key[1]}: {items.get(key, 0)} items in '
+                     f'{seconds:.2f}s ({rate:.0f}/s)')
+
+    requests = {}
+    for labels, histogram in metrics.collect('mesh_http_request_seconds'):
+        count, total = requests.get(labels['service'], (0, 0))
+        requests[labels['service']] = (count + histogram.count,
+                                       total + histogram.sum)
+    for service, (count, total) in sorted(requests.items()):
+        lines.append(f'{service} requests: {count} taking {total:.2f}s '
+                     f'({total / count * 1000:.0f}ms average)')
+
+    hits = metrics.get('mesh_index_lookups_total', result='hit')
+    misses = metrics.get('mesh_index_lookups_total', result='miss')
+    if hits + misses:
+        lines.append(f'index lookups: {hits + misses}, '
+                     f'{hits / (hits + misses):.1%} hits')
+
+    cached = {l['result']: v
+              for l, v in metrics.collect('mesh_cache_requests_total')}
+    if cached:
+        lines.append(f'cached requests: {cached.get("hit", 0)} hits, '
+                     f'{cached.get("revalidated", 0)} revalidated, '
+                     f'{cached.get("miss", 0)} misses')
+
+    outbox = {l['state']: v
+              for l, v in metrics.collect('mesh_outbox_writes_total')}
+    if outbox:
+        lines.append(f'outbox: {outbox.get("enqueued", 0)} writes enqueued, '
+                     f'{outbox.get("delivered", 0)} delivered')
+
+    waited = sum(v for _, v in
+                 metrics.collect('mesh_rate_limit_wait_seconds_total'))
+    limited = sum(v for _, v in metrics.collect('mesh_rate_limited_total'))
+    if waited or limited:
+        lines.append(f'rate limits: waited {waited:.2f}s, '
+                     f'{limited} requests rejected')
+    return lines
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(f'Metrics request: {format % args}')
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host='127.0.0.1'):
+    """Serves the metrics at ``/metrics`` on a background thread
+
+    :param port: Port to listen on, 0 picks a free port
+    :param host: Address to listen on, only local by default
+    :return: The running server, stop it with ``shutdown()``
+    :rtype: :class:`~python:http.server.ThreadingHTTPServer`
+    """
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name='metrics').start()
+    logger.info(f'Serving metrics on http://{host}:'
+                f'{server.server_address[1]}/metrics')
+    return server
+
+
+#: The :class:`Registry` shared by all threads.
+#: Should **always** be used to record metrics.
+registry = Registry()
@@ -0,0 +1,171 @@
+"""This module contains the durable outbox of pending Trakt writes
+
+Writes are enqueued before they are sent and acknowledged once Trakt
+accepted them, so a push or sync interrupted by a crash, a rate limit or
+a network failure resumes with the writes it did not deliver, rather
+than redoing everything from the user's watermark.
+
+Acknowledged writes are kept until the user's watermark advances, see
+:meth:`Outbox.prune`. A run repeated from the same watermark enqueues the
+same writes again, which are then ignored instead of sent twice.
+"""
+
+from collections import namedtuple
+import sqlite3
+import threading
+
+from mesh import metrics
+from mesh.constants import OUTBOX_FILE
+from mesh.helpers import chunked
+
+#: A pending write of *value* as *field* of a Trakt item to *path*, e.g.
+#: a play to ``sync/history`` with its ``watched_at`` time
+OutboxEntry = namedtuple('OutboxEntry',
+                         ['id', 'path', 'field', 'media', 'trakt', 'value'])
+
+#: Maximum number of ids per SQLite query
+_QUERY_SIZE = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    path TEXT NOT NULL,
+    field TEXT,
+    media TEXT NOT NULL,
+    trakt INTEGER NOT NULL,
+    value,
+    delivered INTEGER NOT NULL DEFAULT 0
+);
+-- NULL values, e.g. of removals, are distinct in a UNIQUE constraint.
+-- An endpoint either always or never sends a value, so '' is safe.
+CREATE UNIQUE INDEX IF NOT EXISTS outbox_write
+    ON outbox (user, path, media, trakt, COALESCE(value, ''));
+'''
+
+
+class Outbox:
+    """Persistent queue of each user's pending Trakt writes
+
+    Writes of a user are delivered in the order they were enqueued.
+
+    :param path: Full path to the database file
+    :type path: :class:`~python:pathlib:Path`
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+
+    def __len__(self):
+        return self.count()
+
+    def enqueue(self, username, path, items, field='watched_at'):
+        """Adds writes in a single transaction
+
+        Writes already in the outbox, delivered or not, are ignored.
+
+        :param username: Name of the user
+        :param path: Trakt sync endpoint, e.g. ``sync/history``
+        :param items: Tuples of media type, Trakt id and value
+        :param field: Name of the value in the request, see
+                      :func:`mesh.synchronize.send_batches`
+        :return: The number of writes added
+        :rtype: :class:`~python:int`
+        """
+
+        rows = [(username, path, field, media, trakt, value)
+                for media, trakt, value in items]
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO outbox '
+                '(user, path, field, media, trakt, value) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            added = self._db.total_changes - before
+        if added:
+            metrics.registry.inc('mesh_outbox_writes_total', added,
+                                 state='enqueued')
+        return added
+
+    def pending(self, username, path=None):
+        """Returns the user's undelivered writes, oldest first
+
+        :param username: Name of the user
+        :param path: Only return the writes to this endpoint
+        :rtype: :class:`~python:list` [ :class:`OutboxEntry` ]
+        """
+
+        query = ('SELECT id, path, field, media, trakt, value FROM outbox '
+                 'WHERE user = ? AND NOT delivered')
+        params = [username]
+        if path is not None:
+            query += ' AND path = ?'
+            params.append(path)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id', params)
+            return [OutboxEntry(*row) for row in rows]
+
+    def acknowledge(self, ids):
+        """Marks writes as delivered in a single transaction
+
+        :param ids: The :attr:`OutboxEntry.id` of the delivered writes
+        """
+
+        ids = list(ids)
+        with self._lock, self._db:
+            for chunk in chunked(ids, _QUERY_SIZE):
+                self._db.execute(
+                    'UPDATE outbox SET delivered = 1 WHERE id IN '
+                    f'({",".join("?" * len(chunk))})', chunk)
+        metrics.registry.inc('mesh_outbox_writes_total', len(ids),
+                             state='delivered')
+
+    def prune(self, username):
+        """Removes the user's delivered writes
+
+        Called once the user's watermark covers them, so they are never
+        enqueued again.
+        """
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM outbox WHERE user = ? AND delivered',
+                             (username,))
+
+    def count(self, username=None):
+        """Returns the number of undelivered writes, of a user or of all"""
+
+        query = 'SELECT COUNT(*) FROM outbox WHERE NOT delivered'
+        params = ()
+        if username is not None:
+            query += ' AND user = ?'
+            params = (username,)
+        with self._lock:
+            return self._db.execute(query, params).fetchone()[0]
+
+    def clear(self, username):
+        """Removes all writes of a user, delivered or not"""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM outbox WHERE user = ?', (username,))
+
+    def close(self):
+        """Closes the underlying database"""
+        self._db.close()
+
+
+def get_outbox(path=None):
+    global _outbox
+
+    if path is None:
+        path = OUTBOX_FILE
+
+    if _outbox is None:
+        _outbox = Outbox(path)
+    return _outbox
+
+
+#: Instantiated :class:`Outbox` object shared by all users.
+_outbox = None
@@ -1,14 +1,31 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import logging
+import threading
+import time
 import urllib3
+from xml.etree import ElementTree
 
 import plexapi
-from plexapi.exceptions import BadRequest
+from plexapi.exceptions import BadRequest, NotFound, Unauthorized
 from plexapi.myplex import MyPlexAccount
+from plexapi.server import PlexServer
 from plexapi.config import reset_base_headers
+from plexapi.utils import joinArgs
 import requests
 
+from mesh.matching import Episode, normalize_guid
+from mesh.sessions import get_session
+
 logger = logging.getLogger(__name__)
 
+#: Seconds before a probed server connection is considered unreachable
+PROBE_TIMEOUT = 5
+
+_accounts = {}
+_accounts_lock = threading.Lock()
+
 
 def owned_servers(username, password):
     """Returns basic information about all owned servers
@@ -28,18 +45,292 @@ def owned_servers(username, password):
 
     servers = []
     try:
-        plex_acc = MyPlexAccount(username, password)
+        plex_acc = MyPlexAccount(username, password, session=get_session())
         for resource in plex_acc.resources():
             if resource.provides == 'server' and resource.owned:
                 servers.append((resource.name,
                                resource.clientIdentifier,
                                resource.accessToken))
-    except BadRequest as e:
-        logging.exception(f'Failed to authenticate user "{username}"')
-        pass
+    except BadRequest:
+        logger.exception(f'Failed to authenticate user "{username}"')
     return servers
 
 
+def account(token):
+    """Returns the Plex account owning *token*
+
+    Accounts are created once per token and share the session returned
+    by :func:`mesh.sessions.get_session`, as do the servers connected
+    through them.
+
+    :param token: Access token to a Plex account
+    :type token: :class:`~python:str`
+    :rtype: :class:`~plexapi.myplex.MyPlexAccount`
+    :raises: :class:`~plexapi.exceptions.BadRequest` if the token is invalid
+    """
+
+    with _accounts_lock:
+        if token not in _accounts:
+            _accounts[token] = MyPlexAccount(token=token, session=get_session())
+        return _accounts[token]
+
+
+def probe(urls, identifier, timeout=PROBE_TIMEOUT):
+    """Returns the url through which the server answers the fastest
+
+    All urls are requested in parallel. Responses from servers other than
+    the one with *identifier*, e.g. another server on the same LAN
+    address, are discarded.
+
+    :param urls: Candidate server urls
+    :param identifier: Plex server identifier
+    :param timeout: Seconds before a url is considered unreachable
+    :return: The fastest url and its latency in seconds, or None
+    :rtype: :class:`~python:tuple` [ :class:`~python:str`,
+            :class:`~python:float` ] or None
+    """
+
+    session = get_session()
+
+    def latency(url):
+        start = time.monotonic()
+        try:
+            response = session.get(f'{url}/identity', timeout=timeout)
+            root = ElementTree.fromstring(response.content)
+        except (requests.RequestException, ElementTree.ParseError):
+            return None
+        if root.attrib.get('machineIdentifier') != identifier:
+            return None
+        return time.monotonic() - start
+
+    if not urls:
+        return None
+
+    with ThreadPoolExecutor(len(urls)) as pool:
+        latencies = list(pool.map(latency, urls))
+
+    reachable = [(u, l) for u, l in zip(urls, latencies) if l is not None]
+    if not reachable:
+        return None
+    return min(reachable, key=lambda r: r[1])
+
+
+#: A connected server with the url and access token it was reached with
+Connection = namedtuple('Connection', ['server', 'url', 'token'])
+
+
+def connect(identifier, token, url='', url_token=''):
+    """Connects to the server with matching identifier
+
+    If *url* is given, e.g. the url cached in :attr:`mesh.user.User.url`,
+    it is tried first with *url_token*, the server access token it was
+    reached with. Otherwise, or if it fails, the server is located among
+    the resources of the account owning *token* and all of its advertised
+    connections (local, remote and relay) are probed, see :func:`probe`.
+
+    :param identifier: Plex server identifier
+    :param token: Access token to a Plex account with access to the server
+    :param url: Previously used server url
+    :param url_token: Access token previously used with *url*, defaults
+                      to *token*
+    :type identifier: :class:`~python:str`
+    :type token: :class:`~python:str`
+    :type url: :class:`~python:str`
+    :type url_token: :class:`~python:str`
+    :return: The connection or None if the server is unavailable
+    :rtype: :class:`Connection` or None
+    """
+
+    if url:
+        url_token = url_token or token
+        try:
+            server = PlexServer(url, url_token, session=get_session())
+            if server.machineIdentifier == identifier:
+                return Connection(server, url, url_token)
+        except (requests.RequestException, BadRequest, Unauthorized, NotFound):
+            pass
+        logger.info(f'Cached url "{url}" failed, probing connections')
+
+    try:
+        for resource in account(token).resources():
+            if resource.clientIdentifier != identifier:
+                continue
+
+            fastest = probe(resource.preferred_connections(), identifier)
+            if fastest is None:
+                break
+
+            url, latency = fastest
+            logger.debug(f'Selected "{url}" ({latency * 1000:.0f}ms)')
+            server = PlexServer(url, resource.accessToken, session=get_session())
+            return Connection(server, url, resource.accessToken)
+    except (requests.RequestException, BadRequest, Unauthorized, NotFound) as e:
+        logger.exception(f'Failed to connect to server "{identifier}"')
+        return None
+
+    logger.error(f'Server "{identifier}" is unavailable')
+    return None
+
+
+#: Plex metadata type numbers used to filter library queries
+PLEX_TYPES = {'movie': 1, 'show': 2, 'season': 3, 'episode': 4}
+
+#: Number of items requested per library page
+CONTAINER_SIZE = 500
+
+#: Lightweight record of a library item, as yielded by :func:`walk`.
+#: Episodes carry their :class:`mesh.matching.Episode`, None otherwise
+LibraryItem = namedtuple('LibraryItem', ['media', 'rating_key', 'guids',
+                                         'view_count', 'last_viewed_at',
+                                         'user_rating', 'last_rated_at',
+                                         'episode'], defaults=(None,))
+
+#: A watched Plex item with its normalized guids and last view time
+Play = namedtuple('Play', ['media', 'guids', 'watched_at', 'episode'],
+                  defaults=(None,))
+
+
+def item_guids(item):
+    """Returns the normalized guids of a plexapi media item
+
+    :param item: Plex media item
+    :rtype: :class:`~python:list` [ :class:`~python:str` ]
+    """
+
+    guids = [item.guid] + [g.id for g in getattr(item, 'guids', [])]
+    return [g for g in map(normalize_guid, guids) if g is not None]
+
+
+def _timestamp(value):
+    """Returns an aware datetime from a Plex epoch attribute or None"""
+
+    if value is None:
+        return None
+    return datetime.fromtimestamp(int(value), timezone.utc)
+
+
+def _episode(attrs, shows=None):
+    """Returns the :class:`mesh.matching.Episode` of an episode element
+
+    :param shows: Normalized guids of shows by rating key, the show's
+                  Plex guid is used for shows missing from it
+    """
+
+    if 'parentIndex' not in attrs or 'index' not in attrs:
+        return None
+
+    show = (shows or {}).get(int(attrs.get('grandparentRatingKey', 0)))
+    if show is None:
+        show = [g for g in [normalize_guid(attrs.get('grandparentGuid', ''))]
+                if g is not None]
+    return Episode(show, int(attrs['parentIndex']), int(attrs['index']))
+
+
+def _record(media, element, shows=None):
+    """Returns a :class:`LibraryItem` from a library XML element
+
+    :param shows: See :func:`_episode`
+    """
+
+    attrs = element.attrib
+    guids = [attrs.get('guid', '')] + [g.attrib['id'] for g in element.findall('Guid')]
+    user_rating = attrs.get('userRating')
+
+    return LibraryItem(
+        media,
+        int(attrs['ratingKey']),
+        [g for g in map(normalize_guid, guids) if g is not None],
+        int(attrs.get('viewCount', 0)),
+        _timestamp(attrs.get('lastViewedAt')),
+        float(user_rating) if user_rating is not None else None,
+        _timestamp(attrs.get('lastRatedAt')),
+        _episode(attrs, shows) if media == 'episode' else None
+    )
+
+
+def walk_section(server, key, media, filters=None,
+                 container_size=CONTAINER_SIZE, shows=None):
+    """Yields all items of a media type in a library section
+
+    The section is paged through with ``X-Plex-Container-Start`` and
+    ``X-Plex-Container-Size`` and each XML element is reduced to a
+    :class:`LibraryItem` straight away, so only a single page is held in
+    memory regardless of the library size.
+
+    :param server: The connected server
+    :param key: Library section key
+    :param media: Key in :data:`PLEX_TYPES`
+    :param filters: Additional Plex filter arguments,
+                    e.g. ``{'viewCount>>': 0}``
+    :param container_size: Number of items per page
+    :param shows: Normalized guids of the section's shows by rating key,
+                  used to match episodes through their show
+    :rtype: :class:`LibraryItem`
+    """
+
+    args = {'type': PLEX_TYPES[media], 'includeGuids': 1, **(filters or {})}
+    path = f'/library/sections/{key}/all{joinArgs(args)}'
+
+    start = 0
+    while True:
+        headers = {'X-Plex-Container-Start': str(start),
+                   'X-Plex-Container-Size': str(container_size)}
+        container = server.query(path, headers=headers)
+        if container is None:
+            return
+
+        elements = list(container)
+        for element in elements:
+            yield _record(media, element, shows)
+
+        start += len(elements)
+        total = int(container.attrib.get('totalSize', start))
+        if not elements or start >= total:
+            return
+
+
+def walk(server, filters=None, container_size=CONTAINER_SIZE):
+    """Yields all movies and episodes in the server's libraries
+
+    The shows of a section are listed before its episodes, so episodes
+    carry the guids of their show. See :func:`walk_section` for the
+    arguments.
+
+    :rtype: :class:`LibraryItem`
+    """
+
+    for section in server.library.sections():
+        if section.type == 'movie':
+            yield from walk_section(server, section.key, 'movie', filters,
+                                    container_size)
+        elif section.type == 'show':
+            shows = {item.rating_key: item.guids for item in walk_section(
+                server, section.key, 'show', container_size=container_size)}
+            yield from walk_section(server, section.key, 'episode', filters,
+                                    container_size, shows)
+
+
+def recently_watched(server, since):
+    """Yields the movies and episodes watched after *since*
+
+    The view state is that of the account whose token was used to connect
+    to the server.
+
+    :param server: The connected server
+    :param since: Only items last viewed after this are returned
+    :type server: :class:`~plexapi.server.PlexServer`
+    :type since: :class:`~python:datetime.datetime`
+    :rtype: :class:`Play`
+    """
+
+    filters = {'viewCount>>': 0}
+    if since.year > 1:
+        filters['lastViewedAt>>'] = int(since.timestamp())
+
+    for item in walk(server, filters):
+        if item.last_viewed_at is not None:
+            yield Play(item.media, item.guids, item.last_viewed_at,
+                       item.episode)
 
 
 # Format ready authorization url
@@ -52,8 +343,8 @@ AUTH_URL = f'https://app.plex.tv/auth#?' \
               'clientID={client_id}&' \
               'code={code}'
 
-# Pin Url
-PIN_URL = 'https://plex.tv/api/v2/pins'
+#: Base url of the plex.tv API
+PLEX_TV_URL = 'https://plex.tv'
 
 AUTH_HEADERS = ('X-Plex-Product', 'X-Plex-Platform', 'X-Plex-Device', 'X-Plex-Client-Identifier')
 
@@ -77,46 +368,52 @@ def oauth():
 
     https://github.com/tidusjar/Ombi/issues/2894#issuecomment-477404691
 
+    Yields the url where the user authorizes Mesh, then the username and
+    token once resumed, or None if the authorization failed.
+
     :return: Plex token for the authenticated user
     :rtype: Str or None
     """
 
     headers = build_auth_headers()
-    with requests.session() as session:
-        # headers['X-Plex-Client-Identifier'] = 'kjh123192783y123hj'
-        # headers['X-Plex-Product'] = 'Mesh'
-        # headers['X-Plex-Device'] = 'Mesh (Web)'
-        # headers['X-Plex-Platform'] = 'Web'
-        response = session.post('https://plex.tv/api/v2/pins.json',
-                                headers=headers,
-                                params={'strong': True})
-
-        if response.status_code != requests.codes.created:
-            logger.debug('Failed to create authentication for client')
-            return None
+    session = get_session()
+    response = session.post(f'{PLEX_TV_URL}/api/v2/pins.json',
+                            headers=headers,
+                            params={'strong': True})
+
+    if response.status_code != requests.codes.created:
+        logger.debug('Failed to create authentication for client')
+        return None
+
+    data = response.json()
+    url = AUTH_URL.format(
+        product=headers['X-Plex-Product'],
+        platform=headers['X-Plex-Platform'],
+        client_id=headers['X-Plex-Client-Identifier'],
+        code=data['code']
+    )
+
+    yield url
+    response = session.get(f'{PLEX_TV_URL}/api/v2/pins/{data["id"]}.json',
+                           headers=headers)
+    if response.status_code != requests.codes.ok:
+        logger.warning(f'Failed to retrieve authentication token '
+                       f'(status code: {response.status_code})')
+        yield None
+        return
+
+    token = response.json().get('authToken')
+    if token is None:
+        logger.warning('Failed to retrieve authentication token. '
+                       'Token entry empty')
+        yield None
+        return
+
+    response = session.get(f'{PLEX_TV_URL}/users/account.json',
+                           headers={'X-Plex-Token': token})
+    if response.status_code != requests.codes.ok:
+        logger.warning('Failed to retrieve username')
+        yield None
+        return
 
-        data = response.json()
-        url = AUTH_URL.format(
-            product=headers['X-Plex-Product'],
-            platform=headers['X-Plex-Platform'],
-            client_id=headers['X-Plex-Client-Identifier'],
-            code=data['code']
-        )
-
-        yield url
-        response = session.get(PIN_URL + '/' + str(data["id"]) + '.json', headers=headers)
-        if response.status_code != requests.codes.ok:
-            logger.warning('Failed to retrieve authentication token (status code: {code})'.format(response.status_code))
-            yield None
-
-        token = response.json().get('authToken')
-        if token is None:
-            logger.warning('Failed to retrieve authentication token. Token entry empty')
-            yield None
-
-        response = session.get('https://plex.tv/users/account.json', headers={'X-Plex-Token': token})
-        if response.status_code != requests.codes.ok:
-            logger.warning('Failed to retrieve username')
-            yield None
-
-        yield response.json()['user']['username'], token
+    yield response.json()['user']['username'], token
@@ -1 +1,158 @@
 """This module contains methods for Plex to Trakt scrobbling"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from plexapi.exceptions import NotFound
+
+from mesh import api, metrics
+from mesh.plex import item_guids
+from mesh.tokens import get_tokens
+
+logger = logging.getLogger(__name__)
+
+#: Trakt scrobble action for each Plex playback state
+ACTIONS = {
+    'playing': 'start',
+    'paused': 'pause',
+    'stopped': 'stop'
+}
+
+#: Playback session being scrobbled
+Session = namedtuple('Session', ['user', 'media', 'trakt', 'duration'])
+
+
+def progress(view_offset, duration):
+    """Returns the playback progress in percent, as expected by Trakt"""
+
+    if not duration:
+        return 0
+    return round(min(100, max(0, 100 * view_offset / duration)), 2)
+
+
+class Scrobbler:
+    """Scrobbles plays on a Plex server to Trakt as they happen
+
+    Subscribes to the server's notification websocket and translates the
+    playing, paused and stopped states of playback sessions into Trakt
+    ``scrobble/start``, ``scrobble/pause`` and ``scrobble/stop`` calls.
+    Plex repeats the state of active sessions every few seconds, only
+    state changes are sent to Trakt.
+
+    The server must be connected with the owner's token to receive the
+    notifications of all users. Requires ``websocket-client``.
+
+    :param server: The connected server
+    :param users: The users to scrobble for, plays by other accounts
+                  are ignored
+    :param index: Index used to match Plex items with Trakt items
+    :type server: :class:`~plexapi.server.PlexServer`
+    :type users: :class:`~python:list` [ :class:`mesh.user.User` ]
+    :type index: :class:`mesh.matching.IdIndex`
+    """
+
+    def __init__(self, server, users, index):
+        self.server = server
+        self.users = {u.name: u for u in users}
+        self.index = index
+
+        self._sessions = {}
+        self._states = {}
+        self._listener = None
+        # A single worker keeps the calls of each session in order
+        self._executor = ThreadPoolExecutor(1)
+
+    def start(self):
+        """Starts listening for notifications"""
+        self._listener = self.server.startAlertListener(self._on_alert,
+                                                        self._on_error)
+
+    def stop(self):
+        """Stops listening and waits for pending scrobbles"""
+
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._executor.shutdown(wait=True)
+
+    def _on_error(self, error):
+        logger.error(f'Notification listener failed: {error}')
+
+    def _on_alert(self, data):
+        if data.get('type') != 'playing':
+            return
+
+        for notification in data.get('PlaySessionStateNotification', []):
+            key = notification.get('sessionKey')
+            state = notification.get('state')
+            if state not in ACTIONS or self._states.get(key) == state:
+                continue
+
+            # Plex reuses the keys of stopped sessions
+            if state == 'stopped':
+                self._states.pop(key, None)
+            else:
+                self._states[key] = state
+            try:
+                self._executor.submit(self._scrobble, notification)
+            except Exception:
+                logger.exception('Failed to queue scrobble')
+
+    def _session(self, notification):
+        """Returns the :class:`Session` of a notification or None"""
+
+        key = notification['sessionKey']
+        if key in self._sessions:
+            return self._sessions[key]
+
+        username = next((s.usernames[0] for s in self.server.sessions()
+                         if str(s.sessionKey) == str(key) and s.usernames),
+                        None)
+        user = self.users.get(username)
+        if user is None:
+            return None
+
+        with metrics.phase('match', 1):
+            try:
+                item = self.server.fetchItem(int(notification['ratingKey']))
+            except NotFound:
+                return None
+            if item.type not in ('movie', 'episode'):
+                return None
+
+            trakt = self.index.resolve(item.type, item_guids(item))
+        if trakt is None:
+            logger.info(f'Unable to match "{item.title}" with Trakt')
+            return None
+
+        session = Session(user, item.type, trakt, item.duration)
+        self._sessions[key] = session
+        return session
+
+    @metrics.mode('scrobble')
+    def _scrobble(self, notification):
+        """Sends the Trakt scrobble call for a state change"""
+
+        state = notification['state']
+        try:
+            session = self._session(notification)
+            if state == 'stopped':
+                self._sessions.pop(notification['sessionKey'], None)
+            if session is None:
+                return
+
+            data = {
+                session.media: {'ids': {'trakt': session.trakt}},
+                'progress': progress(notification.get('viewOffset', 0),
+                                     session.duration)
+            }
+            user = session.user
+            with get_tokens().authorized(user), metrics.phase('apply', 1):
+                api.post(f'scrobble/{ACTIONS[state]}', data)
+            metrics.registry.inc('mesh_scrobbles_total',
+                                 action=ACTIONS[state])
+            logger.debug(f'Scrobbled {state} for user "{user.name}"')
+        except Exception:
+            # Errors of executor tasks are otherwise silently discarded
+            logger.exception('Failed to scrobble')
@@ -0,0 +1,126 @@
+"""This module contains the worker pools of the synchronized Plex servers
+
+An event synchronizes a user with every configured server. The work on
+each server runs on that server's own bounded pool of threads, sized to
+what the server can handle, so a slow or small server never holds up the
+others and is never sent more concurrent requests than it allows.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from mesh import metrics
+
+logger = logging.getLogger(__name__)
+
+#: A Plex server to synchronize. *token* is the owner's access token and
+#: *workers* the maximum number of concurrent events on the server, where
+#: 0 uses the default of the :class:`ServerPools`
+Server = namedtuple('Server', ['name', 'identifier', 'token', 'workers'],
+                    defaults=('', 0))
+
+
+class ServerPools:
+    """Bounded worker pools, one per Plex server
+
+    Pools are started on first use. A single server without its own
+    number of workers runs its work on the calling thread instead.
+
+    :param servers: The servers, or their identifiers
+    :param workers: Size of the pools of servers without their own
+    :type servers: :class:`~python:list` [ :class:`Server` or
+                   :class:`~python:str` ]
+    :type workers: :class:`~python:int`
+    """
+
+    def __init__(self, servers, workers=4):
+        self.servers = [s if isinstance(s, Server) else Server(s, s)
+                        for s in servers]
+        if not self.servers:
+            raise ValueError('At least one server is required')
+        self.workers = workers
+
+        #: Url and server token used to connect to the servers other than
+        #: the first, keyed by username and server identifier. Those of the
+        #: first server are stored in :attr:`mesh.user.User.url` and
+        #: :attr:`mesh.user.User.server_token`
+        self.connections = {}
+
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.servers)
+
+    @property
+    def identifiers(self):
+        """Identifiers of the servers, the primary server first"""
+        return [s.identifier for s in self.servers]
+
+    def size(self, server):
+        """Returns the number of workers of *server*"""
+        return server.workers or self.workers
+
+    def _pool(self, server):
+        with self._lock:
+            pool = self._pools.get(server.identifier)
+            if pool is None:
+                pool = self._pools[server.identifier] = ThreadPoolExecutor(
+                    self.size(server), f'plex-{server.name}')
+            return pool
+
+    def map(self, function, *args):
+        """Calls ``function(identifier, *args)`` for each server
+
+        The calls run concurrently on the servers' pools and in the
+        :func:`mesh.metrics.mode` of the caller. All calls complete before
+        the first exception, if any, is raised.
+
+        :return: The result of each call, in the order of the servers
+        :rtype: :class:`~python:list`
+        """
+
+        if len(self.servers) == 1 and not self.servers[0].workers:
+            return [function(self.servers[0].identifier, *args)]
+
+        mode = metrics.current_mode()
+
+        def call(identifier):
+            with metrics.mode(mode):
+                return function(identifier, *args)
+
+        futures = [self._pool(s).submit(call, s.identifier)
+                   for s in self.servers]
+        errors = [f.exception() for f in futures]
+        for server, error in zip(self.servers, errors):
+            if error is not None:
+                logger.debug(f'Work on "{server.name}" failed: {error}')
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+        return [f.result() for f in futures]
+
+    def configure(self, workers):
+        """Changes the default pool size
+
+        Pools of servers without their own size are replaced, running
+        work finishes on the old pools.
+        """
+
+        with self._lock:
+            self.workers = workers
+            for server in self.servers:
+                if not server.workers:
+                    pool = self._pools.pop(server.identifier, None)
+                    if pool is not None:
+                        pool.shutdown(wait=False)
+
+    def shutdown(self):
+        """Stops the pools once their running work finishes"""
+
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.shutdown(wait=True)
@@ -0,0 +1,137 @@
+"""This module contains the HTTP session shared by all Plex and Trakt calls
+
+Reusing one session keeps connections alive between requests, so the TCP
+and TLS handshakes are only paid once per pooled connection rather than
+once per request.
+"""
+
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from trakt import Trakt
+from urllib3.util.retry import Retry
+
+from mesh import metrics
+from mesh.constants import (SESSION_BACKOFF, SESSION_POOL_HOSTS,
+                            SESSION_POOL_SIZE, SESSION_RETRIES,
+                            SESSION_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+#: Maximum number of kept alive connections per host
+POOL_SIZE = SESSION_POOL_SIZE
+
+#: Number of hosts with their own connection pool
+POOL_HOSTS = SESSION_POOL_HOSTS
+
+#: Seconds before a request times out
+TIMEOUT = SESSION_TIMEOUT
+
+#: Number of retries of failed idempotent requests
+RETRIES = SESSION_RETRIES
+
+#: Backoff factor between retries, see :class:`~urllib3.util.retry.Retry`
+BACKOFF = SESSION_BACKOFF
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter applying a default timeout to all requests
+
+    :param timeout: Seconds before a request without timeout times out
+    """
+
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def _record(response, *args, **kwargs):
+    """Response hook recording Plex requests in :mod:`mesh.metrics`
+
+    Trakt requests are recorded by :func:`mesh.api.request`, the Trakt
+    client sends prepared requests which bypass the session's hooks.
+    """
+
+    url = urlsplit(response.request.url)
+    if url.netloc == urlsplit(Trakt.base_url).netloc:
+        return
+
+    service = 'plex.tv' if url.netloc.endswith('plex.tv') else 'plex'
+    metrics.record_request(service, response.request.method, url.path,
+                           response.status_code,
+                           response.elapsed.total_seconds())
+
+
+def build_session(pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS,
+                  timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    """Returns a new session with pooled, kept alive connections
+
+    Connection errors and 502, 503 and 504 responses are retried for
+    idempotent methods only, so writes such as scrobbles are never
+    repeated. Plex responses are recorded in :mod:`mesh.metrics`.
+
+    :param pool_size: Maximum number of connections kept per host
+    :param pool_hosts: Number of hosts with their own connection pool
+    :param timeout: Seconds before a request times out
+    :param retries: Number of retries of failed requests
+    :param backoff: Backoff factor between retries
+    :rtype: :class:`~requests.Session`
+    """
+
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(502, 503, 504),
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(timeout,
+                                 pool_connections=pool_hosts,
+                                 pool_maxsize=pool_size,
+                                 max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(_record)
+    return session
+
+
+def configure(**settings):
+    """Replaces the shared session and installs it in the Trakt client
+
+    Keyword arguments are passed on to :func:`build_session`. Plex calls
+    pick the session up through :func:`get_session`.
+
+    :rtype: :class:`~requests.Session`
+    """
+
+    global _session
+
+    with _lock:
+        _session = build_session(**settings)
+        Trakt.http.session = _session
+        Trakt.configuration.defaults.http(
+            timeout=settings.get('timeout', TIMEOUT))
+    logger.debug(f'Configured shared HTTP session {settings}')
+    return _session
+
+
+def get_session():
+    """Returns the shared session, configuring it with defaults if needed"""
+
+    if _session is None:
+        return configure()
+    return _session
+
+
+_lock = threading.Lock()
+
+#: The shared :class:`~requests.Session`.
+#: Should **always** be used for HTTP requests, see :func:`get_session`.
+_session = None
@@ -1 +1,1243 @@
 """This module contains the synchronization routines"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timezone
+from itertools import chain
+import logging
+import queue
+import threading
+import time
+
+from plexapi.exceptions import BadRequest, NotFound
+from trakt import Trakt
+
+from mesh import api, metrics
+from mesh.constants import SYNC_BATCH_SIZE
+from mesh.exceptions import RateLimitExceeded, SynchronizationError
+from mesh.helpers import (ISO8601_str_from_epoch, chunked, deep_sizeof,
+                          datetime_from_ISO8601_str, datetime_to_ISO8601_str,
+                          epoch_from_ISO8601_str, epochs_from_ISO8601_strs)
+from mesh.history import History
+from mesh.journal import JournalEntry, get_journal
+from mesh.matching import get_index, normalize_guid
+from mesh.outbox import get_outbox
+from mesh.plex import account, connect, recently_watched, walk
+from mesh.servers import ServerPools
+from mesh.tokens import EXPIRY_MARGIN, expires_within, get_tokens
+
+logger = logging.getLogger(__name__)
+
+#: Default number of items sent per ``sync/history`` request
+BATCH_SIZE = SYNC_BATCH_SIZE
+
+#: Smallest batch size used after repeated rate limiting
+MIN_BATCH_SIZE = 50
+
+#: Number of times a batch is sent before the push is aborted
+MAX_ATTEMPTS = 5
+
+#: Seconds before a failed batch is first retried, doubled on each attempt
+RETRY_DELAY = 1
+
+#: Number of batches buffered between the stages of a pipeline
+PIPELINE_DEPTH = 2
+
+#: The last activity fields which reveal a change in each pulled category,
+#: keyed by category and Trakt media type
+PULL_ACTIVITIES = {
+    'history': {'movies': 'watched_at', 'episodes': 'watched_at'},
+    'ratings': {'movies': 'rated_at', 'shows': 'rated_at',
+                'episodes': 'rated_at'},
+    'watchlist': {'movies': 'watchlisted_at', 'shows': 'watchlisted_at'}
+}
+
+#: The item field holding the time of the change in each pulled category
+PULL_TIMESTAMPS = {
+    'history': 'watched_at',
+    'ratings': 'rated_at',
+    'watchlist': 'listed_at'
+}
+
+
+#: Changes of an item on one side since the last sync. Times are in
+#: seconds since the epoch, None fields are unchanged
+Observation = namedtuple('Observation', ['watched_at', 'rating', 'rated_at'],
+                         defaults=(None, None, None))
+
+
+@dataclass
+class Delta:
+    """Changes pulled from Trakt since a user's last pull
+
+    :param watermark: Time of the most recent Trakt activity covered
+    :param history: Watch history entries
+    :param ratings: Rating entries
+    :param watchlist: Watchlist entries
+    """
+
+    watermark: object
+    history: list = field(default_factory=list)
+    ratings: list = field(default_factory=list)
+    watchlist: list = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.history) + len(self.ratings) + len(self.watchlist)
+
+
+def changed_categories(activities, since):
+    """Returns the categories and media types changed after *since*
+
+    :param activities: Response from Trakt's ``sync/last_activities``
+    :param since: The time of the last pull
+    :type activities: :class:`~python:dict`
+    :type since: :class:`~python:datetime.datetime`
+    :return: Changed media types per category, and the time of the most
+             recent activity (never earlier than *since*)
+    :rtype: :class:`~python:tuple` [ :class:`~python:dict`,
+            :class:`~python:datetime.datetime` ]
+    """
+
+    changes = {}
+    watermark = since
+    for category, fields in PULL_ACTIVITIES.items():
+        for media, key in fields.items():
+            timestamp = activities.get(media, {}).get(key)
+            if timestamp is None:
+                continue
+
+            timestamp = datetime_from_ISO8601_str(timestamp)
+            watermark = max(watermark, timestamp)
+            if timestamp > since:
+                changes.setdefault(category, []).append(media)
+    return changes, watermark
+
+
+def changed_since(items, category, since):
+    """Returns the items of *category* that changed after *since*"""
+
+    key = PULL_TIMESTAMPS[category]
+    # Times are compared in whole seconds, items within the second of
+    # *since* are kept since applying them again is harmless
+    since = int(since.timestamp())
+    epochs = epochs_from_ISO8601_strs([i[key] for i in items])
+    return [i for i, epoch in zip(items, epochs) if epoch >= since]
+
+
+def fetch_delta(user, since, categories=tuple(PULL_ACTIVITIES)):
+    """Fetches the Trakt changes made after *since*
+
+    The last activities of the user are compared against *since* so that
+    categories without changes are skipped entirely. History is filtered
+    server side, while ratings and watchlist entries are filtered by
+    their timestamps.
+
+    :param user: The user to fetch for
+    :param since: Only changes made after this are fetched
+    :param categories: Keys in :data:`PULL_ACTIVITIES` to fetch
+    :type user: :class:`mesh.user.User`
+    :type since: :class:`~python:datetime.datetime`
+    :rtype: :class:`Delta`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if a request fails
+    """
+
+    with get_tokens().authorized(user), \
+            metrics.phase('fetch') as phase:
+        activities = api.get('sync/last_activities').json()
+        changes, watermark = changed_categories(activities, since)
+        delta = Delta(watermark)
+
+        query = {}
+        if since.year > 1:
+            query['start_at'] = datetime_to_ISO8601_str(since)
+        if 'history' in categories:
+            for media in changes.get('history', []):
+                delta.history.extend(api.fetch(f'sync/history/{media}', query))
+
+        for category in ('ratings', 'watchlist'):
+            if category not in categories:
+                continue
+            for media in changes.get(category, []):
+                items = api.fetch(f'sync/{category}/{media}')
+                getattr(delta, category).extend(
+                    changed_since(items, category, since))
+        phase.items = len(delta)
+
+    logger.info(f'Fetched {len(delta)} changes for user "{user.name}"')
+    return delta
+
+
+def pull_delta(user):
+    """Fetches the Trakt changes made after the user's last pull
+
+    See :func:`fetch_delta`.
+
+    :param user: The user to pull for
+    :type user: :class:`mesh.user.User`
+    :rtype: :class:`Delta`
+    """
+
+    return fetch_delta(user, user.last_pull)
+
+
+def _guids(ids):
+    """Returns the Plex guids for a Trakt ids dict"""
+    return [f'{agent}://{ids[agent]}' for agent in ('imdb', 'tmdb', 'tvdb')
+            if ids.get(agent)]
+
+
+def _find(sections, media, ids, index):
+    """Returns the Plex movie or show with matching Trakt ids or None
+
+    A Plex guid previously mapped to the Trakt id is tried first, since
+    looking up external guids requires the server to query its agent.
+    """
+
+    candidates = _guids(ids)
+    known = index.guid(media, ids['trakt'])
+    if known is not None:
+        candidates.insert(0, known)
+
+    for section in sections:
+        if section.type != media:
+            continue
+
+        for guid in candidates:
+            try:
+                item = section.getGuid(guid)
+            except NotFound:
+                continue
+
+            if guid != known:
+                guids = _guids(ids) + [normalize_guid(item.guid)]
+                index.add(media, [g for g in guids if g], ids['trakt'])
+            return item
+    return None
+
+
+def _locate(sections, entry, index):
+    """Returns the Plex item matching the Trakt *entry* or None"""
+
+    media = entry['type']
+    parent_media = 'movie' if media == 'movie' else 'show'
+    item = _find(sections, parent_media, entry[parent_media]['ids'], index)
+    if item is None or media != 'episode':
+        return item
+
+    episode = entry['episode']
+    try:
+        return item.episode(season=episode['season'],
+                            episode=episode['number'])
+    except NotFound:
+        return None
+
+
+def apply_delta(server, user, delta, index, watchlist=True):
+    """Applies pulled Trakt changes to the Plex server
+
+    :param server: Server connected with the user's token
+    :param user: The user the delta belongs to
+    :param delta: The changes to apply
+    :param index: Index used to match Trakt items with Plex items
+    :param watchlist: Whether to apply the watchlist changes, which
+                      belong to the Plex account rather than the server
+    :type server: :class:`~plexapi.server.PlexServer`
+    :type user: :class:`mesh.user.User`
+    :type delta: :class:`Delta`
+    :type index: :class:`mesh.matching.IdIndex`
+    """
+
+    sections = server.library.sections()
+
+    for entry in delta.history:
+        with metrics.phase('match', 1):
+            item = _locate(sections, entry, index)
+        if item is not None and not item.isPlayed:
+            with metrics.phase('apply', 1):
+                item.markPlayed()
+
+    for entry in delta.ratings:
+        with metrics.phase('match', 1):
+            item = _locate(sections, entry, index)
+        if item is not None:
+            with metrics.phase('apply', 1):
+                item.rate(float(entry['rating']))
+
+    if watchlist and delta.watchlist:
+        plex_acc = account(user.token)
+        for entry in delta.watchlist:
+            with metrics.phase('match', 1):
+                item = _locate(sections, entry, index)
+            if item is None:
+                continue
+            try:
+                with metrics.phase('apply', 1):
+                    plex_acc.addToWatchlist(item)
+            except BadRequest:
+                logger.debug(f'"{item.title}" is already on the watchlist')
+
+
+def _pools(servers):
+    """Returns *servers* as :class:`mesh.servers.ServerPools`
+
+    :param servers: Plex server identifier or the pools of several servers
+    """
+
+    if isinstance(servers, ServerPools):
+        return servers
+    return ServerPools([servers])
+
+
+def _connect(user, identifier, servers=None):
+    """Connects to the server as the user and caches the connection used
+
+    The url and server token of the first of *servers* are cached in the
+    user, those of the other servers in *servers*.
+
+    :raises: :class:`mesh.exceptions.SynchronizationError` if the server
+             can not be reached
+    """
+
+    primary = servers is None or identifier == servers.identifiers[0]
+    if primary:
+        url, url_token = user.url, user.server_token
+    else:
+        url, url_token = servers.connections.get((user.name, identifier),
+                                                 ('', ''))
+    connection = connect(identifier, user.token, url, url_token)
+    if connection is None:
+        raise SynchronizationError(f'Unable to connect to "{identifier}"')
+    if primary:
+        user.url, user.server_token = connection.url, connection.token
+    else:
+        servers.connections[(user.name, identifier)] = (connection.url,
+                                                        connection.token)
+    return connection.server
+
+
+@metrics.mode('pull')
+def pull(user, identifier):
+    """Pulls the user's Trakt changes into the Plex servers
+
+    Only changes made after :attr:`mesh.user.User.last_pull` are fetched.
+    The changes are fetched once and applied to every server. On success
+    the user's last pull is advanced to the time of the most recent Trakt
+    activity.
+
+    :param user: The user to pull for
+    :param identifier: Plex server identifier, or the pools of the servers
+    :type user: :class:`mesh.user.User`
+    :type identifier: :class:`~python:str` or
+                      :class:`mesh.servers.ServerPools`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if Trakt or
+             a Plex server can not be reached
+    """
+
+    delta = pull_delta(user)
+    if delta:
+        servers = _pools(identifier)
+        index = get_index()
+
+        def apply(identifier):
+            server = _connect(user, identifier, servers)
+            apply_delta(server, user, delta, index,
+                        watchlist=identifier == servers.identifiers[0])
+        servers.map(apply)
+    user.last_pull = delta.watermark
+
+
+#: Marks the end of the values passed between pipeline stages
+_END = object()
+
+
+def pipeline(source, *stages, depth=PIPELINE_DEPTH):
+    """Yields the values of *source* passed through each of *stages*
+
+    *source* is iterated and each stage is called on a thread of its own,
+    connected by queues holding up to *depth* values. Each stage works on
+    the next value while the stages after it handle the previous ones,
+    e.g. plays are matched while the next page is fetched from Plex and
+    the previous batch is sent to Trakt by the caller. A slow stage holds
+    back the stages before it, so values never pile up in memory.
+
+    Values keep their order and the threads run in the
+    :func:`mesh.metrics.mode` of the caller. The first exception raised
+    by *source* or a stage is raised to the caller. The threads stop once
+    the caller stops iterating.
+
+    :param source: Iterable of the values, e.g. batches of plays
+    :param stages: Functions each called with the result of the previous
+    :param depth: Maximum number of values waiting for each stage
+    """
+
+    mode = metrics.current_mode()
+    stopped = threading.Event()
+    queues = [queue.Queue(depth) for _ in range(len(stages) + 1)]
+
+    def put(target, value, error=None):
+        while not stopped.is_set():
+            try:
+                target.put((value, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(inbox):
+        while not stopped.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END, None
+
+    def produce():
+        with metrics.mode(mode):
+            try:
+                for value in source:
+                    if not put(queues[0], value):
+                        return
+            except Exception as e:
+                put(queues[0], _END, e)
+            else:
+                put(queues[0], _END)
+
+    def work(stage, inbox, outbox):
+        with metrics.mode(mode):
+            while True:
+                value, error = get(inbox)
+                if value is _END:
+                    put(outbox, _END, error)
+                    return
+                try:
+                    value = stage(value)
+                except Exception as e:
+                    put(outbox, _END, e)
+                    return
+                if not put(outbox, value):
+                    return
+
+    threads = [threading.Thread(target=produce, daemon=True, name='pipeline')]
+    for stage, inbox, outbox in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=work, args=(stage, inbox, outbox),
+                                        daemon=True, name='pipeline'))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            value, error = queues[-1].get()
+            if error is not None:
+                raise error
+            if value is _END:
+                return
+            yield value
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+
+def _payload(batch, field='watched_at'):
+    """Returns a sync request body for (media, id, value) items
+
+    Each value is sent as *field*, or left out if *field* is None.
+    """
+
+    payload = {}
+    for media, trakt, value in batch:
+        item = {'ids': {'trakt': trakt}}
+        if field is not None:
+            item[field] = value
+        payload.setdefault(f'{media}s', []).append(item)
+    return payload
+
+
+def _not_found(batch, result):
+    """Returns the items of *batch* listed as not found in *result*"""
+
+    missing = {(media[:-1], i['ids'].get('trakt'))
+               for media, items in result.get('not_found', {}).items()
+               for i in items}
+    return [item for item in batch if item[:2] in missing]
+
+
+def send_batches(path, items, batch_size=BATCH_SIZE, field='watched_at',
+                 on_sent=None):
+    """Sends items to a Trakt sync endpoint in adaptively sized batches
+
+    A rate limited batch is retried once the rate limit allows it, and
+    the batch size is halved (down to :data:`MIN_BATCH_SIZE`). Each
+    successful batch doubles it again, up to *batch_size*. Rate limited
+    batches do not count as failed attempts. Items Trakt reports as not
+    found are collected rather than resent.
+
+    :param path: Trakt sync endpoint, e.g. ``sync/history``
+    :param items: Tuples of media type, Trakt id and value
+    :param batch_size: Maximum number of items per request
+    :param field: Name of the value in the request, e.g. ``rating``
+    :param on_sent: Called with each batch once Trakt accepted it
+    :return: The items Trakt could not find
+    :rtype: :class:`~python:list`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if a batch
+             fails :data:`MAX_ATTEMPTS` times
+    """
+
+    not_found = []
+    size = batch_size
+    attempts = 0
+    start = 0
+    while start < len(items):
+        batch = items[start:start + size]
+        try:
+            response = api.post(path, _payload(batch, field))
+        except RateLimitExceeded as e:
+            # The write limiter is paused for e.retry_after, see
+            # api.check_response, so the retry waits for it
+            size = max(MIN_BATCH_SIZE, size // 2)
+            logger.info(f'Rate limited for {e.retry_after:.1f}s, '
+                        f'reducing batch size to {size}')
+        except SynchronizationError:
+            attempts += 1
+            if attempts < MAX_ATTEMPTS:
+                time.sleep(RETRY_DELAY * 2 ** (attempts - 1))
+        else:
+            attempts = 0
+            not_found.extend(_not_found(batch, response.json()))
+            if on_sent is not None:
+                on_sent(batch)
+            start += len(batch)
+            size = min(batch_size, size * 2)
+
+        if attempts >= MAX_ATTEMPTS:
+            raise SynchronizationError(f'Giving up on "{path}" after '
+                                       f'{attempts} attempts')
+    return not_found
+
+
+def flush(username, path=None, batch_size=BATCH_SIZE):
+    """Sends the user's pending writes from the outbox
+
+    Writes are sent in the order they were enqueued and each batch is
+    acknowledged as soon as Trakt accepted it, so an interrupted flush
+    resumes after the last accepted batch. See :class:`mesh.outbox.Outbox`.
+
+    :param username: Name of the user
+    :param path: Only send the writes to this endpoint
+    :param batch_size: Maximum number of items per request
+    :return: The items Trakt could not find
+    :rtype: :class:`~python:list`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if a batch
+             fails :data:`MAX_ATTEMPTS` times
+    """
+
+    outbox = get_outbox()
+    groups = {}
+    for entry in outbox.pending(username, path):
+        groups.setdefault((entry.path, entry.field), []).append(entry)
+
+    not_found = []
+    for (path, field), entries in groups.items():
+        acknowledged = 0
+
+        def sent(batch):
+            nonlocal acknowledged
+            outbox.acknowledge(e.id for e in
+                               entries[acknowledged:acknowledged + len(batch)])
+            acknowledged += len(batch)
+
+        items = [(e.media, e.trakt, e.value) for e in entries]
+        not_found.extend(send_batches(path, items, batch_size, field, sent))
+    return not_found
+
+
+def deliver(username, path, items, batch_size=BATCH_SIZE, field='watched_at'):
+    """Enqueues writes in the user's outbox and sends them
+
+    Pending writes to *path* left by an interrupted run are sent first,
+    see :func:`flush`. The arguments are those of :func:`send_batches`.
+
+    :param username: Name of the user
+    :return: The items Trakt could not find
+    :rtype: :class:`~python:list`
+    """
+
+    get_outbox().enqueue(username, path, items, field)
+    return flush(username, path, batch_size)
+
+
+def prepare_plays(plays, index, history=None):
+    """Matches plays with Trakt items, see :func:`push_plays`
+
+    :return: The matched plays keyed by the Trakt media type, id and
+             watch time to send, and the number of unmatched plays
+    :rtype: :class:`~python:tuple` [ :class:`~python:dict`,
+            :class:`~python:int` ]
+    """
+
+    resolved = _resolve_plays(plays, index)
+    unmatched = len(plays) - len(resolved)
+    if history is not None:
+        with metrics.phase('diff', len(resolved)):
+            pending = History((m, i, epoch_from_ISO8601_str(w))
+                              for m, i, w in resolved)
+            new = {(m, i, ISO8601_str_from_epoch(w))
+                   for m, i, w in pending.difference(history)}
+            resolved = {item: p for item, p in resolved.items() if item in new}
+    return resolved, unmatched
+
+
+def _resolve_plays(plays, index):
+    with metrics.phase('match', len(plays)):
+        ids = index.resolve_many([(p.media, p.guids, p.episode)
+                                  for p in plays])
+    return {(p.media, i, datetime_to_ISO8601_str(p.watched_at)): p
+            for p, i in zip(plays, ids) if i is not None}
+
+
+def send_plays(resolved, index, batch_size=BATCH_SIZE, username=None):
+    """Sends plays matched by :func:`prepare_plays`, see :func:`push_plays`
+
+    :return: Number of plays which could not be added
+    :rtype: :class:`~python:int`
+    """
+
+    def send(items):
+        if username is None:
+            return send_batches('sync/history', items, batch_size)
+        return deliver(username, 'sync/history', items, batch_size)
+
+    with metrics.phase('apply', len(resolved)):
+        not_found = [i for i in send(list(resolved)) if i in resolved]
+    if not not_found:
+        return 0
+
+    # Stale mappings are the likely cause, so retry once after re-resolving
+    failed = [resolved[item] for item in not_found]
+    for play in failed:
+        index.invalidate(play.media, play.guids)
+
+    stale = set(not_found)
+    retry = [item for item in _resolve_plays(failed, index)
+             if item not in stale]
+    with metrics.phase('apply', len(retry)):
+        not_found = set(send(retry)).intersection(retry)
+    return len(failed) - len(retry) + len(not_found)
+
+
+def push_plays(plays, index, batch_size=BATCH_SIZE, history=None,
+               username=None):
+    """Adds Plex plays to the Trakt history of the configured user
+
+    Plays are matched through *index*. Plays Trakt reports as not found
+    have their mappings invalidated and are resolved and sent once more.
+
+    :param plays: The plays to add
+    :param index: Index used to match Plex items with Trakt items
+    :param batch_size: Maximum number of items per request
+    :param history: Plays already on Trakt, matching plays are skipped
+    :param username: Name of the user, the plays are then sent through
+                     the user's outbox, see :func:`deliver`
+    :type plays: :class:`~python:list` [ :class:`mesh.plex.Play` ]
+    :type index: :class:`mesh.matching.IdIndex`
+    :type history: :class:`mesh.history.History`
+    :return: Number of plays which could not be added
+    :rtype: :class:`~python:int`
+    """
+
+    resolved, unmatched = prepare_plays(plays, index, history)
+    return unmatched + send_plays(resolved, index, batch_size, username)
+
+
+def latest_plays(plays, index, batch_size=BATCH_SIZE):
+    """Returns the most recent play of each item among *plays*
+
+    Used to merge the plays of several servers, so an item seen on more
+    than one of them is pushed once. Plays are matched through *index*
+    and merged in batches, so only the latest play of each item is held
+    in memory. Unmatched plays are all kept.
+
+    :param plays: The plays to merge
+    :param index: Index used to match Plex items with Trakt items
+    :param batch_size: Number of plays matched at once
+    :type plays: :class:`~python:list` [ :class:`mesh.plex.Play` ]
+    :type index: :class:`mesh.matching.IdIndex`
+    :rtype: :class:`~python:list` [ :class:`mesh.plex.Play` ]
+    """
+
+    latest = {}
+    for chunk in chunked(plays, batch_size):
+        _merge_latest(latest, chunk, index)
+    return list(latest.values())
+
+
+def _merge_latest(latest, plays, index):
+    """Merges *plays* into the latest play of each item in *latest*"""
+
+    with metrics.phase('match', len(plays)):
+        ids = index.resolve_many([(p.media, p.guids, p.episode)
+                                  for p in plays])
+    for play, trakt in zip(plays, ids):
+        key = (play.media, trakt if trakt is not None else id(play))
+        if key not in latest or play.watched_at > latest[key].watched_at:
+            latest[key] = play
+
+
+@metrics.mode('push')
+def push(user, identifier, batch_size=BATCH_SIZE):
+    """Pushes the user's Plex plays to Trakt
+
+    Only items viewed after :attr:`mesh.user.User.last_push` are sent.
+    The Plex library is streamed and sent one batch at a time, so memory
+    use does not grow with the library. Fetching, matching and sending
+    overlap, see :func:`pipeline`. On success the user's last push is
+    advanced to the most recent play.
+
+    The first push sends the whole library, so the user's Trakt history
+    is loaded as a compact :class:`mesh.history.History` and plays
+    already on Trakt are skipped rather than duplicated.
+
+    With several servers, their plays are fetched concurrently and merged
+    as they arrive, see :func:`latest_plays`. They are sent once every
+    server has been fetched, so the latest play of each watched item is
+    held in memory.
+
+    Plays are sent through the user's outbox, see :func:`deliver`. Writes
+    left by an interrupted push are sent first, and repeating it from the
+    same last push only sends the plays it did not deliver.
+
+    :param user: The user to push for
+    :param identifier: Plex server identifier, or the pools of the servers
+    :param batch_size: Maximum number of items per request
+    :type user: :class:`mesh.user.User`
+    :type identifier: :class:`~python:str` or
+                      :class:`mesh.servers.ServerPools`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if Trakt or
+             a Plex server can not be reached
+    """
+
+    servers = _pools(identifier)
+    index = get_index()
+    if len(servers) == 1:
+        server = _connect(user, servers.identifiers[0], servers)
+        plays = recently_watched(server, user.last_push)
+        batches = metrics.measured(chunked(plays, batch_size), 'fetch')
+    else:
+        latest, lock = {}, threading.Lock()
+
+        def fetch(identifier):
+            server = _connect(user, identifier, servers)
+            plays = recently_watched(server, user.last_push)
+            for chunk in metrics.measured(chunked(plays, batch_size), 'fetch'):
+                with lock:
+                    _merge_latest(latest, chunk, index)
+
+        servers.map(fetch)
+        batches = chunked(list(latest.values()), batch_size)
+
+    watermark = user.last_push
+    total = failed = 0
+    with get_tokens().authorized(user):
+        with metrics.phase('apply'):
+            flush(user.name, batch_size=batch_size)
+        history = None
+        if user.last_push.year == 1:
+            with metrics.phase('fetch') as phase:
+                history = History.from_entries(api.fetch('sync/history'))
+                phase.items = len(history)
+
+        def prepare(plays):
+            return (plays, *prepare_plays(plays, index, history))
+
+        for plays, resolved, unmatched in pipeline(batches, prepare):
+            failed += unmatched + send_plays(resolved, index, batch_size,
+                                             user.name)
+            total += len(plays)
+            watermark = max(watermark, max(p.watched_at for p in plays))
+
+    logger.info(f'Pushed {total - failed} of {total} plays for '
+                f'user "{user.name}"')
+    get_outbox().prune(user.name)
+    user.last_push = watermark
+
+
+def merge(base, plex, trakt):
+    """Three-way merges the state of an item
+
+    *plex* and *trakt* hold the changes seen on each side since the last
+    sync, where None fields are unchanged. Conflicts are resolved
+    deterministically:
+
+    * A new play on one side is copied to the other, new plays on both
+      sides need no writes.
+    * A rating changed on one side is copied to the other. If both sides
+      changed it to different values the most recent rating wins, Plex
+      winning ties.
+
+    :param base: The state at the last sync, or None for new items
+    :param plex: Changes seen on Plex
+    :param trakt: Changes seen on Trakt
+    :type base: :class:`mesh.journal.JournalEntry`
+    :type plex: :class:`Observation`
+    :type trakt: :class:`Observation`
+    :return: The writes for Plex and Trakt, and the merged state
+    :rtype: :class:`~python:tuple` [ :class:`Observation`,
+            :class:`Observation`, :class:`mesh.journal.JournalEntry` ]
+    """
+
+    base = base or JournalEntry()
+    to_plex, to_trakt = {}, {}
+
+    plex_played = (plex.watched_at or 0) > base.plex_watched_at
+    trakt_played = (trakt.watched_at or 0) > base.trakt_watched_at
+    if plex_played and not trakt_played:
+        to_trakt['watched_at'] = plex.watched_at
+    elif trakt_played and not plex_played:
+        to_plex['watched_at'] = trakt.watched_at
+
+    rating = base.rating
+    plex_rated = plex.rating is not None and plex.rating != base.rating
+    trakt_rated = trakt.rating is not None and trakt.rating != base.rating
+    if plex_rated and trakt_rated and plex.rating != trakt.rating:
+        plex_wins = (plex.rated_at or 0) >= (trakt.rated_at or 0)
+        plex_rated, trakt_rated = plex_wins, not plex_wins
+
+    if plex_rated and not trakt_rated:
+        to_trakt.update(rating=plex.rating, rated_at=plex.rated_at)
+        rating = plex.rating
+    elif trakt_rated and not plex_rated:
+        to_plex.update(rating=trakt.rating, rated_at=trakt.rated_at)
+        rating = trakt.rating
+    elif plex_rated:
+        rating = plex.rating
+
+    entry = JournalEntry(
+        max(base.plex_watched_at, plex.watched_at or 0),
+        max(base.trakt_watched_at, trakt.watched_at or 0,
+            to_trakt.get('watched_at') or 0),
+        rating,
+        max(base.plex_rated_at, plex.rated_at or 0),
+        max(base.trakt_rated_at, trakt.rated_at or 0,
+            to_trakt.get('rated_at') or 0)
+    )
+    return Observation(**to_plex), Observation(**to_trakt), entry
+
+
+def _epoch(value):
+    """Returns seconds since the epoch from a datetime or Trakt time"""
+
+    if isinstance(value, str):
+        return epoch_from_ISO8601_str(value)
+    return int(value.timestamp())
+
+
+def trakt_changes(delta):
+    """Returns the Trakt changes of a delta as observations
+
+    :param delta: History and ratings fetched from Trakt
+    :type delta: :class:`Delta`
+    :return: Observations and the latest Trakt entry of each movie and
+             episode, keyed by Trakt media type and id
+    :rtype: :class:`~python:tuple` [ :class:`~python:dict`,
+            :class:`~python:dict` ]
+    """
+
+    changes, entries = {}, {}
+    for entry in delta.history + delta.ratings:
+        media = entry['type']
+        if media not in ('movie', 'episode'):
+            continue
+
+        key = (media, entry[media]['ids']['trakt'])
+        entries[key] = entry
+        change = changes.get(key, Observation())
+        if 'watched_at' in entry:
+            watched_at = max(change.watched_at or 0, _epoch(entry['watched_at']))
+            change = change._replace(watched_at=watched_at)
+        if 'rating' in entry:
+            change = change._replace(rating=entry['rating'],
+                                     rated_at=_epoch(entry['rated_at']))
+        changes[key] = change
+    return changes, entries
+
+
+def plex_changes(server, since, index, batch_size=BATCH_SIZE):
+    """Returns the Plex movies and episodes viewed or rated after *since*
+
+    :param server: Server connected with the user's token
+    :param since: Only items changed after this are returned
+    :param index: Index used to match Plex items with Trakt items
+    :return: Observations and library items, keyed by Trakt media type
+             and id
+    :rtype: :class:`~python:tuple` [ :class:`~python:dict`,
+            :class:`~python:dict` ]
+    """
+
+    if since.year > 1:
+        timestamp = int(since.timestamp())
+        queries = ({'lastViewedAt>>': timestamp}, {'lastRatedAt>>': timestamp})
+    else:
+        queries = ({'viewCount>>': 0}, {'userRating>>': 0})
+
+    # Pages are fetched while the previous chunk is matched
+    chunks = chain.from_iterable(chunked(walk(server, filters), batch_size)
+                                 for filters in queries)
+    changes, items = {}, {}
+    for chunk in pipeline(metrics.measured(chunks, 'fetch')):
+        with metrics.phase('match', len(chunk)):
+            ids = index.resolve_many([(i.media, i.guids, i.episode)
+                                      for i in chunk])
+        for item, trakt in zip(chunk, ids):
+            if trakt is None:
+                continue
+
+            change = Observation()
+            if item.view_count and item.last_viewed_at is not None:
+                change = change._replace(watched_at=_epoch(item.last_viewed_at))
+            if item.last_rated_at is not None and item.last_rated_at > since:
+                change = change._replace(rating=round(item.user_rating or 0),
+                                         rated_at=_epoch(item.last_rated_at))
+            changes[(item.media, trakt)] = change
+            items[(item.media, trakt)] = item
+    return changes, items
+
+
+def _combine(left, right):
+    """Returns the Plex changes of an item seen on two servers
+
+    The latest play and the latest rating win.
+    """
+
+    if left is None:
+        return right
+
+    watched = [w for w in (left.watched_at, right.watched_at) if w is not None]
+    rated = max((left, right), key=lambda o: o.rated_at or 0)
+    return Observation(max(watched) if watched else None, rated.rating,
+                       rated.rated_at)
+
+
+def _write_plex(item, write):
+    """Applies a write to a Plex item and returns its new Plex times"""
+
+    if write.watched_at is not None:
+        item.markPlayed()
+    if write.rating is not None:
+        item.rate(float(write.rating) if write.rating else None)
+
+    item.reload()
+    watched_at = item.lastViewedAt
+    rated_at = getattr(item, 'lastRatedAt', None)
+    return (_epoch(watched_at.astimezone(timezone.utc)) if watched_at else 0,
+            _epoch(rated_at.astimezone(timezone.utc)) if rated_at else 0)
+
+
+def _apply_writes(server, items, writes, trakt_entries, index):
+    """Applies the Plex writes of a sync to a server
+
+    :param items: The server's changed library items, see
+                  :func:`plex_changes`
+    :param writes: The writes, keyed by Trakt media type and id
+    :param trakt_entries: Trakt entries used to locate other items
+    :return: The new Plex watch and rating times of each written item
+    :rtype: :class:`~python:dict`
+    """
+
+    sections = server.library.sections()
+    times = {}
+    for key, write in writes.items():
+        with metrics.phase('match', 1):
+            if key in items:
+                item = server.fetchItem(items[key].rating_key)
+            elif key in trakt_entries:
+                item = _locate(sections, trakt_entries[key], index)
+            else:
+                item = None
+        if item is None:
+            continue
+
+        with metrics.phase('apply', 1):
+            times[key] = _write_plex(item, write)
+    return times
+
+
+#: The writes of a sync: merged journal entries, Trakt plays, ratings and
+#: removed ratings, and Plex writes, all keyed by Trakt media type and id.
+#: *changed* holds the :func:`plex_changes` of each server and
+#: *trakt_entries* the Trakt entries used to locate items on Plex
+SyncWrites = namedtuple('SyncWrites',
+                        ['entries', 'plays', 'ratings', 'unrated', 'plex',
+                         'changed', 'trakt_entries'])
+
+
+def sync_writes(user, since, servers, connected, batch_size=BATCH_SIZE):
+    """Fetches, matches and diffs the changes of a sync without writing
+
+    Must be called within the user's Trakt authorization, see
+    :meth:`mesh.tokens.TokenManager.authorized`.
+
+    :param user: The user to synchronize
+    :param since: Only changes made after this are compared
+    :param servers: The pools of the servers
+    :param connected: The servers connected as the user, keyed by
+                      identifier
+    :param batch_size: Number of Plex items matched at once
+    :type servers: :class:`mesh.servers.ServerPools`
+    :rtype: :class:`SyncWrites`
+    """
+
+    index = get_index()
+    mode = metrics.current_mode()
+
+    def fetch_plex():
+        with metrics.mode(mode):
+            return dict(zip(servers.identifiers, servers.map(
+                lambda i: plex_changes(connected[i], since, index,
+                                       batch_size))))
+
+    # Plex is read while the Trakt changes are fetched on this thread,
+    # which holds the user's authorization
+    with ThreadPoolExecutor(1, 'plex') as pool:
+        plex_changed = pool.submit(fetch_plex)
+        delta = fetch_delta(user, since, ('history', 'ratings'))
+        changed = plex_changed.result()
+    trakt, trakt_entries = trakt_changes(delta)
+    plex = {}
+    for changes, _ in changed.values():
+        for key, change in changes.items():
+            plex[key] = _combine(plex.get(key), change)
+
+    keys = set(plex) | set(trakt)
+    with metrics.phase('diff', len(keys)):
+        base = get_journal().get(user.name, keys)
+        writes = SyncWrites({}, [], [], [], {}, changed, trakt_entries)
+        for key in keys:
+            to_plex, to_trakt, writes.entries[key] = merge(
+                base.get(key), plex.get(key, Observation()),
+                trakt.get(key, Observation()))
+
+            if to_plex != Observation():
+                writes.plex[key] = to_plex
+            if to_trakt.watched_at is not None:
+                watched_at = ISO8601_str_from_epoch(to_trakt.watched_at)
+                writes.plays.append((*key, watched_at))
+            if to_trakt.rating:
+                writes.ratings.append((*key, to_trakt.rating))
+            elif to_trakt.rating == 0:
+                writes.unrated.append((*key, None))
+    return writes
+
+
+@metrics.mode('sync')
+def sync(user, identifier, batch_size=BATCH_SIZE):
+    """Two-way synchronizes the user's plays and ratings
+
+    Changes made on either side after :attr:`mesh.user.User.last_sync`
+    are compared with the state of each item at the last sync, stored in
+    the user's :class:`mesh.journal.Journal`, and only the writes
+    required to bring both sides in line are made, see :func:`merge`.
+    Items without changes are never compared, so the cost follows the
+    number of changes rather than the library size.
+
+    With several servers, their changes are fetched concurrently and
+    combined, the latest play and rating of each item win, and the Plex
+    writes are applied to every server.
+
+    The Trakt writes are sent through the user's outbox, see
+    :func:`deliver`, so a sync repeated after a failure only sends the
+    writes it did not deliver. They are sent while the Plex writes are
+    applied, but neither starts before the diff is complete: an item can
+    only be merged once the changes of every server and of Trakt are
+    known, so all of them are fetched first, see :func:`sync_writes`.
+
+    :param user: The user to synchronize
+    :param identifier: Plex server identifier, or the pools of the servers
+    :param batch_size: Maximum number of items per request
+    :type user: :class:`mesh.user.User`
+    :type identifier: :class:`~python:str` or
+                      :class:`mesh.servers.ServerPools`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if Trakt or
+             a Plex server can not be reached
+    """
+
+    started = datetime.now(timezone.utc)
+    servers = _pools(identifier)
+    connected = dict(zip(servers.identifiers, servers.map(
+        lambda i: _connect(user, i, servers))))
+    index = get_index()
+
+    mode = metrics.current_mode()
+
+    def apply_plex(writes):
+        with metrics.mode(mode):
+            return servers.map(lambda i: _apply_writes(
+                connected[i], writes.changed[i][1], writes.plex,
+                writes.trakt_entries, index))
+
+    with get_tokens().authorized(user):
+        with metrics.phase('apply'):
+            flush(user.name, batch_size=batch_size)
+        writes = sync_writes(user, user.last_sync, servers, connected,
+                             batch_size)
+        trakt_writes = len(writes.plays) + len(writes.ratings) + \
+            len(writes.unrated)
+
+        # Plex is written while the Trakt writes are sent on this thread,
+        # which holds the user's authorization
+        with ThreadPoolExecutor(1, 'plex') as pool:
+            plex_written = pool.submit(apply_plex, writes)
+            with metrics.phase('apply', trakt_writes):
+                deliver(user.name, 'sync/history', writes.plays, batch_size)
+                deliver(user.name, 'sync/ratings', writes.ratings,
+                        batch_size, field='rating')
+                deliver(user.name, 'sync/ratings/remove', writes.unrated,
+                        batch_size, field=None)
+            written = plex_written.result()
+
+    entries = writes.entries
+    for times in written:
+        for key, (watched_at, rated_at) in times.items():
+            entries[key] = entries[key]._replace(
+                plex_watched_at=max(entries[key].plex_watched_at, watched_at),
+                plex_rated_at=max(entries[key].plex_rated_at, rated_at))
+
+    with metrics.phase('apply'):
+        get_journal().update(user.name, entries)
+    logger.info(f'Synchronized {len(entries)} changed items for user '
+                f'"{user.name}": {len(writes.plex)} Plex writes, '
+                f'{trakt_writes} Trakt writes')
+    get_outbox().prune(user.name)
+    user.last_sync = started
+
+
+@dataclass
+class Plan:
+    """The cost of a sync, computed without writing, see :func:`plan`
+
+    :param user: Name of the user
+    :param items: Number of changed items compared
+    :param actions: Number of writes by action
+    :param requests: Number of requests by service, ``read`` requests were
+                     made while planning, ``write`` requests are estimated
+    :param seconds: Estimated duration of the sync
+    :param memory: Estimated bytes held by the sync at its peak
+    """
+
+    user: str
+    items: int = 0
+    actions: dict = field(default_factory=dict)
+    requests: dict = field(default_factory=dict)
+    seconds: float = 0
+    memory: int = 0
+
+    def as_dict(self):
+        """Returns the plan as a JSON serializable dict"""
+        return asdict(self)
+
+
+def _requests():
+    """Returns the requests recorded so far, by service and kind, and the
+    number and total seconds of the Plex requests"""
+
+    counts = {}
+    for labels, value in metrics.registry.collect('mesh_http_requests_total'):
+        kind = 'read' if labels['method'] == 'GET' else 'write'
+        service = counts.setdefault(labels['service'], {})
+        service[kind] = service.get(kind, 0) + value
+
+    timed = [h for labels, h in
+             metrics.registry.collect('mesh_http_request_seconds')
+             if labels['service'] == 'plex']
+    return counts, (sum(h.count for h in timed), sum(h.sum for h in timed))
+
+
+def _limited_seconds(requests, limiter):
+    """Returns the seconds *limiter* holds back a burst of requests"""
+    return max(0, requests - limiter.burst) / limiter.rate
+
+
+@metrics.mode('plan')
+def plan(user, identifier, batch_size=BATCH_SIZE):
+    """Computes the cost of syncing the user without writing anything
+
+    Changes are fetched, matched and diffed as in :func:`sync`, through
+    the response cache and the id index, but neither Plex, Trakt, the
+    journal nor the user are written to. The servers are connected to as
+    a copy of the user, whose cached connection is left unchanged, and the
+    Trakt token is used as is: planning never renews it.
+
+    The estimated duration covers the requests made while planning and
+    the writes, as the Trakt rate limits allow them and at the average
+    Plex latency seen while planning. Plex writes fetch, write and reload
+    each item on every server.
+
+    :param user: The user to plan for
+    :param identifier: Plex server identifier, or the pools of the servers
+    :param batch_size: Maximum number of items per request
+    :type user: :class:`mesh.user.User`
+    :type identifier: :class:`~python:str` or
+                      :class:`mesh.servers.ServerPools`
+    :rtype: :class:`Plan`
+    :raises: :class:`mesh.exceptions.SynchronizationError` if Trakt or
+             a Plex server can not be reached, or if the user's Trakt
+             token is due for renewal, see :mod:`mesh.tokens`
+    """
+
+    if expires_within(user.trakt, EXPIRY_MARGIN):
+        raise SynchronizationError(
+            f'The Trakt token of "{user.name}" must be renewed first')
+
+    user = replace(user)
+    before, (plex_count, plex_seconds) = _requests()
+    servers = _pools(identifier)
+    connected = dict(zip(servers.identifiers, servers.map(
+        lambda i: _connect(user, i, servers))))
+    with Trakt.configuration.oauth.from_response(user.trakt,
+                                                 username=user.name):
+        pending = get_outbox().pending(user.name)
+        writes = sync_writes(user, user.last_sync, servers, connected,
+                             batch_size)
+
+    after, (count, seconds) = _requests()
+    made = {service: {kind: value - before.get(service, {}).get(kind, 0)
+                      for kind, value in kinds.items()}
+            for service, kinds in after.items()}
+
+    actions = {
+        'trakt_history_add': len(writes.plays),
+        'trakt_ratings_add': len(writes.ratings),
+        'trakt_ratings_remove': len(writes.unrated),
+        'trakt_outbox_pending': len(pending),
+        'plex_mark_played': sum(w.watched_at is not None
+                                for w in writes.plex.values()),
+        'plex_rate': sum(w.rating is not None for w in writes.plex.values())
+    }
+    paths = {}
+    for entry in pending:
+        paths[entry.path] = paths.get(entry.path, 0) + 1
+    for path, items in (('sync/history', writes.plays),
+                        ('sync/ratings', writes.ratings),
+                        ('sync/ratings/remove', writes.unrated)):
+        paths[path] = paths.get(path, 0) + len(items)
+    trakt_writes = sum(-(-n // batch_size) for n in paths.values())
+    plex_writes = len(servers) * (2 * len(writes.plex)
+                                  + actions['plex_mark_played']
+                                  + actions['plex_rate'])
+
+    requests = {service: dict(kinds) for service, kinds in made.items()}
+    requests.setdefault('trakt', {})['write'] = trakt_writes
+    requests.setdefault('plex', {})
+    requests['plex']['write'] = requests['plex'].get('write', 0) + plex_writes
+    for kinds in requests.values():
+        kinds.setdefault('read', 0)
+
+    latency = (seconds - plex_seconds) / (count - plex_count) \
+        if count > plex_count else 0
+    duration = (_limited_seconds(requests['trakt']['read'], api.read_limiter)
+                + _limited_seconds(trakt_writes, api.write_limiter)
+                + sum(requests['plex'].values()) * latency)
+
+    return Plan(user.name, len(writes.entries), actions, requests,
+                round(duration, 1),
+                deep_sizeof(writes) + deep_sizeof(pending))
@@ -0,0 +1,219 @@
+"""This module contains the renewal of the users' Trakt OAuth tokens
+
+Trakt access tokens expire ``expires_in`` seconds after ``created_at``.
+The :class:`TokenManager` renews them in the background well before
+then, a few at a time and within the Trakt write rate limit shared by
+all users, and a token which is about to expire is renewed before it is
+used, so a synchronization never fails halfway on an expired token.
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from trakt import Trakt
+
+from mesh import api, metrics
+from mesh.constants import TOKEN_CHECK_INTERVAL, TOKEN_RENEW_BEFORE
+from mesh.exceptions import SynchronizationError
+
+logger = logging.getLogger(__name__)
+
+#: Seconds before their expiry tokens are renewed in the background
+RENEW_BEFORE = TOKEN_RENEW_BEFORE
+
+#: Seconds before their expiry tokens are renewed right before use. The
+#: Trakt client refuses tokens expiring within two days
+EXPIRY_MARGIN = 3 * 24 * 60 * 60
+
+#: Seconds between background checks for expiring tokens
+CHECK_INTERVAL = TOKEN_CHECK_INTERVAL
+
+#: Maximum number of tokens renewed per background check
+BATCH_SIZE = 50
+
+#: Redirect uri of the out-of-band authorization, see
+#: :func:`mesh.interactive.trakt_oauth`
+REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
+
+
+def expires_at(token):
+    """Returns the time a token expires in seconds since the epoch
+
+    :param token: Trakt OAuth token response
+    :type token: :class:`~python:dict`
+    :return: The expiry time, or None if the token does not tell
+    """
+
+    try:
+        return int(token['created_at']) + int(token['expires_in'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def expires_within(token, seconds, now=None):
+    """Returns whether a token expires within *seconds*"""
+
+    expiry = expires_at(token)
+    if expiry is None:
+        return False
+    return expiry - (time.time() if now is None else now) < seconds
+
+
+class TokenManager:
+    """Renews the Trakt tokens of the users before they expire
+
+    Tokens are used through :meth:`authorized`, which also keeps the
+    background renewal from replacing a token while it is in use.
+
+    :param store: Users whose tokens are renewed in the background, new
+                  tokens are written through its ``update``
+    :param renew_before: Seconds before expiry tokens are renewed
+    :param interval: Seconds between background checks
+    :param batch_size: Maximum number of tokens renewed per check
+    :type store: :class:`mesh.user.UserStore`
+    """
+
+    def __init__(self, store=None, renew_before=RENEW_BEFORE,
+                 interval=CHECK_INTERVAL, batch_size=BATCH_SIZE):
+        self.store = store
+        self.renew_before = renew_before
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _lock(self, user):
+        with self._guard:
+            return self._locks.setdefault(user.name, threading.RLock())
+
+    @contextmanager
+    def authorized(self, user):
+        """Activates the user's Trakt OAuth token for the duration
+
+        A token expiring within :data:`EXPIRY_MARGIN` seconds is renewed
+        first.
+
+        :param user: The user to authorize as
+        :type user: :class:`mesh.user.User`
+        :raises: :class:`mesh.exceptions.SynchronizationError` if an
+                 expiring token can not be renewed
+        """
+
+        with self._lock(user):
+            if expires_within(user.trakt, EXPIRY_MARGIN):
+                self.renew(user)
+            with Trakt.configuration.oauth.from_response(user.trakt,
+                                                         username=user.name):
+                yield
+
+    def renew(self, user):
+        """Exchanges the user's refresh token for a new token
+
+        The new token replaces :attr:`mesh.user.User.trakt` and is written
+        to the store in a single transaction.
+
+        :param user: The user to renew the token of
+        :type user: :class:`mesh.user.User`
+        :raises: :class:`mesh.exceptions.SynchronizationError` if Trakt
+                 rejects the refresh token
+        """
+
+        with self._lock(user):
+            api.limiter('POST').acquire()
+            token = Trakt['oauth'].token_refresh(
+                user.trakt.get('refresh_token'), REDIRECT_URI)
+            if not token:
+                metrics.registry.inc('mesh_token_renewals_total',
+                                     result='failure')
+                raise SynchronizationError(
+                    f'Unable to renew the Trakt token of "{user.name}"')
+
+            user.trakt = token
+            if self.store is not None:
+                self.store.update(user, ('trakt',))
+        metrics.registry.inc('mesh_token_renewals_total', result='success')
+        logger.info(f'Renewed the Trakt token of user "{user.name}"')
+
+    def due(self, now=None):
+        """Returns the users whose tokens should be renewed, soonest first
+
+        :rtype: :class:`~python:list` [ :class:`mesh.user.User` ]
+        """
+
+        if self.store is None:
+            return []
+        users = [u for u in self.store.users
+                 if expires_within(u.trakt, self.renew_before, now)]
+        return sorted(users, key=lambda u: expires_at(u.trakt))
+
+    def renew_due(self):
+        """Renews up to *batch_size* of the due tokens
+
+        Users whose token is in use are skipped until the next check.
+
+        :return: The number of renewed tokens
+        :rtype: :class:`~python:int`
+        """
+
+        renewed = 0
+        for user in self.due()[:self.batch_size]:
+            lock = self._lock(user)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                self.renew(user)
+                renewed += 1
+            except SynchronizationError:
+                logger.warning(f'Unable to renew the Trakt token of user '
+                               f'"{user.name}", re-authorization is required '
+                               f'once it expires')
+            finally:
+                lock.release()
+        return renewed
+
+    def start(self):
+        """Starts renewing the due tokens in the background"""
+
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.renew_due()
+                except Exception:
+                    logger.exception('Token renewal failed')
+                if self._stopped.wait(self.interval):
+                    return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, daemon=True,
+                                        name='tokens')
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background renewal"""
+
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+
+def get_tokens(store=None, renew_before=RENEW_BEFORE,
+               interval=CHECK_INTERVAL):
+    global _tokens
+
+    if _tokens is None:
+        _tokens = TokenManager(store, renew_before, interval)
+    return _tokens
+
+
+#: Instantiated :class:`TokenManager` object shared by all users.
+#: Should **always** be used to authorize Trakt requests of users.
+_tokens = None
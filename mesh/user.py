@@ -1,10 +1,19 @@
 from dataclasses import dataclass, field, asdict, is_dataclass
 from datetime import datetime, timezone
 import json
+import logging
+import os
 from pathlib import Path
+import sqlite3
+import threading
 
 from mesh.helpers import datetime_to_ISO8601_str, datetime_from_ISO8601_str
 
+logger = logging.getLogger(__name__)
+
+#: User fields which change during synchronization
+STATE_FIELDS = ('last_pull', 'last_push', 'last_sync', 'url', 'server_token')
+
 
 @dataclass
 class User:
@@ -18,6 +27,11 @@ class User:
     :param last_sync: Last time user performed a full sync
     :param url: The url through which the user managed to connect to the plex
                 server during the last pull/push/sync
+    :param server_token: The access token to the plex server used with
+                         :attr:`url`, which differs from :attr:`token` for
+                         servers shared with the user
+    :param interval: Seconds between the user's scheduled events, 0 uses
+                     the scheduler's default
     """
 
     name: str
@@ -36,6 +50,8 @@ class User:
         default_factory=lambda: datetime.min.replace(tzinfo=timezone.utc)
     )
     url: str = ''
+    interval: int = 0
+    server_token: str = field(default='', repr=False)
 
     def __post_init__(self):
         if isinstance(self.last_pull, str):
@@ -90,9 +106,155 @@ class UserManager:
         return next(filter(lambda u: u.name == username, self.users), None)
 
     def save(self):
-        """Saves the UserManager as json"""
-        with self.file.open(mode='w') as f:
+        """Saves the UserManager as json
+
+        The file is written next to the existing one and then moved over
+        it, so an interrupted save never leaves a truncated file behind.
+        """
+
+        tmp = self.file.with_name(f'{self.file.name}.tmp')
+        with tmp.open(mode='w') as f:
             json.dump(self, f, cls=UserEncoder, indent=2)
+        os.replace(tmp, self.file)
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    trakt TEXT NOT NULL,
+    last_pull TEXT NOT NULL,
+    last_push TEXT NOT NULL,
+    last_sync TEXT NOT NULL,
+    url TEXT NOT NULL,
+    server_token TEXT NOT NULL,
+    interval INTEGER NOT NULL
+)
+'''
+
+_COLUMNS = ('name', 'token', 'trakt') + STATE_FIELDS + ('interval',)
+
+
+def _row(user):
+    """Returns the database row of a user"""
+
+    values = asdict(user)
+    values['trakt'] = json.dumps(user.trakt)
+    for key in ('last_pull', 'last_push', 'last_sync'):
+        values[key] = datetime_to_ISO8601_str(values[key])
+    return tuple(values[c] for c in _COLUMNS)
+
+
+class UserStore:
+    """Transactional user store backed by SQLite
+
+    Alternative to :class:`UserManager` for many users. Users are kept in
+    memory, indexed by name, and every change is written to the database
+    in its own transaction: :meth:`update` only writes the changed fields
+    of a single user, so concurrent events never rewrite each other's
+    users.
+
+    :param path: Full path to the database file
+    :type path: :class:`~python:pathlib:Path`
+    """
+
+    def __init__(self, path):
+        self.file = path
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(_SCHEMA)
+
+        self._users = {}
+        rows = self._db.execute(f'SELECT {", ".join(_COLUMNS)} FROM users')
+        for row in rows:
+            data = dict(zip(_COLUMNS, row))
+            data['trakt'] = json.loads(data['trakt'])
+            self._users[data['name']] = User.from_json(data)
+
+    def __len__(self):
+        return len(self._users)
+
+    @property
+    def users(self):
+        """List of all the users"""
+        return list(self._users.values())
+
+    def get(self, username):
+        """Returns the user with matching name or None"""
+        return self._users.get(username)
+
+    def add(self, user):
+        """Adds a user
+
+        :param user: The user to be added
+        :raises: ValueError if a user of the same name is already managed
+        """
+
+        with self._lock, self._db:
+            if user.name in self._users:
+                raise ValueError(f'User "{user.name}" already exists')
+            self._db.execute(
+                f'INSERT INTO users VALUES ({", ".join("?" * len(_COLUMNS))})',
+                _row(user))
+            self._users[user.name] = user
+
+    def update(self, user, fields=STATE_FIELDS):
+        """Writes the given fields of a single user
+
+        :param user: A managed user
+        :param fields: Names of the fields to write
+        :type fields: :class:`~python:tuple` [ :class:`~python:str` ]
+        :raises: ValueError if the user is not managed
+        """
+
+        values = dict(zip(_COLUMNS, _row(user)))
+        assignments = ', '.join(f'{f} = ?' for f in fields)
+        with self._lock, self._db:
+            if user.name not in self._users:
+                raise ValueError(f'User "{user.name}" does not exist')
+            self._db.execute(
+                f'UPDATE users SET {assignments} WHERE name = ?',
+                [values[f] for f in fields] + [user.name])
+
+    def remove(self, username):
+        """Removes the user with matching name"""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM users WHERE name = ?', (username,))
+            self._users.pop(username, None)
+
+    def save(self):
+        """Writes all users in a single transaction"""
+
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO users '
+                f'VALUES ({", ".join("?" * len(_COLUMNS))})',
+                [_row(u) for u in self._users.values()])
+
+    def import_json(self, file):
+        """Imports the users of a :class:`UserManager` json file
+
+        Users which already exist in the store are skipped.
+
+        :param file: Full path to the usermapping file
+        :return: The number of imported users
+        :rtype: :class:`~python:int`
+        """
+
+        imported = 0
+        for user in UserManager(file).users:
+            if user.name in self._users:
+                continue
+            self.add(user)
+            imported += 1
+        logger.info(f'Imported {imported} users from "{file}"')
+        return imported
+
+    def close(self):
+        """Closes the underlying database"""
+        self._db.close()
 
 
 class UserEncoder(json.JSONEncoder):
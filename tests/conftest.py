@@ -0,0 +1,53 @@
+import pytest
+
+from mesh import metrics
+from mesh.cache import ResponseCache
+from mesh.journal import Journal
+from mesh.matching import IdIndex
+from mesh.metrics import Registry
+from mesh.outbox import Outbox
+from mesh.user import UserStore
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Replaces the shared metrics registry by an empty one"""
+
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    return registry
+
+
+@pytest.fixture
+def response_cache(tmp_path):
+    response_cache = ResponseCache(tmp_path.joinpath('responses.db'))
+    yield response_cache
+    response_cache.close()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(tmp_path.joinpath('journal.db'))
+    yield journal
+    journal.close()
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = IdIndex(tmp_path.joinpath('idindex.db'))
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(tmp_path.joinpath('outbox.db'))
+    yield outbox
+    outbox.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(tmp_path.joinpath('users.db'))
+    yield store
+    store.close()
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta, timezone
+import json
+
+import pytest
+
+from mesh import api
+from mesh.api import check_response, rate_limit_wait
+from mesh.exceptions import RateLimitExceeded
+from mesh.helpers import RateLimiter
+
+
+def test_rate_limit_wait_without_headers():
+    assert rate_limit_wait({}) == 0
+
+
+def test_rate_limit_wait_retry_after():
+    assert rate_limit_wait({'Retry-After': '2'}) == 2
+
+
+def test_rate_limit_wait_with_remaining_requests():
+    header = {'remaining': 10, 'until': '2020-01-01T00:00:00Z'}
+    assert rate_limit_wait({'X-Ratelimit': json.dumps(header)}) == 0
+
+
+def test_rate_limit_wait_until_reset():
+    until = datetime.now(timezone.utc) + timedelta(seconds=30)
+    header = {'remaining': 0, 'until': until.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    assert 28 < rate_limit_wait({'X-Ratelimit': json.dumps(header)}) <= 30
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({}, api.DEFAULT_RETRY_AFTER),
+    ({'Retry-After': '2'}, 2)
+])
+def test_rate_limited_response_pauses_limiter(monkeypatch, headers, expected):
+    limiter = RateLimiter(1)
+    monkeypatch.setattr(api, 'write_limiter', limiter)
+
+    with pytest.raises(RateLimitExceeded) as e:
+        check_response('POST', 'sync/history', FakeResponse(429, headers),
+                       'user')
+    assert e.value.retry_after == expected
+    assert expected - 1 < limiter._take('user') <= expected
+    assert limiter._take('other') == 0
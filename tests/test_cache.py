@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from benchmarks.mocks import MockTrakt, trakt_client
+from mesh import api, cache
+from mesh.cache import ResponseCache
+
+
+@pytest.mark.parametrize('method, path, ttl, shared', [
+    ('GET', 'search/imdb/tt0000001', 7 * 24 * 60 * 60, True),
+    ('GET', 'shows/1/seasons', 24 * 60 * 60, True),
+    ('GET', 'users/me/lists/1/items', 60 * 60, False),
+    ('GET', 'sync/history', None, None),
+    ('POST', 'search/imdb/tt0000001', None, None)
+])
+def test_policy(method, path, ttl, shared):
+    policy = cache.policy(method, path)
+    if ttl is None:
+        assert policy is None
+    else:
+        assert (policy.ttl, policy.shared) == (ttl, shared)
+
+
+def test_lookup_keys(response_cache):
+    response_cache.store('* search/imdb/tt1?', {}, b'[]', 60)
+
+    assert response_cache.lookup('GET', 'search/imdb/tt1', None, 'a').fresh
+    assert response_cache.lookup('GET', 'search/imdb/tt1').fresh
+    assert response_cache.lookup('GET', 'sync/history') is None
+    # Personal responses require a user and are not shared
+    assert response_cache.lookup('GET', 'users/a/lists') is None
+    response_cache.store('a users/a/lists?', {}, b'[]', 60)
+    assert response_cache.lookup('GET', 'users/a/lists', None, 'a').fresh
+    assert not response_cache.lookup('GET', 'users/a/lists', None, 'b').fresh
+
+
+def test_query_order(response_cache):
+    response_cache.store('* search/imdb/tt1?a=1&b=2', {}, b'[]', 60)
+    assert response_cache.lookup('GET', 'search/imdb/tt1',
+                                 {'b': 2, 'a': 1}).fresh
+
+
+def test_expiry_and_validators(response_cache):
+    headers = {'ETag': '"1"', 'Last-Modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+    response_cache.store('* search/imdb/tt1?', headers, b'[1]', -1)
+
+    lookup = response_cache.lookup('GET', 'search/imdb/tt1')
+    assert not lookup.fresh
+    assert lookup.validators == {
+        'If-None-Match': '"1"',
+        'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+    assert lookup.response().json() == [1]
+
+
+def test_eviction(tmp_path):
+    response_cache = ResponseCache(tmp_path.joinpath('responses.db'), 10)
+    for i in range(3):
+        response_cache.store(str(i), {}, b'1234', 60)
+        time.sleep(0.01)
+    assert len(response_cache) == 2
+    assert response_cache.size == 8
+
+    response_cache.store('big', {}, b'12345678901', 60)
+    assert len(response_cache) == 2
+
+    response_cache.close()
+    reopened = ResponseCache(tmp_path.joinpath('responses.db'), 10)
+    assert reopened.size == 8
+    reopened.close()
+
+
+def test_requests_are_revalidated(response_cache, registry, monkeypatch):
+    monkeypatch.setattr(api, 'response_cache', response_cache)
+    with MockTrakt(size=10, read_rate=1e9, burst=10 ** 9) as trakt, \
+            trakt_client(trakt):
+        first = api.get('search/imdb/tt0000001', authenticated=False).json()
+        assert api.get('search/imdb/tt0000001',
+                       authenticated=False).json() == first
+        assert trakt.requests == 1
+
+        with response_cache._db:
+            response_cache._db.execute('UPDATE responses SET expires_at = 0')
+        assert api.get('search/imdb/tt0000001',
+                       authenticated=False).json() == first
+        assert trakt.requests == 2
+
+    assert registry.get('mesh_cache_requests_total', result='miss') == 1
+    assert registry.get('mesh_cache_requests_total', result='hit') == 1
+    assert registry.get('mesh_cache_requests_total',
+                        result='revalidated') == 1
+    assert response_cache.lookup('GET', 'search/imdb/tt0000001').fresh
@@ -1,10 +1,14 @@
 from configparser import ConfigParser
+import os
 from pathlib import Path
+import time
 
 import pytest
 
-from mesh.configuration import Configuration, _TEMPLATE
+from mesh.configuration import (Configuration, TUNING, _TEMPLATE, duration,
+                                server_section)
 from mesh.exceptions import InvalidConfiguration
+from mesh.servers import Server
 
 
 @pytest.fixture
@@ -106,3 +110,149 @@ def test_set_non_existing_section(valid_config_file):
     with pytest.raises(ValueError):
         c.set('test', 'test', 'test')
 
+
+def test_section_views_are_cached(valid_config_file):
+    c = Configuration(valid_config_file)
+    assert c.plex is c.plex
+
+    view = c.plex
+    c.set('plex', 'token', 'changed')
+    assert c.plex is not view
+    assert c.plex.token == 'changed'
+
+
+def test_tuning_defaults(valid_config_file):
+    c = Configuration(valid_config_file)
+    for section, options in TUNING.items():
+        for option, (_, default) in options.items():
+            assert getattr(getattr(c, section), option) == default
+
+
+def test_tuning_options_are_typed(valid_config_file, base_configparser):
+    base_configparser.add_section('scheduler')
+    base_configparser.set('scheduler', 'workers', '8')
+    base_configparser.set('scheduler', 'interval', '1h30m')
+    base_configparser.set('scheduler', 'daemon', 'yes')
+    with open(valid_config_file, 'w') as f:
+        base_configparser.write(f)
+
+    c = Configuration(valid_config_file)
+    assert c.scheduler.workers == 8
+    assert c.scheduler.interval == 5400
+    assert c.scheduler.daemon is True
+    assert c.scheduler.jitter == 0.1
+
+
+def test_invalid_tuning_option(valid_config_file, base_configparser):
+    base_configparser.add_section('sync')
+    base_configparser.set('sync', 'batch_size', 'many')
+    with open(valid_config_file, 'w') as f:
+        base_configparser.write(f)
+
+    with pytest.raises(InvalidConfiguration):
+        Configuration(valid_config_file)
+
+
+def test_set_tuning_option(valid_config_file):
+    c = Configuration(valid_config_file)
+    c.set('sync', 'batch_size', '100')
+    assert c.sync.batch_size == 100
+
+
+@pytest.mark.parametrize('section, option, value', [
+    ('sync', 'batch_size', 'many'),
+    ('tokens', 'renew_before', 'soon'),
+    ('scheduler', 'daemon', 'maybe'),
+    ('plex', 'workers', 'two')
+])
+def test_set_invalid_value(valid_config_file, section, option, value):
+    c = Configuration(valid_config_file)
+    with pytest.raises(ValueError):
+        c.set(section, option, value)
+    assert not c._config_parser.has_option(section, option)
+
+
+def test_reload(valid_config_file, base_configparser):
+    c = Configuration(valid_config_file)
+    assert c.plex.token == 'test'
+
+    base_configparser.set('plex', 'token', 'reloaded')
+    with open(valid_config_file, 'w') as f:
+        base_configparser.write(f)
+    c.reload()
+    assert c.plex.token == 'reloaded'
+
+
+def test_failed_reload_keeps_configuration(valid_config_file):
+    c = Configuration(valid_config_file)
+    with open(valid_config_file, 'w') as f:
+        f.write('testing invalid file')
+
+    with pytest.raises(InvalidConfiguration):
+        c.reload()
+    assert c.plex.token == 'test'
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('90', 90), ('15m', 900), ('1h30m', 5400), ('1d', 86400), (60, 60)
+])
+def test_duration(value, seconds):
+    assert duration(value) == seconds
+
+
+def test_invalid_duration():
+    with pytest.raises(ValueError):
+        duration('soon')
+
+
+def test_environment_overrides(valid_config_file, monkeypatch):
+    monkeypatch.setenv('MESH_TRAKT_SECRET', 'secret')
+    monkeypatch.setenv('MESH_SYNC_BATCH_SIZE', '200')
+
+    c = Configuration(valid_config_file)
+    assert c.trakt.secret == 'secret'
+    assert c.sync.batch_size == 200
+
+
+def test_watch_reloads_changed_file(valid_config_file, base_configparser):
+    c = Configuration(valid_config_file)
+    reloaded = []
+    c.add_listener(reloaded.append)
+    c.watch(interval=0.01)
+
+    base_configparser.set('plex', 'token', 'watched')
+    with open(valid_config_file, 'w') as f:
+        base_configparser.write(f)
+    mtime = os.stat(valid_config_file).st_mtime + 1
+    os.utime(valid_config_file, (mtime, mtime))
+
+    for _ in range(100):
+        if reloaded:
+            break
+        time.sleep(0.01)
+    c.unwatch()
+
+    assert reloaded == [c]
+    assert c.plex.token == 'watched'
+
+
+def test_servers(valid_config_file):
+    config = Configuration(valid_config_file)
+    config.set('plex', 'workers', '2')
+    config.set(server_section('Living Room'), 'identifier', 'other')
+    config.set(server_section('Living Room'), 'token', 'secret')
+    config.save()
+    config.reload()
+
+    assert config.servers() == [Server('plex', 'test', 'test', 2),
+                                Server('living-room', 'other', 'secret', 0)]
+
+
+def test_server_requires_options(valid_config_file, base_configparser):
+    base_configparser.add_section('plex:other')
+    base_configparser.set('plex:other', 'identifier', 'other')
+    with open(valid_config_file, 'w') as f:
+        base_configparser.write(f)
+
+    with pytest.raises(InvalidConfiguration):
+        Configuration(valid_config_file)
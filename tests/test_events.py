@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from mesh.events import Event, Scheduler, EVENTS
+from mesh.user import User
+
+
+class RecordingEvent(Event):
+    """Event which records concurrency while sleeping briefly"""
+
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+    runs = []
+
+    def run(self, servers):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+            cls.runs.append(self.user.name)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.running -= 1
+
+
+@pytest.fixture
+def recording_event(monkeypatch):
+    RecordingEvent.running = 0
+    RecordingEvent.max_running = 0
+    RecordingEvent.runs = []
+    monkeypatch.setitem(EVENTS, 'record', RecordingEvent)
+    return RecordingEvent
+
+
+@pytest.fixture
+def users():
+    return [User(f'user{i}', 'token', {}) for i in range(8)]
+
+
+def test_event_requires_run(users):
+    with pytest.raises(TypeError):
+        Event(0, users[0])
+
+
+def test_scheduler_runs_each_user_once(recording_event, users):
+    scheduler = Scheduler('server', workers=4)
+    scheduler.schedule_users(users, 'record')
+    scheduler.run(until_idle=True)
+
+    assert sorted(recording_event.runs) == sorted(u.name for u in users)
+    assert len(scheduler) == 0
+
+
+def test_scheduler_respects_worker_cap(recording_event, users):
+    scheduler = Scheduler('server', workers=3)
+    scheduler.schedule_users(users, 'record')
+
+    start = time.monotonic()
+    scheduler.run(until_idle=True)
+
+    assert recording_event.max_running == 3
+    assert time.monotonic() - start < 8 * 0.05
+
+
+def test_scheduler_never_runs_a_user_concurrently(recording_event, users):
+    scheduler = Scheduler('server', workers=4)
+    now = time.monotonic()
+    scheduler.schedule(RecordingEvent(now, users[0]))
+    scheduler.schedule(RecordingEvent(now, users[0]))
+    scheduler.schedule(RecordingEvent(now, users[1]))
+
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    time.sleep(0.2)
+    scheduler.stop()
+    thread.join()
+
+    assert recording_event.runs == ['user0', 'user1']
+    assert len(scheduler) == 1
+
+
+def test_scheduler_reschedules_repeating_events(recording_event, users):
+    completed = []
+    scheduler = Scheduler('server', workers=1, jitter=0,
+                          on_complete=completed.append)
+    scheduler.schedule(RecordingEvent(time.monotonic(), users[0], 0.01))
+
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    time.sleep(0.3)
+    scheduler.stop()
+    thread.join()
+
+    assert len(recording_event.runs) > 1
+    assert len(completed) == len(recording_event.runs)
+
+
+def test_user_interval_is_ignored_for_single_runs(recording_event, users):
+    users[0].interval = 10
+    scheduler = Scheduler('server')
+    scheduler.schedule_users(users[:1], 'record')
+    scheduler.run(until_idle=True)
+    assert recording_event.runs == ['user0']
+
+
+def test_scheduler_configure(recording_event, users):
+    scheduler = Scheduler('server', workers=1, batch_size=100)
+    scheduler.schedule_users(users, 'record')
+    scheduler.configure(workers=4, batch_size=50)
+
+    assert all(event.batch_size == 50 for event in scheduler._queue)
+    scheduler.run(until_idle=True)
+    assert recording_event.max_running == 4
@@ -2,7 +2,10 @@ from datetime import datetime, timezone
 
 import pytest
 
-from mesh.helpers import datetime_from_ISO8601_str, datetime_to_ISO8601_str, zero_pad_year
+from mesh import helpers
+from mesh.helpers import datetime_from_ISO8601_str, datetime_to_ISO8601_str, zero_pad_year, RateLimiter
+from mesh.helpers import (ISO8601_str_from_epoch, ISO8601_strs_from_epochs,
+                          epoch_from_ISO8601_str, epochs_from_ISO8601_strs)
 
 str_dates = [
     '1-01-01T00:00:00.000Z',
@@ -24,3 +27,45 @@ def test_datetime_from_iso8601_str(str_date, datetime_date):
 @pytest.mark.parametrize('datetime_date, str_date', list(zip(datetime_dates, str_dates_year_zero_padded)))
 def test_datetime_to_iso8601_str(datetime_date, str_date):
     assert datetime_to_ISO8601_str(datetime_date) == str_date
+
+
+def test_datetime_from_iso8601_str_keeps_milliseconds():
+    assert datetime_from_ISO8601_str('2020-03-02T10:00:00.123Z') == \
+        datetime(2020, 3, 2, 10, 0, 0, 123000, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('str_date, datetime_date', list(zip(str_dates, datetime_dates)))
+def test_epoch_from_iso8601_str(str_date, datetime_date):
+    epoch = int(datetime_date.timestamp())
+    assert epoch_from_ISO8601_str(str_date) == epoch
+    assert ISO8601_str_from_epoch(epoch) == zero_pad_year(str_date)
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_batch_epochs(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(helpers, 'numpy', None)
+
+    strs = str_dates + ['2020-03-02T10:00:00.999Z', '1970-01-01T00:00:00.000Z']
+    epochs = [epoch_from_ISO8601_str(s) for s in strs]
+
+    assert list(epochs_from_ISO8601_strs(strs)) == epochs
+    assert ISO8601_strs_from_epochs(epochs) == \
+        [datetime_to_ISO8601_str(datetime_from_ISO8601_str(s)) for s in strs]
+    assert list(epochs_from_ISO8601_strs([])) == []
+
+
+def test_rate_limiter_allows_burst_then_waits():
+    limiter = RateLimiter(20, burst=2)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    assert limiter.acquire('b') == 0
+
+
+def test_rate_limiter_pause():
+    limiter = RateLimiter(100, burst=5)
+    limiter.pause('a', 0.05)
+    assert limiter.acquire('a') > 0
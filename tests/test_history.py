@@ -0,0 +1,76 @@
+import pytest
+
+from mesh.history import History, decode, encode
+
+
+@pytest.fixture
+def history():
+    return History([('movie', 1, 300), ('episode', 1, 100), ('movie', 1, 100),
+                    ('movie', 2, 200)])
+
+
+def test_history_is_sorted(history):
+    assert list(history) == [('movie', 1, 100), ('movie', 1, 300),
+                             ('episode', 1, 100), ('movie', 2, 200)]
+    assert len(history) == 4
+
+
+def test_history_sorts_times_before_the_epoch():
+    plays = [('movie', 1, 5), ('movie', 1, -62135596800), ('episode', 7, 0),
+             ('movie', 1, 5), ('movie', 9, -1)]
+    assert list(History(plays)) == sorted(
+        plays, key=lambda p: (encode(*p[:2]), p[2]))
+    assert list(History([('movie', 3, 10)])) == [('movie', 3, 10)]
+    assert len(History()) == 0
+
+
+def test_encode_roundtrip():
+    for media in ('movie', 'episode'):
+        assert decode(encode(media, 42)) == (media, 42)
+
+
+def test_contains(history):
+    assert ('movie', 1, 300) in history
+    assert ('movie', 1, 200) not in history
+    assert ('episode', 2, 100) not in history
+
+
+def test_difference(history):
+    other = History([('movie', 1, 100), ('movie', 2, 200), ('movie', 3, 100)])
+    assert list(history.difference(other)) == [('movie', 1, 300),
+                                               ('episode', 1, 100)]
+    assert list(other.difference(history)) == [('movie', 3, 100)]
+
+
+def test_difference_with_tolerance(history):
+    other = History([('movie', 1, 105), ('movie', 1, 295), ('movie', 2, 260)])
+    assert list(history.difference(other, tolerance=10)) == [
+        ('episode', 1, 100), ('movie', 2, 200)]
+
+
+def test_difference_keeps_repeated_plays():
+    history = History([('movie', 1, 100), ('movie', 1, 100)])
+    other = History([('movie', 1, 100)])
+    assert list(history.difference(other)) == [('movie', 1, 100)]
+
+
+def test_latest(history):
+    assert list(history.latest()) == [('movie', 1, 300), ('episode', 1, 100),
+                                      ('movie', 2, 200)]
+
+
+def test_join(history):
+    other = History([('movie', 2, 250), ('movie', 1, 50), ('movie', 3, 1)])
+    assert list(history.join(other)) == [('movie', 1, 300, 50),
+                                         ('movie', 2, 200, 250)]
+
+
+def test_from_entries():
+    entries = [
+        {'type': 'movie', 'movie': {'ids': {'trakt': 1}},
+         'watched_at': '1970-01-01T00:01:00.000Z'},
+        {'type': 'episode', 'episode': {'ids': {'trakt': 2}},
+         'watched_at': '1970-01-01T00:00:30.000Z'}
+    ]
+    assert History.from_entries(iter(entries)) == History(
+        [('movie', 1, 60), ('episode', 2, 30)])
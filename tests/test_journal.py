@@ -0,0 +1,35 @@
+from mesh.journal import JournalEntry
+
+
+def test_journal_roundtrip(journal):
+    entries = {('movie', 1): JournalEntry(100, 100, 8, 50, 50),
+               ('episode', 1): JournalEntry(200, 210)}
+    journal.update('mesh', entries)
+
+    keys = [('movie', 1), ('episode', 1), ('movie', 2)]
+    assert journal.get('mesh', keys) == entries
+    assert journal.get('other', keys) == {}
+
+
+def test_journal_update_replaces(journal):
+    journal.update('mesh', {('movie', 1): JournalEntry(100, 100)})
+    journal.update('mesh', {('movie', 1): JournalEntry(200, 200, 7)})
+
+    assert journal.get('mesh', [('movie', 1)]) == {
+        ('movie', 1): JournalEntry(200, 200, 7)}
+
+
+def test_journal_get_many(journal):
+    entries = {('movie', i): JournalEntry(i) for i in range(1200)}
+    journal.update('mesh', entries)
+
+    assert journal.get('mesh', entries) == entries
+
+
+def test_journal_clear(journal, tmp_path):
+    journal.update('mesh', {('movie', 1): JournalEntry(100)})
+    journal.update('other', {('movie', 1): JournalEntry(100)})
+    journal.clear('mesh')
+
+    assert journal.get('mesh', [('movie', 1)]) == {}
+    assert len(journal.get('other', [('movie', 1)])) == 1
@@ -0,0 +1,132 @@
+import time
+
+from plexapi.server import PlexServer
+import pytest
+
+from benchmarks.mocks import MockPlex, MockTrakt, trakt_client
+from mesh import matching
+from mesh.matching import Episode, IdIndex, normalize_guid
+from mesh.plex import walk
+
+
+@pytest.mark.parametrize('guid, normalized', [
+    ('plex://movie/5d776825880197001ec967c6', 'plex://movie/5d776825880197001ec967c6'),
+    ('com.plexapp.agents.imdb://tt0944947?lang=en', 'imdb://tt0944947'),
+    ('com.plexapp.agents.themoviedb://1399?lang=en', 'tmdb://1399'),
+    ('com.plexapp.agents.thetvdb://121361/1/1?lang=en', 'tvdb://121361/1/1'),
+    ('tmdb://1399', 'tmdb://1399'),
+    ('local://1234', None),
+    ('com.plexapp.agents.none://1234', None)
+])
+def test_normalize_guid(guid, normalized):
+    assert normalize_guid(guid) == normalized
+
+
+def test_index_add_and_get(index):
+    index.add('movie', ['plex://movie/1', 'imdb://tt1'], 10)
+    assert index.get('movie', ['imdb://tt1']) == 10
+    assert index.get('show', ['imdb://tt1']) is None
+    assert index.guid('movie', 10) == 'plex://movie/1'
+
+
+def test_index_is_persistent(tmp_path):
+    path = tmp_path.joinpath('idindex.db')
+    index = IdIndex(path)
+    index.add('movie', ['imdb://tt1'], 10)
+    index.close()
+
+    index = IdIndex(path)
+    assert index.get('movie', ['imdb://tt1']) == 10
+    index.close()
+
+
+def test_index_invalidate(index):
+    index.add('movie', ['imdb://tt1', 'tmdb://1'], 10)
+    index.add('show', ['tmdb://1'], 20)
+
+    index.invalidate('movie', ['imdb://tt1'])
+    assert index.lookup('movie', ['imdb://tt1']) == (False, None)
+    assert index.get('movie', ['tmdb://1']) == 10
+
+    index.invalidate('movie')
+    assert index.get('movie', ['tmdb://1']) is None
+    assert index.get('show', ['tmdb://1']) == 20
+
+    index.add('movie', ['tmdb://1', 'tmdb://2'], 10)
+    index.invalidate(guids=['tmdb://1'])
+    assert index.get('movie', ['tmdb://1']) is None
+    assert index.get('show', ['tmdb://1']) is None
+    assert index.get('movie', ['tmdb://2']) == 10
+
+    index.invalidate()
+    assert len(index) == 0
+
+
+def test_index_resolve_many_searches_misses_once(monkeypatch, index):
+    searched = []
+
+    def search(media, guids):
+        searched.append(guids)
+        return {'imdb://tt2': 20}.get(guids[0])
+
+    monkeypatch.setattr(matching, 'search', search)
+    index.add('movie', ['imdb://tt1'], 10)
+
+    items = [('movie', ['imdb://tt1']), ('movie', ['imdb://tt2']),
+             ('movie', ['imdb://tt3'])]
+    assert index.resolve_many(items) == [10, 20, None]
+    assert index.resolve_many(items) == [10, 20, None]
+    assert searched == [['imdb://tt2'], ['imdb://tt3']]
+
+
+def test_index_expired_miss(monkeypatch, index):
+    index.add('movie', ['imdb://tt1'], None)
+    assert index.lookup('movie', ['imdb://tt1']) == (True, None)
+
+    monkeypatch.setattr(time, 'time', lambda: 2 ** 40)
+    assert index.lookup('movie', ['imdb://tt1']) == (False, None)
+
+
+def test_index_resolve_many_matches_episodes_by_show(monkeypatch, index):
+    searched, trees = [], []
+
+    def search(media, guids):
+        searched.append((media, guids))
+        return {'show': 5}.get(media)
+
+    def season_tree(show):
+        trees.append(show)
+        return {(1, 1): 51, (1, 2): 52}
+
+    monkeypatch.setattr(matching, 'search', search)
+    monkeypatch.setattr(matching, 'season_tree', season_tree)
+
+    show = ['tvdb://1']
+    items = [('episode', ['tvdb://11'], Episode(show, 1, 1)),
+             ('episode', ['tvdb://12'], Episode(show, 1, 2)),
+             ('episode', ['tvdb://13'], Episode(show, 1, 3)),
+             ('movie', ['imdb://tt1'], None)]
+    assert index.resolve_many(items) == [51, 52, None, None]
+    assert trees == [5]
+    assert searched == [('movie', ['imdb://tt1']), ('show', show),
+                        ('episode', ['tvdb://13'])]
+    assert index.get('show', show) == 5
+
+    # Season trees are kept in memory for other episodes of the show
+    items = [('episode', ['tvdb://14'], Episode(show, 1, 2))]
+    assert index.resolve_many(items) == [52]
+    assert trees == [5]
+
+
+def test_index_resolves_mock_library(index):
+    with MockPlex(size=250, users=1) as plex, \
+            MockTrakt(size=250, read_rate=1e9, burst=10 ** 9) as trakt, \
+            trakt_client(trakt, username=None):
+        server = PlexServer(plex.url, plex.token('user0'))
+        episodes = [i for i in walk(server) if i.media == 'episode']
+        ids = index.resolve_many([(i.media, i.guids, i.episode)
+                                  for i in episodes])
+
+    assert ids == list(range(250))
+    # One search and one season tree per show
+    assert trakt.requests == 2 * plex.shows
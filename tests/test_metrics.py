@@ -0,0 +1,85 @@
+import urllib.request
+
+import pytest
+
+from mesh import metrics
+
+
+def test_registry_series(registry):
+    registry.inc('mesh_index_lookups_total', 3, result='hit')
+    registry.inc('mesh_index_lookups_total', result='hit')
+    registry.set('mesh_scheduler_queued_events', 5)
+
+    assert registry.get('mesh_index_lookups_total', result='hit') == 4
+    assert registry.get('mesh_index_lookups_total', result='miss') == 0
+    assert registry.get('mesh_scheduler_queued_events') == 5
+
+    with pytest.raises(KeyError):
+        registry.inc('unknown_total')
+
+
+def test_render(registry):
+    registry.inc('mesh_http_requests_total', service='trakt',
+                 endpoint='/sync/history', method='GET', status=200)
+    registry.observe('mesh_http_request_seconds', 0.02,
+                     service='trakt', endpoint='/sync/history')
+    registry.observe('mesh_http_request_seconds', 100,
+                     service='trakt', endpoint='/sync/history')
+
+    lines = metrics.render().splitlines()
+    assert '# TYPE mesh_http_requests_total counter' in lines
+    assert 'mesh_http_requests_total{endpoint="/sync/history",method="GET",' \
+           'service="trakt",status="200"} 1' in lines
+    labels = 'endpoint="/sync/history",service="trakt"'
+    assert f'mesh_http_request_seconds_bucket{{{labels},le="0.01"}} 0' in lines
+    assert f'mesh_http_request_seconds_bucket{{{labels},le="0.025"}} 1' in lines
+    assert f'mesh_http_request_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f'mesh_http_request_seconds_count{{{labels}}} 2' in lines
+    assert not any(l.startswith('# TYPE mesh_events_total') for l in lines)
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('/library/metadata/123/allLeaves', '/library/metadata/{id}/allLeaves'),
+    ('/search/imdb/tt0000001', '/search/imdb/{id}'),
+    ('/sync/history/movies', '/sync/history/movies')
+])
+def test_endpoint(path, expected):
+    assert metrics.endpoint(path) == expected
+
+
+def test_phases(registry):
+    @metrics.mode('push')
+    def push():
+        with metrics.phase('match', 3):
+            pass
+        return list(metrics.measured([[1, 2], [3]], 'fetch'))
+
+    assert push() == [[1, 2], [3]]
+    with metrics.phase('apply') as phase:
+        phase.items = 2
+
+    assert registry.get('mesh_phase_items_total', mode='push',
+                        phase='match') == 3
+    assert registry.get('mesh_phase_items_total', mode='push',
+                        phase='fetch') == 3
+    assert registry.get('mesh_phase_items_total', mode='other',
+                        phase='apply') == 2
+    assert registry.get('mesh_phase_seconds_total', mode='push',
+                        phase='fetch') > 0
+
+    summary = metrics.summary()
+    assert any(l.startswith('push match: 3 items') for l in summary)
+
+
+def test_serve(registry):
+    registry.inc('mesh_scrobbles_total', action='start')
+    server = metrics.serve(0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'mesh_scrobbles_total{action="start"} 1' in body.splitlines()
@@ -0,0 +1,49 @@
+from mesh.outbox import Outbox
+
+
+def test_pending_in_order(outbox):
+    outbox.enqueue('mesh', 'sync/history', [('movie', 2, 'b'), ('movie', 1, 'a')])
+    outbox.enqueue('mesh', 'sync/ratings', [('movie', 1, 8)], field='rating')
+    outbox.enqueue('other', 'sync/history', [('movie', 3, 'c')])
+
+    pending = outbox.pending('mesh')
+    assert [(e.path, e.field, e.trakt, e.value) for e in pending] == [
+        ('sync/history', 'watched_at', 2, 'b'),
+        ('sync/history', 'watched_at', 1, 'a'),
+        ('sync/ratings', 'rating', 1, 8)]
+    assert [e.trakt for e in outbox.pending('mesh', 'sync/ratings')] == [1]
+    assert outbox.count('mesh') == 3
+    assert len(outbox) == 4
+
+
+def test_acknowledged_writes_are_not_enqueued_again(outbox):
+    items = [('movie', 1, 'a'), ('movie', 2, 'b')]
+    assert outbox.enqueue('mesh', 'sync/history', items) == 2
+    outbox.acknowledge([outbox.pending('mesh')[0].id])
+
+    assert outbox.enqueue('mesh', 'sync/history',
+                          items + [('movie', 1, 'c')]) == 1
+    assert [e.value for e in outbox.pending('mesh')] == ['b', 'c']
+
+    outbox.prune('mesh')
+    assert outbox.enqueue('mesh', 'sync/history', items) == 1
+    assert outbox.count('mesh') == 3
+
+
+def test_removals_are_not_enqueued_again(outbox):
+    items = [('movie', 1, None), ('movie', 2, None)]
+    assert outbox.enqueue('mesh', 'sync/ratings/remove', items, None) == 2
+    assert outbox.enqueue('mesh', 'sync/ratings/remove', items, None) == 0
+    assert [e.value for e in outbox.pending('mesh')] == [None, None]
+
+
+def test_persistence(tmp_path):
+    outbox = Outbox(tmp_path.joinpath('outbox.db'))
+    outbox.enqueue('mesh', 'sync/history', [('episode', 1, 'a')])
+    outbox.close()
+
+    reopened = Outbox(tmp_path.joinpath('outbox.db'))
+    assert [e.media for e in reopened.pending('mesh')] == ['episode']
+    reopened.clear('mesh')
+    assert len(reopened) == 0
+    reopened.close()
@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+import time
+from xml.etree import ElementTree
+
+import requests
+
+from benchmarks.mocks import MockPlex
+from mesh import plex
+from mesh.plex import LibraryItem, Play, probe, walk_section, recently_watched
+
+MOVIE = '''<Video ratingKey="{key}" guid="plex://movie/{key}" viewCount="{views}"
+ {viewed} userRating="8.0"><Guid id="imdb://tt{key}"/></Video>'''
+
+
+class FakeSection:
+    key = 1
+    type = 'movie'
+
+
+class FakeLibrary:
+    def sections(self):
+        return [FakeSection()]
+
+
+class FakeServer:
+    """Serves *count* movies, every other one watched"""
+
+    library = FakeLibrary()
+
+    def __init__(self, count):
+        self.count = count
+        self.queries = []
+
+    def query(self, path, headers):
+        self.queries.append((path, headers))
+        start = int(headers['X-Plex-Container-Start'])
+        size = int(headers['X-Plex-Container-Size'])
+        videos = ''.join(
+            MOVIE.format(key=k, views=k % 2,
+                         viewed=f'lastViewedAt="{k}"' if k % 2 else '')
+            for k in range(start, min(start + size, self.count)))
+        return ElementTree.fromstring(
+            f'<MediaContainer totalSize="{self.count}">{videos}</MediaContainer>')
+
+
+def test_walk_section_pages_through_section():
+    server = FakeServer(25)
+    items = list(walk_section(server, 1, 'movie', container_size=10))
+
+    assert [i.rating_key for i in items] == list(range(25))
+    assert [h['X-Plex-Container-Start'] for _, h in server.queries] == ['0', '10', '20']
+    assert '/library/sections/1/all?includeGuids=1&type=1' == server.queries[0][0]
+
+
+def test_walk_section_records():
+    item = next(walk_section(FakeServer(2), 1, 'movie'))
+    assert item == LibraryItem('movie', 0, ['plex://movie/0', 'imdb://tt0'],
+                               0, None, 8.0, None)
+
+
+def test_walk_section_is_lazy():
+    server = FakeServer(1000)
+    items = walk_section(server, 1, 'movie', container_size=10)
+    next(items)
+    assert len(server.queries) == 1
+
+
+def test_recently_watched_filters_and_yields_plays():
+    server = FakeServer(4)
+    since = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    plays = list(recently_watched(server, since))
+
+    assert plays[0] == Play('movie', ['plex://movie/1', 'imdb://tt1'],
+                            datetime.fromtimestamp(1, timezone.utc))
+    assert len(plays) == 2
+    assert f'lastViewedAt>>={int(since.timestamp())}' in server.queries[0][0]
+
+
+class FakeResponse:
+    def __init__(self, identifier):
+        self.content = f'<MediaContainer machineIdentifier="{identifier}"/>'.encode()
+
+
+class FakeSession:
+    """Answers each url after its delay, from the server it maps to"""
+
+    def __init__(self, delays, identifiers=None):
+        self.delays = delays
+        self.identifiers = identifiers or {}
+
+    def get(self, url, timeout):
+        base = url.rsplit('/', 1)[0]
+        delay = self.delays[base]
+        if delay is None:
+            raise requests.ConnectionError()
+        time.sleep(delay)
+        return FakeResponse(self.identifiers.get(base, 'server'))
+
+
+def test_probe_selects_fastest_connection(monkeypatch):
+    session = FakeSession({'https://relay': 0.1, 'https://local': 0.01,
+                           'https://remote': 0.05})
+    monkeypatch.setattr(plex, 'get_session', lambda: session)
+
+    url, latency = probe(list(session.delays), 'server')
+    assert url == 'https://local'
+    assert latency < 0.1
+
+
+def test_probe_ignores_failures_and_other_servers(monkeypatch):
+    session = FakeSession({'https://down': None, 'https://other': 0,
+                           'https://relay': 0.02},
+                          identifiers={'https://other': 'other'})
+    monkeypatch.setattr(plex, 'get_session', lambda: session)
+
+    assert probe(list(session.delays), 'server')[0] == 'https://relay'
+    assert probe(['https://down'], 'server') is None
+
+
+def test_connect_cached_url_with_server_token():
+    with MockPlex(size=10) as server:
+        token = server.token('user0')
+        connection = plex.connect(server.identifier, 'account', server.url,
+                                  token)
+        assert (connection.url, connection.token) == (server.url, token)
+        assert connection.server.machineIdentifier == server.identifier
+
+        connection = plex.connect(server.identifier, token, server.url)
+        assert connection.token == token
+
+
+def test_oauth(monkeypatch):
+    headers = {'X-Plex-Product': 'Mesh', 'X-Plex-Platform': 'Linux',
+               'X-Plex-Client-Identifier': 'mesh'}
+    monkeypatch.setattr(plex, 'build_auth_headers', lambda: headers)
+    with MockPlex(size=10) as server:
+        monkeypatch.setattr(plex, 'PLEX_TV_URL', server.url)
+        flow = plex.oauth()
+        assert 'clientID=mesh' in next(flow)
+        assert next(flow) == ('user0', server.token('user0'))
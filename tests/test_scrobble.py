@@ -0,0 +1,67 @@
+import pytest
+
+from mesh.scrobble import Scrobbler, progress
+
+
+@pytest.mark.parametrize('view_offset, duration, expected', [
+    (0, 1000, 0),
+    (500, 1000, 50),
+    (1, 3, 33.33),
+    (2000, 1000, 100),
+    (10, 0, 0)
+])
+def test_progress(view_offset, duration, expected):
+    assert progress(view_offset, duration) == expected
+
+
+class RecordingScrobbler(Scrobbler):
+    def __init__(self):
+        super().__init__(None, [], None)
+        self.scrobbled = []
+
+    def _scrobble(self, notification):
+        self.scrobbled.append(notification['state'])
+
+
+def alert(state, key='1'):
+    return {'type': 'playing', 'PlaySessionStateNotification': [
+        {'sessionKey': key, 'ratingKey': '10', 'state': state, 'viewOffset': 0}]}
+
+
+def test_only_state_changes_are_scrobbled():
+    scrobbler = RecordingScrobbler()
+    for state in ('playing', 'playing', 'buffering', 'paused', 'paused',
+                  'playing', 'stopped'):
+        scrobbler._on_alert(alert(state))
+    scrobbler.stop()
+
+    assert scrobbler.scrobbled == ['playing', 'paused', 'playing', 'stopped']
+
+
+def test_stopped_sessions_are_forgotten():
+    scrobbler = RecordingScrobbler()
+    for state in ('playing', 'stopped', 'playing'):
+        scrobbler._on_alert(alert(state))
+    scrobbler._on_alert(alert('stopped'))
+    scrobbler.stop()
+
+    assert scrobbler.scrobbled == ['playing', 'stopped', 'playing', 'stopped']
+    assert scrobbler._states == {}
+
+
+def test_scrobble_errors_are_logged(caplog):
+    class FailingScrobbler(Scrobbler):
+        def _session(self, notification):
+            raise RuntimeError('unexpected')
+
+    scrobbler = FailingScrobbler(None, [], None)
+    scrobbler._on_alert(alert('playing'))
+    scrobbler.stop()
+    assert 'Failed to scrobble' in caplog.text
+
+
+def test_other_notifications_are_ignored():
+    scrobbler = RecordingScrobbler()
+    scrobbler._on_alert({'type': 'timeline'})
+    scrobbler.stop()
+    assert scrobbler.scrobbled == []
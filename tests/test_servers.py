@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from mesh import metrics
+from mesh.servers import Server, ServerPools
+
+
+def test_single_server_runs_inline():
+    pools = ServerPools(['a'])
+    assert pools.map(lambda i: (i, threading.current_thread())) == [
+        ('a', threading.current_thread())]
+
+
+def test_map_limits_each_server():
+    lock = threading.Lock()
+    running = {'small': 0, 'large': 0}
+    peaks = dict(running)
+
+    def work(identifier):
+        with lock:
+            running[identifier] += 1
+            peaks[identifier] = max(peaks[identifier], running[identifier])
+        time.sleep(0.02)
+        with lock:
+            running[identifier] -= 1
+        return identifier
+
+    pools = ServerPools([Server('small', 'small', workers=1),
+                         Server('large', 'large')], workers=4)
+    threads = [threading.Thread(target=pools.map, args=(work,))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert pools.map(work) == ['small', 'large']
+    assert peaks['small'] == 1
+    assert peaks['large'] > 1
+    pools.shutdown()
+
+
+def test_map_raises_after_all_calls():
+    done = []
+
+    def work(identifier):
+        if identifier == 'a':
+            raise ValueError(identifier)
+        time.sleep(0.02)
+        done.append(identifier)
+
+    pools = ServerPools(['a', 'b'])
+    with pytest.raises(ValueError):
+        pools.map(work)
+    assert done == ['b']
+    pools.shutdown()
+
+
+def test_map_keeps_metrics_mode():
+    pools = ServerPools(['a', 'b'])
+    with metrics.mode('push'):
+        assert pools.map(lambda i: metrics.current_mode()) == ['push'] * 2
+    pools.shutdown()
@@ -0,0 +1,35 @@
+from requests.adapters import HTTPAdapter
+from trakt import Trakt
+
+from mesh import sessions
+from mesh.sessions import TimeoutHTTPAdapter, build_session, configure
+
+
+def test_build_session_pools_connections():
+    session = build_session(pool_size=7, pool_hosts=3, retries=2)
+    adapter = session.get_adapter('https://api.trakt.tv')
+
+    assert isinstance(adapter, TimeoutHTTPAdapter)
+    assert adapter._pool_maxsize == 7
+    assert adapter._pool_connections == 3
+    assert adapter.max_retries.total == 2
+    assert not adapter.max_retries.is_retry('POST', 503)
+    assert adapter.max_retries.is_retry('GET', 503)
+
+
+def test_adapter_applies_default_timeout(monkeypatch):
+    sent = []
+    monkeypatch.setattr(HTTPAdapter, 'send',
+                        lambda self, request, **kwargs: sent.append(kwargs))
+
+    adapter = TimeoutHTTPAdapter(5)
+    adapter.send(None)
+    adapter.send(None, timeout=1)
+    assert [kwargs['timeout'] for kwargs in sent] == [5, 1]
+
+
+def test_configure_installs_session_in_trakt(monkeypatch):
+    monkeypatch.setattr(sessions, '_session', None)
+    session = configure(pool_size=3)
+    assert sessions.get_session() is session
+    assert Trakt.http.session is session
@@ -0,0 +1,440 @@
+from datetime import datetime, timezone
+import threading
+
+import pytest
+import requests
+
+from benchmarks.mocks import MockPlex, MockTrakt, trakt_client
+from mesh import api, matching, synchronize
+from mesh.exceptions import RateLimitExceeded, SynchronizationError
+from mesh.helpers import datetime_to_ISO8601_str
+from mesh.plex import Play
+from mesh.history import History
+from mesh.journal import JournalEntry
+from mesh.servers import ServerPools
+from mesh.synchronize import (Delta, Observation, changed_categories,
+                              changed_since, deliver, merge, pipeline, plan,
+                              pull_delta, push, push_plays, send_batches, sync,
+                              trakt_changes)
+from mesh.user import User
+
+
+@pytest.fixture
+def activities():
+    """Returns a last_activities response where only movies changed recently"""
+
+    return {
+        'movies': {
+            'watched_at': '2020-03-02T10:00:00.000Z',
+            'rated_at': '2020-01-01T00:00:00.000Z',
+            'watchlisted_at': '2020-01-01T00:00:00.000Z'
+        },
+        'episodes': {
+            'watched_at': '2020-01-01T00:00:00.000Z',
+            'rated_at': '2020-01-01T00:00:00.000Z'
+        },
+        'shows': {
+            'rated_at': '2020-01-01T00:00:00.000Z',
+            'watchlisted_at': '2020-01-01T00:00:00.000Z'
+        }
+    }
+
+
+@pytest.fixture
+def pending(monkeypatch, outbox):
+    """Replaces the shared outbox by an empty one"""
+
+    monkeypatch.setattr('mesh.outbox._outbox', outbox)
+    return outbox
+
+
+@pytest.fixture
+def user():
+    return User('mesh', 'token', {'access_token': 'auth'},
+                last_pull='2020-02-01T00:00:00.000Z')
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {}
+
+    def json(self):
+        return self.data
+
+
+def test_changed_categories(activities):
+    since = datetime(2020, 2, 1, tzinfo=timezone.utc)
+    changes, watermark = changed_categories(activities, since)
+    assert changes == {'history': ['movies']}
+    assert watermark == datetime(2020, 3, 2, 10, tzinfo=timezone.utc)
+
+
+def test_changed_categories_from_first_pull(activities):
+    since = datetime.min.replace(tzinfo=timezone.utc)
+    changes, _ = changed_categories(activities, since)
+    assert changes['history'] == ['movies', 'episodes']
+    assert changes['ratings'] == ['movies', 'shows', 'episodes']
+    assert changes['watchlist'] == ['movies', 'shows']
+
+
+def test_changed_categories_without_changes(activities):
+    since = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    changes, watermark = changed_categories(activities, since)
+    assert changes == {}
+    assert watermark == since
+
+
+def test_changed_since():
+    items = [{'rated_at': '2020-01-01T00:00:00.000Z'},
+             {'rated_at': '2020-03-01T00:00:00.000Z'}]
+    since = datetime(2020, 2, 1, tzinfo=timezone.utc)
+    assert changed_since(items, 'ratings', since) == items[1:]
+
+
+def test_pull_delta_skips_unchanged_categories(monkeypatch, activities, user):
+    requested = []
+
+    def get(path, query=None, authenticated=True):
+        requested.append((path, query))
+        if path == 'sync/last_activities':
+            return FakeResponse(activities)
+        return FakeResponse([{'type': 'movie', 'watched_at': '2020-03-02T10:00:00.000Z'}])
+
+    monkeypatch.setattr(api, 'get', get)
+    delta = pull_delta(user)
+
+    assert [p for p, _ in requested] == ['sync/last_activities',
+                                         'sync/history/movies']
+    assert requested[1][1]['start_at'] == '2020-02-01T00:00:00.000Z'
+    assert len(delta) == 1
+    assert delta.watermark == datetime(2020, 3, 2, 10, tzinfo=timezone.utc)
+
+
+def test_empty_delta():
+    assert not Delta(datetime.min.replace(tzinfo=timezone.utc))
+
+
+def history_response(not_found=()):
+    return FakeResponse({'added': {}, 'not_found': {'movies': [
+        {'ids': {'trakt': i}} for i in not_found]}})
+
+
+def test_send_batches_chunks_items(monkeypatch):
+    batches = []
+
+    def post(path, data, authenticated=True):
+        batches.append(data['movies'])
+        return history_response()
+
+    monkeypatch.setattr(api, 'post', post)
+    items = [('movie', i, '2020-01-01T00:00:00.000Z') for i in range(25)]
+    assert send_batches('sync/history', items, batch_size=10) == []
+    assert [len(b) for b in batches] == [10, 10, 5]
+
+
+def test_send_batches_shrinks_batches_when_rate_limited(monkeypatch):
+    batches = []
+
+    def post(path, data, authenticated=True):
+        if len(batches) == 1:
+            batches.append(None)
+            raise RateLimitExceeded('limited', 0)
+        batches.append(len(data['movies']))
+        return history_response()
+
+    monkeypatch.setattr(api, 'post', post)
+    monkeypatch.setattr(synchronize, 'MIN_BATCH_SIZE', 1)
+    items = [('movie', i, '2020-01-01T00:00:00.000Z') for i in range(20)]
+    send_batches('sync/history', items, batch_size=8)
+    assert batches == [8, None, 4, 8]
+
+
+def test_send_batches_gives_up(monkeypatch):
+    def post(path, data, authenticated=True):
+        raise SynchronizationError('failed')
+
+    monkeypatch.setattr(api, 'post', post)
+    monkeypatch.setattr(synchronize, 'RETRY_DELAY', 0)
+    with pytest.raises(SynchronizationError):
+        send_batches('sync/history', [('movie', 1, '')])
+
+
+def test_send_batches_rate_limits_are_not_failures(monkeypatch):
+    calls = []
+
+    def post(path, data, authenticated=True):
+        calls.append(len(data['movies']))
+        if len(calls) <= synchronize.MAX_ATTEMPTS:
+            raise RateLimitExceeded('limited', 0)
+        return history_response()
+
+    monkeypatch.setattr(api, 'post', post)
+    items = [('movie', i, '2020-01-01T00:00:00.000Z') for i in range(4)]
+    assert send_batches('sync/history', items, batch_size=4) == []
+    assert len(calls) == synchronize.MAX_ATTEMPTS + 1
+
+
+def test_deliver_resumes_after_failure(monkeypatch, pending):
+    batches = []
+
+    def post(path, data, authenticated=True):
+        if len(batches) == 1 and failing:
+            raise SynchronizationError('unreachable')
+        batches.append([i['ids']['trakt'] for i in data['movies']])
+        return history_response()
+
+    monkeypatch.setattr(api, 'post', post)
+    monkeypatch.setattr(synchronize, 'RETRY_DELAY', 0)
+    items = [('movie', i, '2020-01-01T00:00:00.000Z') for i in range(25)]
+
+    failing = True
+    with pytest.raises(SynchronizationError):
+        deliver('mesh', 'sync/history', items, batch_size=10)
+    assert pending.count('mesh') == 15
+
+    # Repeating the writes only sends those which were not delivered
+    failing = False
+    assert deliver('mesh', 'sync/history', items, batch_size=10) == []
+    assert batches == [list(range(10)), list(range(10, 20)),
+                       list(range(20, 25))]
+    assert pending.count('mesh') == 0
+
+
+def test_pipeline_keeps_order():
+    results = pipeline(range(20), lambda v: v * 2, lambda v: v + 1, depth=1)
+    assert list(results) == [v * 2 + 1 for v in range(20)]
+    assert list(pipeline([])) == []
+
+
+def test_pipeline_raises_stage_errors():
+    def stage(value):
+        if value == 3:
+            raise SynchronizationError('failed')
+        return value
+
+    results = []
+    with pytest.raises(SynchronizationError):
+        for value in pipeline(range(10), stage):
+            results.append(value)
+    assert results == [0, 1, 2]
+
+
+def test_pipeline_applies_backpressure():
+    produced = []
+    release = threading.Event()
+
+    def source():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    def stage(value):
+        if value:
+            release.wait()
+        return value
+
+    results = pipeline(source(), stage, depth=2)
+    assert next(results) == 0
+    threading.Event().wait(0.2)
+    # One value held by the stage, two queued and one waiting to be queued
+    assert produced == [0, 1, 2, 3, 4]
+
+    release.set()
+    results.close()
+    assert len(produced) < 100
+
+
+def test_push_plays_retries_only_not_found(monkeypatch, index):
+    sent = []
+
+    def post(path, data, authenticated=True):
+        sent.append([i['ids']['trakt'] for i in data['movies']])
+        return history_response(not_found=[2] if len(sent) == 1 else [])
+
+    def search(media, guids):
+        return {'imdb://tt1': 1, 'imdb://tt2': 22}.get(guids[0])
+
+    monkeypatch.setattr(api, 'post', post)
+    monkeypatch.setattr(matching, 'search', search)
+    index.add('movie', ['imdb://tt2'], 2)  # Stale mapping
+
+    watched_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    plays = [Play('movie', ['imdb://tt1'], watched_at),
+             Play('movie', ['imdb://tt2'], watched_at),
+             Play('movie', ['local://3'], watched_at)]
+
+    assert push_plays(plays, index) == 1
+    assert sent == [[1, 2], [22]]
+    assert index.get('movie', ['imdb://tt2']) == 22
+
+
+def test_merge_copies_one_sided_changes():
+    base = JournalEntry(100, 100, 7, 100, 100)
+    to_plex, to_trakt, entry = merge(base, Observation(watched_at=200),
+                                     Observation(rating=9, rated_at=300))
+
+    assert to_plex == Observation(rating=9, rated_at=300)
+    assert to_trakt == Observation(watched_at=200)
+    assert entry == JournalEntry(200, 200, 9, 100, 300)
+
+
+def test_merge_ignores_unchanged_items():
+    base = JournalEntry(200, 200, 8, 100, 100)
+    to_plex, to_trakt, entry = merge(base, Observation(200, 8, 100),
+                                     Observation(150))
+
+    assert to_plex == to_trakt == Observation()
+    assert entry == base
+
+
+def test_merge_plays_on_both_sides():
+    to_plex, to_trakt, entry = merge(None, Observation(watched_at=200),
+                                     Observation(watched_at=300))
+
+    assert to_plex == to_trakt == Observation()
+    assert entry.plex_watched_at == 200
+    assert entry.trakt_watched_at == 300
+
+
+@pytest.mark.parametrize('plex_rated_at, trakt_rated_at, rating', [
+    (300, 200, 6),
+    (200, 300, 9),
+    (200, 200, 6)
+])
+def test_merge_rating_conflict(plex_rated_at, trakt_rated_at, rating):
+    to_plex, to_trakt, entry = merge(JournalEntry(rating=7),
+                                     Observation(None, 6, plex_rated_at),
+                                     Observation(None, 9, trakt_rated_at))
+
+    assert entry.rating == rating
+    if rating == 6:
+        assert to_plex == Observation()
+        assert to_trakt.rating == 6
+    else:
+        assert to_plex.rating == 9
+        assert to_trakt == Observation()
+
+
+def test_merge_unrating():
+    to_plex, to_trakt, entry = merge(JournalEntry(rating=7, plex_rated_at=100),
+                                     Observation(rating=0, rated_at=200),
+                                     Observation())
+
+    assert to_trakt.rating == 0
+    assert entry.rating == 0
+
+
+def test_trakt_changes():
+    delta = Delta(None, history=[
+        {'type': 'movie', 'movie': {'ids': {'trakt': 1}},
+         'watched_at': '2020-01-01T00:00:00.000Z'},
+        {'type': 'movie', 'movie': {'ids': {'trakt': 1}},
+         'watched_at': '2020-01-02T00:00:00.000Z'}
+    ], ratings=[
+        {'type': 'movie', 'movie': {'ids': {'trakt': 1}}, 'rating': 8,
+         'rated_at': '2020-01-03T00:00:00.000Z'},
+        {'type': 'show', 'show': {'ids': {'trakt': 2}}, 'rating': 5,
+         'rated_at': '2020-01-03T00:00:00.000Z'}
+    ])
+
+    changes, entries = trakt_changes(delta)
+    assert changes == {('movie', 1): Observation(1578009600 - 86400, 8,
+                                                 1578009600)}
+    assert list(entries) == [('movie', 1)]
+
+
+def test_push_plays_skips_plays_on_trakt(monkeypatch, index):
+    sent = []
+
+    def post(path, data, authenticated=True):
+        sent.extend(i['ids']['trakt'] for i in data['movies'])
+        return history_response()
+
+    monkeypatch.setattr(api, 'post', post)
+    index.add('movie', ['imdb://tt1'], 1)
+    index.add('movie', ['imdb://tt2'], 2)
+
+    watched_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    plays = [Play('movie', ['imdb://tt1'], watched_at),
+             Play('movie', ['imdb://tt2'], watched_at)]
+    history = History([('movie', 1, int(watched_at.timestamp()))])
+
+    assert push_plays(plays, index, history=history) == 0
+    assert sent == [2]
+
+
+def test_push_merges_servers(monkeypatch, index, pending):
+    monkeypatch.setattr(matching, '_index', index)
+    with MockPlex(size=30) as first, MockPlex(size=30) as second, \
+            MockTrakt(size=30, read_rate=1e9, write_rate=1e9,
+                      burst=10 ** 9) as trakt, trakt_client(trakt):
+        user = User('user0', first.token('user0'), trakt.authorize('user0'),
+                    url=first.url)
+        # Plays of the second server are a later view of the same items
+        for i in range(0, 30, 3):
+            requests.get(f'{second.url}/:/scrobble', params={
+                'key': second.rating_key('movie', i),
+                'identifier': 'com.plexapp.plugins.library'},
+                headers={'X-Plex-Token': second.token('user0')})
+
+        servers = ServerPools([first.identifier, second.identifier])
+        servers.connections[('user0', second.identifier)] = (second.url, '')
+        push(user, servers)
+        servers.shutdown()
+
+        history = trakt.state('user0').history
+
+    assert len(history) == 20
+    assert {e['watched_at'] for e in history if e['type'] == 'movie'} == {
+        datetime_to_ISO8601_str(datetime.fromtimestamp(
+            second.state('user0', second.rating_key('movie', i))
+            ['lastViewedAt'], timezone.utc)) for i in range(0, 30, 3)}
+
+
+def test_combine_keeps_latest_changes():
+    combined = synchronize._combine(Observation(300, 6, 100),
+                                    Observation(200, 8, 150))
+    assert combined == Observation(300, 8, 150)
+    assert synchronize._combine(None, Observation(1)) == Observation(1)
+
+
+def test_plan_writes_nothing(monkeypatch, index, journal, pending):
+    monkeypatch.setattr(matching, '_index', index)
+    monkeypatch.setattr('mesh.journal._journal', journal)
+    with MockPlex(size=30) as plex, \
+            MockTrakt(size=30, read_rate=1e9, write_rate=1e9,
+                      burst=10 ** 9) as trakt, trakt_client(trakt):
+        user = User('user0', plex.token('user0'), trakt.authorize('user0'),
+                    url=plex.url)
+        result = plan(user, plex.identifier, batch_size=8)
+
+        assert trakt.state('user0').history == []
+        assert pending.count() == 0
+        assert user.last_sync.year == 1
+        assert user.server_token == ''
+        assert result.items == 20
+        assert result.actions['trakt_history_add'] == 20
+        assert result.actions['plex_mark_played'] == 0
+        assert result.requests['trakt']['write'] == 3
+        assert result.requests['trakt']['read'] > 0
+        assert result.memory > 0
+        assert result.as_dict()['user'] == 'user0'
+
+        sync(user, plex.identifier, batch_size=8)
+        assert len(trakt.state('user0').history) == 20
+        assert user.server_token == plex.token('user0')
+
+
+def test_plan_does_not_renew_tokens():
+    with MockTrakt(size=10, expires_in=24 * 60 * 60) as trakt, \
+            trakt_client(trakt, username=None):
+        user = User('user0', 'token', trakt.authorize('user0'))
+        token = user.trakt
+
+        with pytest.raises(SynchronizationError):
+            plan(user, 'server')
+        assert user.trakt is token
+        assert trakt.requests == 0
@@ -0,0 +1,142 @@
+import threading
+
+import pytest
+
+from benchmarks.mocks import MockTrakt, trakt_client
+from mesh import api, tokens
+from mesh.exceptions import SynchronizationError
+from mesh.tokens import TokenManager
+from mesh.user import User, UserStore
+
+DAY = 24 * 60 * 60
+
+
+@pytest.mark.parametrize('token, seconds, expected', [
+    ({'created_at': 0, 'expires_in': 100}, 50, False),
+    ({'created_at': 0, 'expires_in': 100}, 150, True),
+    ({'created_at': '0', 'expires_in': '100'}, 150, True),
+    ({'access_token': 'token'}, 150, False),
+    ({}, 150, False)
+])
+def test_expires_within(token, seconds, expected):
+    assert tokens.expires_within(token, seconds, now=0) is expected
+
+
+def test_due_soonest_first(store):
+    for name, created in (('late', 50), ('never', None), ('soon', 10),
+                          ('fresh', 10 ** 6)):
+        trakt = {} if created is None else {'created_at': created,
+                                            'expires_in': 100}
+        store.add(User(name, 'token', trakt))
+
+    manager = TokenManager(store, renew_before=200)
+    assert [u.name for u in manager.due(now=0)] == ['soon', 'late']
+    assert TokenManager().due() == []
+
+
+def test_expiring_token_renewed_before_use(store, registry):
+    with MockTrakt(size=10, expires_in=DAY) as trakt, \
+            trakt_client(trakt, username=None):
+        user = User('user', 'token', trakt.authorize('user'))
+        store.add(user)
+        expired = user.trakt
+        trakt.expires_in = 90 * DAY
+
+        manager = TokenManager(store)
+        with manager.authorized(user):
+            history = api.get('sync/history/movies').json()
+
+        assert history == []
+        assert user.trakt['refresh_token'] != expired['refresh_token']
+        assert trakt.requests == 2
+
+    store.close()
+    reopened = UserStore(store.file)
+    assert reopened.get('user').trakt == user.trakt
+    reopened.close()
+    assert registry.get('mesh_token_renewals_total', result='success') == 1
+
+
+def test_valid_token_not_renewed(registry):
+    with MockTrakt(size=10) as trakt, trakt_client(trakt, username=None):
+        user = User('user', 'token', trakt.authorize('user'))
+        token = user.trakt
+
+        with TokenManager().authorized(user):
+            api.get('sync/history/movies')
+
+        assert user.trakt is token
+        assert trakt.requests == 1
+    assert registry.get('mesh_token_renewals_total', result='success') == 0
+
+
+def test_rejected_refresh_token(registry):
+    with MockTrakt(size=10) as trakt, trakt_client(trakt, username=None):
+        user = User('user', 'token', {'access_token': 'a',
+                                      'refresh_token': 'unknown'})
+
+        with pytest.raises(SynchronizationError):
+            TokenManager().renew(user)
+        assert user.trakt['access_token'] == 'a'
+    assert registry.get('mesh_token_renewals_total', result='failure') == 1
+
+
+def test_renew_due_in_batches(store):
+    with MockTrakt(size=10, expires_in=DAY) as trakt, \
+            trakt_client(trakt, username=None):
+        invalid = User('invalid', 'token', dict(trakt.authorize('invalid'),
+                                                refresh_token='unknown'))
+        store.add(invalid)
+        for i in range(5):
+            store.add(User(f'user{i}', 'token', trakt.authorize(f'user{i}')))
+        trakt.expires_in = 90 * DAY
+
+        manager = TokenManager(store, batch_size=4)
+        assert manager.renew_due() == 3
+        assert len(manager.due()) == 3
+        assert manager.renew_due() == 2
+        assert manager.due() == [invalid]
+
+
+def test_renew_due_skips_tokens_in_use(store):
+    with MockTrakt(size=10, expires_in=4 * DAY) as trakt, \
+            trakt_client(trakt, username=None):
+        user = User('user', 'token', trakt.authorize('user'))
+        store.add(user)
+        trakt.expires_in = 90 * DAY
+        manager = TokenManager(store, renew_before=5 * DAY)
+
+        in_use, release = threading.Event(), threading.Event()
+
+        def use():
+            with manager.authorized(user):
+                in_use.set()
+                release.wait()
+
+        thread = threading.Thread(target=use)
+        thread.start()
+        in_use.wait()
+        try:
+            assert manager.renew_due() == 0
+        finally:
+            release.set()
+            thread.join()
+        assert manager.renew_due() == 1
+
+
+def test_background_renewal(store):
+    with MockTrakt(size=10, expires_in=DAY) as trakt, \
+            trakt_client(trakt, username=None):
+        store.add(User('user', 'token', trakt.authorize('user')))
+        trakt.expires_in = 90 * DAY
+        manager = TokenManager(store, interval=0.01)
+
+        manager.start()
+        try:
+            for _ in range(500):
+                if not manager.due():
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            manager.stop()
+        assert manager.due() == []
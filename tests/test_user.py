@@ -4,7 +4,7 @@ from pathlib import Path
 
 import pytest
 
-from mesh.user import User, UserManager, UserEncoder
+from mesh.user import User, UserManager, UserEncoder, UserStore
 
 
 @pytest.fixture
@@ -122,4 +122,42 @@ def test_usermanager_save(non_existing_file, user):
     um.save()
 
     um_load = UserManager(non_existing_file)
-    assert um == um_load
\ No newline at end of file
+    assert um == um_load
+
+
+def test_userstore_add_user(store, user):
+    store.add(user)
+    assert store.get('mesh') == user
+    assert store.users == [user]
+    with pytest.raises(ValueError):
+        store.add(user)
+
+
+def test_userstore_update_persists(store, user, tmp_path):
+    store.add(user)
+    user.last_pull = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    user.url = 'http://127.0.0.1:32400'
+    user.server_token = 'server'
+    user.interval = 60
+    store.update(user)
+    store.close()
+
+    reopened = UserStore(tmp_path.joinpath('users.db'))
+    loaded = reopened.get('mesh')
+    assert loaded.last_pull == user.last_pull
+    assert loaded.url == user.url
+    assert loaded.server_token == user.server_token
+    assert loaded.interval == 0
+    assert loaded.trakt == {'trakt': 'auth'}
+    reopened.close()
+
+
+def test_userstore_update_unknown_user(store, user):
+    with pytest.raises(ValueError):
+        store.update(user)
+
+
+def test_userstore_import_json(store, existing_file, user):
+    assert store.import_json(existing_file) == 1
+    assert store.get('mesh') == user
+    assert store.import_json(existing_file) == 0